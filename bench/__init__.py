@@ -0,0 +1 @@
+# Стенд для нагрузочных замеров: подставные Telegram и OpenAI, временный Postgres
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import random
+import time
+
+import openai
+from aiohttp import web
+
+
+class FakeOpenAI:
+    """Локальный HTTP-сервер с API ChatCompletion для стенда.
+
+    Задержка ответа — latency секунд ± доля jitter; error_rate доля запросов получает 500,
+    rate_limit_rate — 429 с Retry-After. Ответы зависят от промпта, чтобы диалог проходил
+    всю воронку: анализ соцсетей отвечает JSON с Vedet, анализ квалификации — JSON
+    с квалификацией, первый промпт на trigger_turn-м сообщении пользователя отвечает
+    «Хорошо <3», второй и третий на thanks_turn-м — сообщением с #спасибо.
+
+    Потоковый запрос (stream) получает первый кусок через долю first_token_share
+    от задержки, остальные куски приходят равномерно за оставшееся время.
+
+    malformed_rate — доля ответов анализа, которые не проходят схему (лишний текст вокруг
+    JSON, бюджет строкой, неверное значение поля); на запрос исправления сервер отвечает
+    верным JSON.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.5, error_rate=0.0, rate_limit_rate=0.0, retry_after=1,
+                 trigger_turn=2, thanks_turn=4, seti_answer="да", first_token_share=0.2, malformed_rate=0.0,
+                 host="127.0.0.1", port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.trigger_turn = trigger_turn
+        self.thanks_turn = thanks_turn
+        self.seti_answer = seti_answer
+        self.first_token_share = first_token_share
+        self.malformed_rate = malformed_rate
+        self.malformed = 0
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    def configure_openai(self):
+        """Направляет клиент openai на этот сервер."""
+        openai.api_base = self.url
+        openai.api_key = "bench"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def respond(self, messages):
+        """Текст ответа модели на запрос messages."""
+        system = "\n".join(message["content"] for message in messages if message["role"] == "system")
+        user_turns = sum(1 for message in messages if message["role"] == "user")
+        if "Исправь ответ" in system:
+            user = messages[-1]["content"]
+            return self.seti_result() if "Vedet" in user else self.qualification_result()
+        if "Vedet" in system:
+            if random.random() < self.malformed_rate:
+                self.malformed += 1
+                return "Анализ диалога:\n{\"Vedet\": \"скорее да\"}"
+            return self.seti_result()
+        if "monthly_budget" in system:
+            if random.random() < self.malformed_rate:
+                self.malformed += 1
+                return ("```json\n{\"qualification\": \"Горячий клиент\", \"monthly_budget\": \"около 50 тысяч\", "
+                        "\"consultation_agreed\": \"согласен\"}\n```")
+            return self.qualification_result()
+        if "конспект" in system:
+            return "Клиент ответил на вопросы менеджера."
+        if "Хорошо <3" in system:
+            if user_turns >= self.trigger_turn:
+                return "Хорошо <3"
+            return "Здравствуйте! Мы делаем видео для соцсетей с помощью нейросетей.\n\nПодскажите, вы сами ведёте свои соцсети?"
+        if user_turns >= self.thanks_turn:
+            return "Спасибо за ответы!\n\nС вами свяжется наш менеджер. #спасибо"
+        return "Понимаю, это частый вопрос.\n\nРасскажите, пожалуйста, сколько времени у вас уходит на съёмку видео?"
+
+    def seti_result(self):
+        return json.dumps({"Vedet": self.seti_answer}, ensure_ascii=False)
+
+    def qualification_result(self):
+        return json.dumps({
+            "qualification": "горячий",
+            "summary": "Клиент ведёт соцсети и согласился на консультацию.",
+            "monthly_budget": 50000,
+            "consultation_agreed": "да",
+        }, ensure_ascii=False)
+
+    async def _handle(self, request):
+        self.requests += 1
+        body = await request.json()
+        latency = max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+        stream = body.get("stream", False)
+        await asyncio.sleep(latency * self.first_token_share if stream else latency)
+
+        chance = random.random()
+        if chance < self.rate_limit_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+        if chance < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "Internal error", "type": "server_error"}}, status=500)
+
+        content = self.respond(body["messages"])
+        if stream:
+            return await self._stream(request, body, content, latency * (1 - self.first_token_share))
+        prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+        completion_tokens = len(content) // 4 + 1
+        return web.json_response({
+            "id": f"chatcmpl-bench-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    async def _stream(self, request, body, content, duration):
+        """Ответ в формате server-sent events, как у API при stream=true."""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        pieces = [content[start:start + 16] for start in range(0, len(content), 16)]
+        try:
+            for index, piece in enumerate(pieces):
+                if index:
+                    await asyncio.sleep(duration / len(pieces))
+                chunk = {
+                    "id": f"chatcmpl-bench-{self.requests}",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "gpt-4o-mini"),
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # Клиент закрыл поток, не дочитав (ответ прерван новым сообщением пользователя)
+            pass
+        return response
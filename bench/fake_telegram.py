@@ -0,0 +1,79 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+
+class FakeClient:
+    """Подставной клиент pyrogram: входящие сообщения подаёт стенд, исходящие складываются в почтовые ящики.
+
+    Поддерживает то, чем пользуются скрипты рассылки: start/stop, декоратор on_message,
+    send_message и send_document. send_latency имитирует задержку ответа Telegram.
+    """
+
+    def __init__(self, name, *args, send_latency=0.0, **kwargs):
+        self.name = name
+        self.send_latency = send_latency
+        self.handlers = []
+        self.sent = 0
+        self._mailboxes = {}
+        self._tasks = set()
+
+    async def start(self):
+        return self
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    def on_message(self, filters=None):
+        def decorator(handler):
+            self.handlers.append(handler)
+            return handler
+        return decorator
+
+    def mailbox(self, username):
+        mailbox = self._mailboxes.get(username)
+        if mailbox is None:
+            mailbox = self._mailboxes[username] = asyncio.Queue()
+        return mailbox
+
+    def deliver(self, username, text=None, voice=None, video_note=None, sticker=None):
+        """Входящее сообщение пользователя: обработчики запускаются отдельными задачами, как у pyrogram."""
+        message = SimpleNamespace(
+            chat=SimpleNamespace(username=username, id=username),
+            text=text, voice=voice, video_note=video_note, sticker=sticker,
+        )
+        for handler in self.handlers:
+            task = asyncio.create_task(handler(self, message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _record(self, chat_id, kind, payload):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent += 1
+        self.mailbox(chat_id).put_nowait((time.monotonic(), kind, payload))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._record(chat_id, "message", text)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._record(chat_id, "document", document)
+
+    def drain(self, username):
+        """Сбрасывает ещё не прочитанные исходящие сообщения пользователя."""
+        mailbox = self.mailbox(username)
+        while not mailbox.empty():
+            mailbox.get_nowait()
+
+    async def wait_reply(self, username, timeout, after=None):
+        """Следующее текстовое сообщение пользователю: (время отправки, текст).
+
+        Сообщения, отправленные раньше after (например, хвост прошлого ответа по абзацам), пропускаются.
+        """
+        deadline = time.monotonic() + timeout
+        mailbox = self.mailbox(username)
+        while True:
+            sent_at, kind, payload = await asyncio.wait_for(mailbox.get(), max(0.0, deadline - time.monotonic()))
+            if kind == "message" and (after is None or sent_at >= after):
+                return sent_at, payload
@@ -0,0 +1,51 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+class LocalPostgres:
+    """Временный Postgres для стенда в отдельном каталоге, удаляется после остановки.
+
+    Используется пакет pgserver, если он установлен, иначе initdb и pg_ctl из PATH.
+    start() записывает параметры подключения в DB_* окружения — их читают скрипты рассылки.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or tempfile.mkdtemp(prefix="bench_pg_")
+        self._server = None
+        self._pg_ctl = None
+
+    def start(self):
+        try:
+            import pgserver
+        except ImportError:
+            pgserver = None
+
+        if pgserver is not None:
+            self._server = pgserver.get_server(self.directory, cleanup_mode="delete")
+        else:
+            initdb, self._pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+            if not initdb or not self._pg_ctl:
+                raise RuntimeError("Для временной базы нужен пакет pgserver или initdb/pg_ctl в PATH")
+            data = os.path.join(self.directory, "data")
+            subprocess.run([initdb, "-D", data, "-U", "postgres", "--auth=trust"], check=True,
+                           stdout=subprocess.DEVNULL)
+            # Только unix-сокет в каталоге базы: порт 5432 системного Postgres не занимается
+            subprocess.run([self._pg_ctl, "-D", data, "-w", "-l", os.path.join(self.directory, "postgres.log"),
+                            "-o", f"-k {self.directory} -c listen_addresses=''", "start"], check=True,
+                           stdout=subprocess.DEVNULL)
+
+        os.environ.update(DB_NAME="postgres", DB_USER="postgres", DB_PASSWORD="",
+                          DB_HOST=self.directory, DB_PORT="5432")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.cleanup()
+            self._server = None
+        elif self._pg_ctl is not None:
+            subprocess.run([self._pg_ctl, "-D", os.path.join(self.directory, "data"), "-m", "fast", "stop"],
+                           stdout=subprocess.DEVNULL)
+            self._pg_ctl = None
+        shutil.rmtree(self.directory, ignore_errors=True)
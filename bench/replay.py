@@ -0,0 +1,291 @@
+"""Прогон записанных диалогов из Logs/ через настоящий код скрипта на стенде.
+
+    python -m bench.replay --logs Logs --speedup 20 --concurrency 200 --repeat 10 --json replay.json
+
+Реплики пользователя из файлов диалогов подаются с паузами, как их набирал бы человек:
+сообщения подряд без ответа между ними — один ход, отправленный пачкой. Все паузы и окно
+склейки делятся на --speedup. Для каждого хода записывается задержка ответа и переходы
+состояния: промпт 1 → 2/3 после «Хорошо <3» и анализ квалификации после #спасибо.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.fake_openai import FakeOpenAI
+from bench.run_bench import percentile
+from bench.stand import Stand, bench_environment, load_script
+from common.transcripts import collapse_repeated_history, parse_transcript, read_transcript
+
+
+def user_turns(messages):
+    """Ходы пользователя: сообщения подряд до ответа ассистента склеиваются в один ход."""
+    turns = []
+    current = []
+    for role, content in messages:
+        if role == "user":
+            if content:
+                current.append(content)
+        elif current:
+            turns.append(current)
+            current = []
+    if current:
+        turns.append(current)
+    return turns
+
+
+def load_dialogs(directory, limit=None, max_turns=None):
+    """Диалоги из каталога: список (имя файла без .txt, ходы пользователя); пустые пропускаются."""
+    dialogs = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+        turns = user_turns(collapse_repeated_history(parse_transcript(read_transcript(path))))
+        if max_turns:
+            turns = turns[:max_turns]
+        if turns:
+            dialogs.append((os.path.basename(path)[:-len(".txt")], turns))
+        if limit and len(dialogs) >= limit:
+            break
+    return dialogs
+
+
+class Replayer:
+    """Подаёт ходы записанных диалогов на стенд и собирает задержки и переходы по ходам."""
+
+    def __init__(self, stand, args):
+        self.stand = stand
+        self.args = args
+        self.traces = []
+        # id(истории диалога) -> (история, результат анализа): по истории находится диалог, для которого
+        # script.analyze_qualification был вызван (имя пользователя в анализ не передаётся)
+        self._qualifications = {}
+
+    def install(self):
+        """Оборачивает анализ квалификации скрипта, чтобы видеть его запуски и результат."""
+        script = self.stand.script
+        analyze = script.analyze_qualification
+
+        async def recorded_analyze(dialogue, *args, **kwargs):
+            result = await analyze(dialogue, *args, **kwargs)
+            self._qualifications[id(dialogue)] = (dialogue, result)
+            return result
+
+        script.analyze_qualification = recorded_analyze
+
+    def pause(self, seconds):
+        return asyncio.sleep(seconds / self.args.speedup)
+
+    def typing_time(self, text):
+        return len(text) / self.args.typing_speed
+
+    async def wait_idle(self, username):
+        """Ждёт, пока обработка последнего хода (с анализом квалификации) закончится."""
+        key = ("reply", self.stand.campaign.index_name, username)
+        deadline = time.monotonic() + self.args.reply_timeout
+        while self.stand.script.timer_wheel.is_active(key) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def replay(self, source, copy, turns):
+        username = f"replay_{copy}_{source}"
+        client = self.stand.client_for(len(self.traces))
+        trace = {"source": source, "username": username, "turns": [], "prompt_switch": None, "qualification": None}
+        self.traces.append(trace)
+        dialogs = self.stand.campaign.dialogs
+
+        await asyncio.sleep(random.uniform(0, self.args.ramp))
+        prompt = 1
+        for number, messages in enumerate(turns, 1):
+            client.drain(username)
+            if number > 1:
+                await self.pause(random.uniform(0.5, 1.5) * self.args.think_time)
+            for text in messages:
+                await self.pause(self.typing_time(text))
+                client.deliver(username, text)
+                last_sent_at = time.monotonic()
+
+            turn = {"turn": number, "messages": len(messages), "chars": sum(len(text) for text in messages)}
+            trace["turns"].append(turn)
+            try:
+                replied_at, _ = await client.wait_reply(username, self.args.reply_timeout, after=last_sent_at)
+            except asyncio.TimeoutError:
+                turn["timeout"] = True
+                break
+
+            turn["latency"] = replied_at - last_sent_at
+            # Ответ по абзацам приходит несколькими сообщениями: ход смотрим целиком, когда он обработан
+            await self.wait_idle(username)
+            state = await dialogs.get(username)
+            last = state["messages"][-1] if state["messages"] else {}
+            turn["prompt_before"], turn["prompt_after"] = prompt, state["current_prompt"]
+            turn["thanks"] = last.get("role") == "assistant" and "#спасибо" in last["content"].lower()
+            if state["current_prompt"] != prompt and trace["prompt_switch"] is None:
+                trace["prompt_switch"] = {"turn": number, "to": state["current_prompt"]}
+            prompt = state["current_prompt"]
+
+        await self.wait_idle(username)
+        state = await dialogs.get(username)
+        analysis = self._qualifications.pop(id(state["messages"]), None)
+        if any(turn.get("thanks") for turn in trace["turns"]):
+            trace["qualification"] = {
+                "turn": next(turn["turn"] for turn in trace["turns"] if turn.get("thanks")),
+                "started": analysis is not None,
+                "result": analysis[1] if analysis else None,
+            }
+
+
+def build_report(args, dialogs, traces, elapsed, fake_openai):
+    turns = [turn for trace in traces for turn in trace["turns"]]
+    latencies = sorted(turn["latency"] for turn in turns if "latency" in turn)
+    processing = [max(0.0, latency - args.reply_delay) for latency in latencies]
+
+    by_turn = {}
+    for turn in turns:
+        if "latency" in turn:
+            by_turn.setdefault(turn["turn"], []).append(max(0.0, turn["latency"] - args.reply_delay))
+
+    switches = [trace["prompt_switch"] for trace in traces if trace["prompt_switch"]]
+    qualifications = [trace["qualification"] for trace in traces if trace["qualification"]]
+    return {
+        "transcripts": len(dialogs),
+        "dialogs": len(traces),
+        "speedup": args.speedup,
+        "reply_delay": args.reply_delay,
+        "elapsed_sec": round(elapsed, 2),
+        "user_turns": len(turns),
+        "user_messages": sum(turn["messages"] for turn in turns),
+        "replies": len(latencies),
+        "timeouts": sum(1 for turn in turns if turn.get("timeout")),
+        "replies_per_sec": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "reply_latency_p50": percentile(latencies, 50),
+        "reply_latency_p99": percentile(latencies, 99),
+        "processing_latency_p50": percentile(processing, 50),
+        "processing_latency_p99": percentile(processing, 99),
+        "processing_latency_by_turn": {
+            number: {"count": len(values), "p50": percentile(sorted(values), 50), "p99": percentile(sorted(values), 99)}
+            for number, values in sorted(by_turn.items())
+        },
+        "prompt_switches": {
+            "to_2": sum(1 for switch in switches if switch["to"] == 2),
+            "to_3": sum(1 for switch in switches if switch["to"] == 3),
+            "none": len(traces) - len(switches),
+        },
+        "qualification": {
+            "thanks": len(qualifications),
+            "analyzed": sum(1 for item in qualifications if item["started"]),
+            "succeeded": sum(1 for item in qualifications if item["result"]),
+        },
+        "llm_requests": fake_openai.requests,
+        "llm_injected_errors": fake_openai.errors,
+        "llm_malformed_analyses": fake_openai.malformed,
+        "traces": traces,
+    }
+
+
+async def run(args, dialogs):
+    fake_openai = FakeOpenAI(latency=args.llm_latency, jitter=args.llm_jitter, error_rate=args.llm_error_rate,
+                             trigger_turn=args.trigger_turn, thanks_turn=args.thanks_turn, seti_answer=args.seti_answer,
+                             malformed_rate=args.llm_malformed_rate)
+    stand = Stand(fake_openai, reply_delay=args.reply_delay, accounts=args.accounts, use_env_db=args.use_env_db)
+    await stand.start()
+    try:
+        replayer = Replayer(stand, args)
+        replayer.install()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(source, copy, turns):
+            async with semaphore:
+                await replayer.replay(source, copy, turns)
+
+        started = time.monotonic()
+        await asyncio.gather(*(
+            limited(source, copy, turns) for copy in range(args.repeat) for source, turns in dialogs
+        ))
+        elapsed = time.monotonic() - started
+    finally:
+        await stand.close()
+    return build_report(args, dialogs, replayer.traces, elapsed, fake_openai)
+
+
+def print_report(report):
+    def seconds(value):
+        return "—" if value is None else f"{value:.3f} с"
+
+    print(f"Файлов диалогов: {report['transcripts']}, прогнано диалогов: {report['dialogs']} "
+          f"(ускорение ×{report['speedup']}, окно склейки {report['reply_delay']:.2f} с), время: {report['elapsed_sec']} с")
+    print(f"Ходов пользователя: {report['user_turns']} ({report['user_messages']} сообщений), "
+          f"ответов: {report['replies']}, без ответа: {report['timeouts']}, ответов в секунду: {report['replies_per_sec']}")
+    print(f"Задержка ответа p50/p99: {seconds(report['reply_latency_p50'])} / {seconds(report['reply_latency_p99'])}")
+    print(f"Без окна склейки p50/p99: {seconds(report['processing_latency_p50'])} / "
+          f"{seconds(report['processing_latency_p99'])}")
+    for number, values in report["processing_latency_by_turn"].items():
+        print(f"  ход {number}: {values['count']} ответов, p50/p99 {seconds(values['p50'])} / {seconds(values['p99'])}")
+    switches = report["prompt_switches"]
+    print(f"Переход с промпта 1: на 2 — {switches['to_2']}, на 3 — {switches['to_3']}, без перехода — {switches['none']}")
+    qualification = report["qualification"]
+    print(f"#спасибо: {qualification['thanks']}, анализ квалификации запущен: {qualification['analyzed']}, "
+          f"с результатом: {qualification['succeeded']}")
+    print(f"Запросов к модели: {report['llm_requests']}, из них с ошибкой: {report['llm_injected_errors']}, "
+          f"анализов не по схеме: {report['llm_malformed_analyses']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Прогон записанных диалогов через скрипт рассылки на стенде")
+    parser.add_argument("--logs", default="Logs", help="Каталог с файлами диалогов")
+    parser.add_argument("--limit", type=int, help="Взять не больше стольких файлов")
+    parser.add_argument("--max-turns", type=int, help="Ходов пользователя из каждого диалога, не больше")
+    parser.add_argument("--repeat", type=int, default=1, help="Сколько раз прогнать каждый диалог (разными пользователями)")
+    parser.add_argument("--concurrency", type=int, default=100, help="Одновременных диалогов, не больше")
+    parser.add_argument("--speedup", type=float, default=10.0, help="Во сколько раз ускорить паузы и окно склейки")
+    parser.add_argument("--typing-speed", type=float, default=6.0, help="Скорость набора сообщения, символов в секунду")
+    parser.add_argument("--think-time", type=float, default=20.0, help="Средняя пауза перед следующим ходом, сек")
+    parser.add_argument("--ramp", type=float, default=5.0, help="За сколько секунд начинаются диалоги первой волны")
+    parser.add_argument("--reply-delay", type=float,
+                        help="Окно склейки сообщений, сек (по умолчанию REPLY_DELAY скрипта, делённое на --speedup)")
+    parser.add_argument("--reply-timeout", type=float, default=120.0, help="Сколько ждать ответа бота, сек")
+    parser.add_argument("--accounts", type=int, default=1, help="Аккаунтов Telegram")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Средняя задержка ответа модели, сек")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="Разброс задержки модели (доля)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--llm-malformed-rate", type=float, default=0.0,
+                        help="Доля ответов анализа не по схеме (проверка запроса на исправление)")
+    parser.add_argument("--trigger-turn", type=int, default=2, help="На каком ходу первый промпт отвечает «Хорошо <3»")
+    parser.add_argument("--thanks-turn", type=int, default=4, help="С какого хода второй и третий промпт ставят #спасибо")
+    parser.add_argument("--seti-answer", default="да", help="Ответ анализа соцсетей: да (промпт 2) или нет (промпт 3)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Потоковые ответы по абзацам (STREAM_REPLIES=1): задержка считается до первого абзаца")
+    parser.add_argument("--use-env-db", action="store_true",
+                        help="Использовать базу из DB_* вместо временной (в неё будут записаны диалоги кампании bench)")
+    parser.add_argument("--seed", type=int, help="Зерно случайных пауз, чтобы повторить прогон")
+    parser.add_argument("--json", help="Записать отчёт с ходами каждого диалога в JSON-файл")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.stream:
+        os.environ["STREAM_REPLIES"] = "1"
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.reply_delay is None:
+        bench_environment()
+        args.reply_delay = load_script().REPLY_DELAY / args.speedup
+
+    dialogs = load_dialogs(args.logs, args.limit, args.max_turns)
+    if not dialogs:
+        print(f"В каталоге {args.logs} нет диалогов с репликами пользователя")
+        return 1
+
+    report = asyncio.run(run(args, dialogs))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""Нагрузочный замер обработки ответов: тысячи одновременных диалогов через настоящий код скрипта.
+
+    python -m bench.run_bench --dialogs 2000 --turns 4 --llm-latency 0.5 --llm-error-rate 0.02
+
+Отчёт: сообщений в секунду, p50/p99 задержки ответа (от последнего сообщения
+пользователя до ответа и она же без окна склейки) и память на диалог.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.fake_openai import FakeOpenAI
+from bench.stand import Stand
+
+
+def rss_bytes():
+    """Текущий размер резидентной памяти процесса."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Не Linux: максимальный размер за время работы (на macOS в байтах, иначе в килобайтах)
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+class Result:
+    def __init__(self):
+        self.latencies = []
+        self.user_messages = 0
+        self.timeouts = 0
+
+
+async def run_dialog(stand, number, args, result):
+    """Один пользователь: turns ходов по burst сообщений, после каждого хода ждёт ответа бота."""
+    username = f"bench_user_{number}"
+    client = stand.client_for(number)
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    for turn in range(args.turns):
+        client.drain(username)
+        for part in range(args.burst):
+            if part:
+                await asyncio.sleep(args.burst_gap)
+            client.deliver(username, f"Ответ {turn + 1}.{part + 1}: да, веду соцсети сама, бюджет около 50 тысяч")
+            result.user_messages += 1
+            last_sent_at = time.monotonic()
+        try:
+            replied_at, _ = await client.wait_reply(username, args.reply_timeout, after=last_sent_at)
+        except asyncio.TimeoutError:
+            result.timeouts += 1
+            return
+        result.latencies.append(replied_at - last_sent_at)
+        await asyncio.sleep(random.uniform(0, args.think_time))
+
+
+async def run(args):
+    fake_openai = FakeOpenAI(latency=args.llm_latency, jitter=args.llm_jitter, error_rate=args.llm_error_rate,
+                             rate_limit_rate=args.llm_rate_limit_rate)
+    stand = Stand(fake_openai, reply_delay=args.reply_delay, accounts=args.accounts,
+                  send_latency=args.send_latency, use_env_db=args.use_env_db)
+    await stand.start()
+    try:
+        gc.collect()
+        rss_before = rss_bytes()
+        if args.tracemalloc:
+            tracemalloc.start()
+
+        result = Result()
+        started = time.monotonic()
+        await asyncio.gather(*(run_dialog(stand, number, args, result) for number in range(args.dialogs)))
+        elapsed = time.monotonic() - started
+
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0] if args.tracemalloc else None
+        rss_after = rss_bytes()
+        resident = len(stand.campaign.dialogs)
+    finally:
+        await stand.close()
+        if args.tracemalloc:
+            tracemalloc.stop()
+
+    latencies = sorted(result.latencies)
+    processing = [max(0.0, latency - args.reply_delay) for latency in latencies]
+    report = {
+        "dialogs": args.dialogs,
+        "turns": args.turns,
+        "elapsed_sec": round(elapsed, 2),
+        "user_messages": result.user_messages,
+        "replies": len(latencies),
+        "timeouts": result.timeouts,
+        "messages_per_sec": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "user_messages_per_sec": round(result.user_messages / elapsed, 2) if elapsed else None,
+        "reply_latency_p50": percentile(latencies, 50),
+        "reply_latency_p99": percentile(latencies, 99),
+        "processing_latency_p50": percentile(processing, 50),
+        "processing_latency_p99": percentile(processing, 99),
+        "resident_dialogs": resident,
+        "rss_per_dialog_bytes": round((rss_after - rss_before) / max(1, resident)),
+        "traced_per_dialog_bytes": round(traced / max(1, resident)) if traced is not None else None,
+        "llm_requests": fake_openai.requests,
+        "llm_injected_errors": fake_openai.errors,
+        "llm_concurrency": int(os.getenv("OPENAI_MAX_CONCURRENCY")),
+    }
+    return report
+
+
+def print_report(report):
+    def seconds(value):
+        return "—" if value is None else f"{value:.3f} с"
+
+    print(f"Диалогов: {report['dialogs']} по {report['turns']} ходов, время: {report['elapsed_sec']} с")
+    print(f"Сообщений пользователей: {report['user_messages']}, ответов: {report['replies']}, "
+          f"без ответа: {report['timeouts']}")
+    print(f"Ответов в секунду: {report['messages_per_sec']}, сообщений пользователей в секунду: "
+          f"{report['user_messages_per_sec']}")
+    print(f"Задержка ответа p50/p99: {seconds(report['reply_latency_p50'])} / {seconds(report['reply_latency_p99'])}")
+    print(f"Без окна склейки p50/p99: {seconds(report['processing_latency_p50'])} / "
+          f"{seconds(report['processing_latency_p99'])}")
+    print(f"Память на диалог (RSS): {report['rss_per_dialog_bytes']} байт"
+          + (f", по tracemalloc: {report['traced_per_dialog_bytes']} байт"
+             if report['traced_per_dialog_bytes'] is not None else ""))
+    print(f"Запросов к модели: {report['llm_requests']}, из них с ошибкой: {report['llm_injected_errors']}, "
+          f"параллельно не больше {report['llm_concurrency']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный замер обработки ответов с подставными Telegram и OpenAI")
+    parser.add_argument("--dialogs", type=int, default=1000, help="Число одновременных диалогов")
+    parser.add_argument("--turns", type=int, default=4, help="Ходов пользователя в каждом диалоге")
+    parser.add_argument("--burst", type=int, default=1, help="Сообщений пользователя в одном ходе")
+    parser.add_argument("--burst-gap", type=float, default=0.2, help="Пауза между сообщениями одного хода, сек")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Наибольшая пауза пользователя перед следующим ходом, сек")
+    parser.add_argument("--ramp", type=float, default=5.0, help="За сколько секунд начинаются все диалоги")
+    parser.add_argument("--reply-delay", type=float, default=1.0, help="Окно склейки сообщений перед ответом, сек")
+    parser.add_argument("--reply-timeout", type=float, default=120.0, help="Сколько ждать ответа бота, сек")
+    parser.add_argument("--accounts", type=int, default=1, help="Аккаунтов Telegram")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="Задержка отправки сообщения в Telegram, сек")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Средняя задержка ответа модели, сек")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="Разброс задержки модели (доля)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--llm-rate-limit-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--llm-concurrency", type=int, help="OPENAI_MAX_CONCURRENCY (по умолчанию 64)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Потоковые ответы по абзацам (STREAM_REPLIES=1): задержка считается до первого абзаца")
+    parser.add_argument("--use-env-db", action="store_true",
+                        help="Использовать базу из DB_* вместо временной (в неё будут записаны диалоги кампании bench)")
+    parser.add_argument("--tracemalloc", action="store_true", help="Дополнительно считать память через tracemalloc (медленнее)")
+    parser.add_argument("--json", help="Записать отчёт в JSON-файл")
+    parser.add_argument("--max-p99", type=float,
+                        help="Завершиться с ошибкой, если p99 без окна склейки больше этого значения, сек")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.stream:
+        os.environ["STREAM_REPLIES"] = "1"
+    if args.llm_concurrency:
+        os.environ["OPENAI_MAX_CONCURRENCY"] = str(args.llm_concurrency)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if args.max_p99 is not None and (report["processing_latency_p99"] is None
+                                     or report["processing_latency_p99"] > args.max_p99):
+        print(f"p99 без окна склейки превышает {args.max_p99} с")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import importlib.util
+import os
+import sys
+import tempfile
+
+from bench.fake_openai import FakeOpenAI
+from bench.fake_telegram import FakeClient
+from bench.local_postgres import LocalPostgres
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(ROOT, "script_version_2", "script.py")
+
+
+def bench_environment():
+    """Без лишнего вывода в консоль и без лимитов OpenAI, если они не заданы явно (до импорта скрипта)."""
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("OPENAI_RPM", "1000000")
+    os.environ.setdefault("OPENAI_TPM", "1000000000")
+    os.environ.setdefault("OPENAI_MAX_CONCURRENCY", "64")
+
+
+def load_script():
+    """Импортирует script_version_2/script.py как модуль (аргументы командной строки он разбирает только в __main__)."""
+    module = sys.modules.get("campaign_script")
+    if module is not None:
+        return module
+    spec = importlib.util.spec_from_file_location("campaign_script", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["campaign_script"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Stand:
+    """Скрипт рассылки script_version_2 с подставными Telegram и OpenAI и временной базой.
+
+    Работает настоящий код обработки: on_message → колесо таймеров → start_timer →
+    запрос к модели → send_message → запись статистики и состояния диалогов.
+    Меняются только клиент pyrogram (FakeClient), адрес API OpenAI (FakeOpenAI),
+    база (LocalPostgres или база из DB_* при use_env_db) и каталог файлов диалогов.
+    """
+
+    def __init__(self, fake_openai=None, reply_delay=1.0, accounts=1, send_latency=0.0, use_env_db=False,
+                 workdir=None):
+        self.fake_openai = fake_openai or FakeOpenAI()
+        self.reply_delay = reply_delay
+        self.account_count = accounts
+        self.send_latency = send_latency
+        self.use_env_db = use_env_db
+        self.workdir = workdir or tempfile.mkdtemp(prefix="bench_")
+        self.postgres = None
+        self.script = None
+        self.pool = None
+        self.campaign = None
+
+    async def start(self):
+        bench_environment()
+        if not self.use_env_db:
+            self.postgres = LocalPostgres(os.path.join(self.workdir, "postgres")).start()
+        await self.fake_openai.start()
+
+        script = self.script = load_script()
+        self.fake_openai.configure_openai()
+        script.Client = lambda name, *args, **kwargs: FakeClient(name, send_latency=self.send_latency)
+        script.transcripts = script.TranscriptWriter(os.path.join(self.workdir, "Logs"))
+        script.REPLY_DELAY = self.reply_delay
+
+        leads_file = os.path.join(self.workdir, "leads.csv")
+        with open(leads_file, "w", encoding="utf-8") as file:
+            file.write(f"{script.username_column},{script.name_column}\n")
+
+        await script.initialize_tables()
+        self.pool = await script.open_runtime()
+        self.campaign = script.Campaign({
+            "index_name": "bench",
+            "leads_file": leads_file,
+            "accounts": [f"bench_account_{number}" for number in range(self.account_count)],
+        }, self.pool)
+        await self.campaign.start()
+        return self
+
+    @property
+    def clients(self):
+        return self.campaign.clients
+
+    def client_for(self, number):
+        """Аккаунт, которому пишет пользователь с порядковым номером number."""
+        return self.clients[number % len(self.clients)]
+
+    async def close(self):
+        if self.script is not None and self.pool is not None:
+            await self.script.close_runtime(self.pool, [self.campaign] if self.campaign else [])
+            self.pool = None
+        await self.fake_openai.close()
+        if self.postgres is not None:
+            self.postgres.stop()
+            self.postgres = None
@@ -0,0 +1 @@
+# Общие модули, которые используют скрипты рассылки и бот статистики
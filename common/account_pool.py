@@ -0,0 +1,198 @@
+import logging
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from pyrogram.errors import FloodWait, PeerFlood
+
+from common.metrics import TELEGRAM_LIMITS
+
+
+def parse_active_hours(value):
+    """Разбирает окна активности вида "10:00-13:00,15-20" в список пар минут от начала суток."""
+    windows = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, end = part.split('-')
+        windows.append((_parse_minutes(start), _parse_minutes(end)))
+    return windows
+
+
+def _parse_minutes(value):
+    hours, _, minutes = value.strip().partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+def seconds_until_active(windows, moment):
+    """Через сколько секунд от moment (datetime) начнётся окно активности; 0 — уже внутри окна."""
+    if not windows:
+        return 0.0
+    minute = moment.hour * 60 + moment.minute + moment.second / 60
+    waits = []
+    for start, end in windows:
+        # Окно может переходить через полночь, например 22:00-02:00
+        inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+        if inside:
+            return 0.0
+        waits.append((start - minute) % (24 * 60))
+    return min(waits) * 60
+
+
+class Account:
+    """Аккаунт Telegram в пуле рассылки: клиент, бакет отправок, дневная квота и пауза после ограничений."""
+
+    def __init__(self, client, name, daily_quota, rate_per_hour, burst):
+        self.client = client
+        self.name = name
+        self.daily_quota = daily_quota
+        self.rate_per_hour = rate_per_hour
+        self.burst = burst
+        # Множитель скорости: уменьшается вдвое после FloodWait/PeerFlood и постепенно восстанавливается
+        self.rate_factor = 1.0
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.sent_today = 0
+        self.day = date.today()
+        self.next_send_at = 0.0
+        self.cooldown_until = 0.0
+
+    @property
+    def rate(self):
+        """Текущая скорость пополнения бакета, сообщений в секунду."""
+        return self.rate_per_hour * self.rate_factor / 3600
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def quota_left(self):
+        today = date.today()
+        if today != self.day:
+            self.day = today
+            self.sent_today = 0
+        return max(0, self.daily_quota - self.sent_today)
+
+    def ready_at(self):
+        """Момент (time.monotonic), когда в бакете будет токен и закончатся джиттер и пауза."""
+        self._refill()
+        token_at = self.updated_at + (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(token_at, self.next_send_at, self.cooldown_until)
+
+
+class AccountPool:
+    """Пул аккаунтов для первых сообщений с темпом отправки на каждый аккаунт.
+
+    У каждого аккаунта свой токен-бакет: SEND_RATE_PER_HOUR сообщений в час, всплеск
+    до SEND_BURST подряд, не больше ACCOUNT_DAILY_QUOTA в день. Первые сообщения уходят
+    только в окна SEND_ACTIVE_HOURS, к паузе между ними добавляется случайная доля
+    SEND_JITTER. После FloodWait аккаунт ждёт указанное Telegram время, после PeerFlood —
+    ACCOUNT_PEER_FLOOD_COOLDOWN; в обоих случаях его скорость снижается вдвое и затем
+    восстанавливается на SEND_RECOVERY_STEP с каждой успешной отправкой.
+
+    pick() выбирает готовый аккаунт с наименьшим числом отправок за день, поэтому
+    рассылка растёт пропорционально числу аккаунтов. Ответы в диалоге уходят с того
+    клиента, на который написал пользователь.
+    """
+
+    def __init__(self, daily_quota=None, rate_per_hour=None, burst=None, active_hours=None, jitter=None,
+                 recovery_step=None, peer_flood_cooldown=None):
+        # По умолчанию — осторожный темп прежних скриптов; поднимать его стоит по прогнозу в логе
+        self.daily_quota = daily_quota or int(os.getenv("ACCOUNT_DAILY_QUOTA", 2))
+        self.rate_per_hour = rate_per_hour or float(os.getenv("SEND_RATE_PER_HOUR", 3))
+        self.burst = burst or int(os.getenv("SEND_BURST", 1))
+        self.active_hours = parse_active_hours(active_hours or os.getenv("SEND_ACTIVE_HOURS", "11:00-20:00"))
+        self.jitter = jitter if jitter is not None else float(os.getenv("SEND_JITTER", 0.3))
+        self.recovery_step = recovery_step or float(os.getenv("SEND_RECOVERY_STEP", 0.05))
+        # PeerFlood не сообщает срок ограничения — аккаунт отдыхает фиксированное время
+        self.peer_flood_cooldown = peer_flood_cooldown or float(os.getenv("ACCOUNT_PEER_FLOOD_COOLDOWN", 86400))
+        self.accounts = []
+        self._by_client = {}
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def __iter__(self):
+        return iter(self.accounts)
+
+    def add(self, client, name):
+        account = Account(client, name, self.daily_quota, self.rate_per_hour, self.burst)
+        self.accounts.append(account)
+        self._by_client[id(client)] = account
+        return account
+
+    def for_client(self, client):
+        return self._by_client.get(id(client))
+
+    def pick(self):
+        """Аккаунт, готовый отправить первое сообщение прямо сейчас, или None."""
+        if seconds_until_active(self.active_hours, datetime.now()) > 0:
+            return None
+        now = time.monotonic()
+        ready = [account for account in self.accounts if account.quota_left() > 0 and account.ready_at() <= now]
+        if not ready:
+            return None
+        return min(ready, key=lambda account: (account.sent_today, account.ready_at()))
+
+    def seconds_until_available(self):
+        """Через сколько секунд какой-либо аккаунт сможет отправить следующее первое сообщение."""
+        now = datetime.now()
+        monotonic_now = time.monotonic()
+        waiting = [account.ready_at() - monotonic_now for account in self.accounts if account.quota_left() > 0]
+        if waiting:
+            wait = max(0.0, min(waiting))
+        else:
+            # Квоты всех аккаунтов исчерпаны — ждём их сброса в полночь
+            tomorrow = now.date() + timedelta(days=1)
+            wait = (datetime(tomorrow.year, tomorrow.month, tomorrow.day) - now).total_seconds()
+        return wait + seconds_until_active(self.active_hours, now + timedelta(seconds=wait))
+
+    def record_sent(self, account):
+        account._refill()
+        account.tokens -= 1
+        account.sent_today += 1
+        # Случайная добавка к паузе, чтобы отправки не шли по ровной сетке
+        account.next_send_at = time.monotonic() + random.uniform(0, self.jitter) / account.rate
+        account.rate_factor = min(1.0, account.rate_factor + self.recovery_step)
+
+    def report_error(self, client, error):
+        """Ставит аккаунт на паузу, если ошибка — ограничение Telegram; возвращает True для таких ошибок."""
+        account = self.for_client(client)
+        if isinstance(error, FloodWait):
+            pause = float(error.value or 0) * (1 + random.uniform(0, self.jitter))
+        elif isinstance(error, PeerFlood):
+            pause = self.peer_flood_cooldown
+        else:
+            return False
+        TELEGRAM_LIMITS.inc(account=account.name if account is not None else "unknown", error=type(error).__name__)
+        if account is not None:
+            account._refill()
+            account.cooldown_until = max(account.cooldown_until, time.monotonic() + pause)
+            account.rate_factor = max(0.1, account.rate_factor / 2)
+            account.tokens = min(account.tokens, 0.0)
+            logging.warning(f"Аккаунт {account.name} получил {type(error).__name__}, пауза {pause:.0f} сек, "
+                            f"скорость снижена до {account.rate * 3600:.1f} сообщений в час")
+            self.log_projection()
+        return True
+
+    def active_hours_per_day(self):
+        if not self.active_hours:
+            return 24.0
+        return sum(((end - start) % (24 * 60) or 24 * 60) for start, end in self.active_hours) / 60
+
+    def projected_rate(self):
+        """Прогноз темпа рассылки: (сообщений в час в активные часы, сообщений в день) по всем аккаунтам."""
+        per_hour = sum(account.rate * 3600 for account in self.accounts)
+        per_day = sum(
+            min(account.daily_quota, account.rate * 3600 * self.active_hours_per_day() + account.burst)
+            for account in self.accounts
+        )
+        return per_hour, per_day
+
+    def log_projection(self):
+        per_hour, per_day = self.projected_rate()
+        logging.info(f"Прогноз рассылки: {per_hour:.1f} сообщений в час, до {per_day:.0f} в день "
+                     f"по {len(self.accounts)} аккаунтам")
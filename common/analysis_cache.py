@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+
+# Создание таблицы постоянного кэша результатов анализа
+async def create_analysis_cache_table(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_cache (
+        key CHAR(64) PRIMARY KEY,
+        kind VARCHAR(50) NOT NULL,
+        prompt_version CHAR(16) NOT NULL,
+        result JSONB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Uncached:
+    """Результат compute(), который отдаётся вызывающим, но не кэшируется — например, неполный анализ."""
+
+    def __init__(self, result):
+        self.result = result
+
+
+class AnalysisCache:
+    """Кэш результатов анализа диалога по содержимому.
+
+    Ключ — вид анализа, версия промпта (хэш его текста) и хэш диалога, поэтому
+    повторный анализ того же диалога тем же промптом не стоит ни одного запроса
+    к модели. Первый уровень — LRU в памяти на ANALYSIS_CACHE_SIZE записей,
+    второй — таблица analysis_cache в Postgres, которая переживает перезапуски.
+    """
+
+    def __init__(self, pool=None, max_entries=None):
+        self.pool = pool
+        self.max_entries = max_entries or int(os.getenv("ANALYSIS_CACHE_SIZE", 2048))
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def attach(self, pool):
+        """Подключает постоянный уровень кэша (пул соединений с базой)."""
+        self.pool = pool
+
+    @staticmethod
+    def make_key(kind, prompt, dialogue):
+        prompt_version = _digest(prompt)[:16]
+        return hashlib.sha256(f"{kind}:{prompt_version}:{_digest(dialogue)}".encode('utf-8')).hexdigest(), prompt_version
+
+    def _remember(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _load(self, key):
+        if self.pool is None:
+            return None
+        try:
+            value = await self.pool.fetchval("SELECT result FROM analysis_cache WHERE key = $1;", key)
+        except Exception as e:
+            logging.warning(f"Не удалось прочитать кэш анализа из базы данных: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    async def _store(self, key, kind, prompt_version, result):
+        if self.pool is None:
+            return
+        try:
+            await self.pool.execute("""
+                INSERT INTO analysis_cache (key, kind, prompt_version, result)
+                VALUES ($1, $2, $3, $4::jsonb)
+                ON CONFLICT (key) DO NOTHING;
+            """, key, kind, prompt_version, json.dumps(result, ensure_ascii=False), retry=True)
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить кэш анализа в базу данных: {e}")
+
+    def peek(self, kind, prompt, dialogue):
+        """Возвращает результат из памяти без запроса к базе и модели или None."""
+        key, _ = self.make_key(kind, prompt, dialogue)
+        result = self._entries.get(key)
+        return dict(result) if result is not None else None
+
+    async def get_or_compute(self, kind, prompt, dialogue, compute):
+        """Возвращает закэшированный результат или вызывает compute() и запоминает его.
+
+        Одновременные запросы одного и того же анализа ждут один вызов compute().
+        Пустой результат (None или {}) и результат в Uncached не кэшируются, чтобы следующий
+        вызов попробовал снова.
+        """
+        key, prompt_version = self.make_key(kind, prompt, dialogue)
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(result)
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            result = await asyncio.shield(in_flight)
+            return dict(result) if result is not None else None
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await self._load(key)
+            if result is not None:
+                self.hits += 1
+                self._remember(key, result)
+            else:
+                self.misses += 1
+                result = await compute()
+                if isinstance(result, Uncached):
+                    result = result.result
+                elif result:
+                    await self._store(key, kind, prompt_version, result)
+                    self._remember(key, result)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            # Ошибку получат ожидающие, а не «висящий» future без обработчика
+            future.exception()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        return dict(result) if result is not None else None
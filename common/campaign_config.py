@@ -0,0 +1,34 @@
+import json
+import os
+
+
+def load_campaign_configs(path):
+    """Читает список кампаний из JSON-файла.
+
+    Каждая кампания — объект с обязательным index_name и необязательными leads_file,
+    username_column, name_column, accounts (список имён сессий), stream_replies, triggers и prompts. Промпты
+    задаются объектом прямо в кампании или путём к отдельному JSON-файлу (относительно
+    файла кампаний). Незаданные поля скрипт берёт из своих настроек по умолчанию.
+    """
+    with open(path, encoding='utf-8') as file:
+        configs = json.load(file)
+    if not isinstance(configs, list) or not configs:
+        raise ValueError(f"В {path} должен быть непустой список кампаний")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    index_names = set()
+    for config in configs:
+        index_name = config.get("index_name")
+        if not index_name:
+            raise ValueError(f"У кампании в {path} не указан index_name: {config}")
+        if index_name in index_names:
+            raise ValueError(f"index_name {index_name} указан в {path} несколько раз")
+        index_names.add(index_name)
+
+        prompts = config.get("prompts")
+        if isinstance(prompts, str):
+            with open(os.path.join(base_dir, prompts), encoding='utf-8') as file:
+                config["prompts"] = json.load(file)
+        if config.get("leads_file"):
+            config["leads_file"] = os.path.join(base_dir, config["leads_file"])
+    return configs
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+
+import asyncpg
+from asyncpg import exceptions
+
+# Ошибки, после которых соединение считается потерянным (например, Postgres перезапустился).
+# TimeoutError (подкласс OSError) сюда не входит: таймаут запроса или ожидания свободного
+# соединения — это медленная база или занятый пул, а не обрыв, и пересоздавать пул из-за него нельзя
+RECONNECT_ERRORS = (
+    exceptions.ConnectionDoesNotExistError,
+    exceptions.InterfaceError,
+    exceptions.CannotConnectNowError,
+    exceptions.AdminShutdownError,
+    ConnectionResetError,
+    ConnectionRefusedError,
+)
+# При создании пула повторяем и сетевые ошибки вроде недоступного хоста: запросов ещё не было
+CONNECT_ERRORS = RECONNECT_ERRORS + (OSError,)
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+class DbPool:
+    """Пул соединений asyncpg, общий для рассылки, обработчика сообщений, таймеров и напоминаний.
+
+    Методы execute/executemany/fetch/fetchrow/fetchval берут соединение из пула на время
+    одного запроса. Если соединение оборвалось, чтение повторяется, а запись — только
+    с retry=True: её можно повторить лишь тогда, когда повтор ничего не испортит
+    (upsert фиксированными значениями, ON CONFLICT DO NOTHING). Таймауты не повторяются.
+    Для транзакций соединение берётся явно через acquire().
+    """
+
+    def __init__(self, min_size=None, max_size=None, acquire_timeout=None, statement_cache_size=None,
+                 command_timeout=None, reconnect_attempts=None):
+        self.min_size = min_size if min_size is not None else _env_int("DB_POOL_MIN_SIZE", 2)
+        self.max_size = max_size if max_size is not None else _env_int("DB_POOL_MAX_SIZE", 10)
+        self.acquire_timeout = acquire_timeout if acquire_timeout is not None else _env_int("DB_ACQUIRE_TIMEOUT", 10)
+        self.statement_cache_size = (statement_cache_size if statement_cache_size is not None
+                                     else _env_int("DB_STATEMENT_CACHE_SIZE", 100))
+        self.command_timeout = command_timeout if command_timeout is not None else _env_int("DB_COMMAND_TIMEOUT", 30)
+        self.reconnect_attempts = (reconnect_attempts if reconnect_attempts is not None
+                                   else _env_int("DB_RECONNECT_ATTEMPTS", 5))
+        self._pool = None
+
+    async def open(self):
+        """Создаёт пул; если база ещё недоступна, повторяет попытки с нарастающей паузой."""
+        for attempt in range(self.reconnect_attempts + 1):
+            try:
+                self._pool = await asyncpg.create_pool(
+                    database=os.getenv("DB_NAME"),
+                    user=os.getenv("DB_USER"),
+                    password=os.getenv("DB_PASSWORD"),
+                    host=os.getenv("DB_HOST"),
+                    port=os.getenv("DB_PORT"),
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    statement_cache_size=self.statement_cache_size,
+                    command_timeout=self.command_timeout,
+                    max_inactive_connection_lifetime=300,
+                )
+                return self
+            except CONNECT_ERRORS as e:
+                if attempt == self.reconnect_attempts:
+                    raise
+                delay = min(2 ** attempt, 30)
+                logging.warning(f"Не удалось подключиться к базе данных: {e}. Повтор через {delay} сек")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def acquire(self):
+        """Соединение из пула для транзакций: async with pool.acquire() as conn: ..."""
+        return self._pool.acquire(timeout=self.acquire_timeout)
+
+    async def _run(self, method, retry, *args, **kwargs):
+        for attempt in range(self.reconnect_attempts + 1):
+            try:
+                async with self._pool.acquire(timeout=self.acquire_timeout) as conn:
+                    return await getattr(conn, method)(*args, **kwargs)
+            except RECONNECT_ERRORS as e:
+                # Запись, которую небезопасно повторять, могла успеть примениться до обрыва
+                if not retry or attempt == self.reconnect_attempts:
+                    raise
+                # Старые соединения после перезапуска Postgres уже мертвы — пул пересоздаст их
+                self._pool.expire_connections()
+                delay = min(0.5 * 2 ** attempt, 10)
+                logging.warning(f"Соединение с базой данных потеряно: {e}. Повтор через {delay} сек")
+                await asyncio.sleep(delay)
+
+    async def execute(self, query, *args, retry=False, **kwargs):
+        return await self._run("execute", retry, query, *args, **kwargs)
+
+    async def executemany(self, query, args, retry=False, **kwargs):
+        return await self._run("executemany", retry, query, args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._run("fetch", True, query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._run("fetchrow", True, query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._run("fetchval", True, query, *args, **kwargs)
+
+
+async def create_db_pool(**kwargs):
+    """Создаёт и открывает пул соединений с настройками из .env (DB_POOL_*, DB_*_TIMEOUT)."""
+    return await DbPool(**kwargs).open()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+
+from common.llm_client import get_llm_client, LLMError
+from common.tokens import count_tokens
+
+# Промпт для сворачивания старой части диалога в конспект
+SUMMARY_PROMPT = {
+    "role": "system",
+    "content": (
+        "Ты ведёшь краткий конспект переписки менеджера с клиентом. "
+        "Объедини прежний конспект и новые сообщения в один конспект не длиннее 10 предложений: "
+        "что клиент рассказал о себе, его ответы на вопросы менеджера, возражения, договорённости "
+        "и на каком шаге остановился диалог. Пиши по-русски, без вступлений."
+    )
+}
+
+
+class DialogContext:
+    """Контекст диалога для запроса к нейросети с ограничением по токенам.
+
+    В запрос уходят системный промпт, конспект старой части диалога и последние
+    реплики дословно. Старые реплики сворачиваются в конспект в фоне и пачками
+    по CONTEXT_SUMMARY_BATCH сообщений — между сворачиваниями начало запроса
+    не меняется, и на стороне провайдера срабатывает кэширование промпта.
+
+    Состояние хранится в словаре диалога: summary — конспект,
+    summarized_upto — сколько первых сообщений в него уже вошло.
+    """
+
+    def __init__(self, keep_turns=None, max_tokens=None, summary_batch=None):
+        self.keep_turns = keep_turns or int(os.getenv("CONTEXT_KEEP_TURNS", 12))
+        self.max_tokens = max_tokens or int(os.getenv("CONTEXT_MAX_TOKENS", 4000))
+        self.summary_batch = summary_batch or int(os.getenv("CONTEXT_SUMMARY_BATCH", 8))
+        self._tasks = {}
+
+    def history(self, state):
+        """Сообщения для запроса после системного промпта: конспект и последние реплики."""
+        recent = state["messages"][state.get("summarized_upto", 0):]
+
+        # Пока конспект не догнал диалог, самые старые реплики сверх бюджета не отправляем,
+        # но последние keep_turns сообщений уходят всегда
+        tokens = count_tokens(recent)
+        start = 0
+        while len(recent) - start > self.keep_turns and tokens > self.max_tokens:
+            tokens -= count_tokens(recent[start:start + 1])
+            start += 1
+        recent = recent[start:]
+
+        if state.get("summary"):
+            return [{"role": "system", "content": "Краткое содержание начала диалога:\n" + state["summary"]}] + recent
+        return recent
+
+    def schedule_summary(self, key, state, on_update=None):
+        """Запускает фоновое сворачивание старых реплик в конспект, если их накопилось достаточно.
+
+        on_update вызывается после того, как конспект обновлён (например, чтобы сохранить состояние).
+        """
+        start = state.get("summarized_upto", 0)
+        end = len(state["messages"]) - self.keep_turns
+        if end - start < self.summary_batch:
+            return
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            return
+        self._tasks[key] = asyncio.create_task(self._summarize(key, state, start, end, on_update))
+
+    async def _summarize(self, key, state, start, end, on_update):
+        chunk = state["messages"][start:end]
+        dialogue = "\n\n".join(
+            f"{'Клиент' if message['role'] == 'user' else 'Менеджер'}: {message['content']}" for message in chunk
+        )
+        request = [
+            SUMMARY_PROMPT,
+            {
+                "role": "user",
+                "content": f"Прежний конспект:\n{state.get('summary') or 'нет'}\n\nНовые сообщения:\n{dialogue}"
+            }
+        ]
+        try:
+            summary = await get_llm_client().complete(request, temperature=0.3, max_tokens=400, label="summary")
+        except LLMError as e:
+            logging.warning(f"Не удалось свернуть диалог {key} в конспект: {e}")
+            return
+        finally:
+            self._tasks.pop(key, None)
+
+        # Конспект применяем, только если за время запроса его не обновили другим путём
+        if state.get("summarized_upto", 0) == start:
+            state["summary"] = summary.strip()
+            state["summarized_upto"] = end
+            if on_update is not None:
+                on_update(key, state)
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from common.metrics import DB_WRITE_LATENCY, OPEN_DIALOGS
+
+
+# Создание таблицы состояния диалогов
+async def create_dialog_state_table(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS dialog_state (
+        campaign VARCHAR(255) NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        state JSONB NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (campaign, username)
+    );
+    """)
+
+
+def new_dialog_state():
+    """Состояние нового диалога: история, буфер ещё не отвеченных сообщений, этап промпта и статистика."""
+    return {
+        "messages": [],
+        "pending": [],
+        "use_alternate_prompt": False,
+        "in_secondary_prompt": False,
+        "current_prompt": 1,  # Начинаем с первого промпта
+        "summary": None,
+        "summarized_upto": 0,
+        "transcript_written": 0,  # Сколько сообщений уже дописано в файл диалога
+        "stats": {
+            "user_replied": False,
+            "message_count": 0,
+            "sensitive_info_sent": False,
+            "initial_message_sent": False,
+            "reminder_sent": False
+        }
+    }
+
+
+# Записывается снимок состояния целиком, поэтому после обрыва соединения запись можно повторить
+_UPSERT_SQL = """
+    INSERT INTO dialog_state (campaign, username, state, updated_at)
+    VALUES ($1, $2, $3::jsonb, CURRENT_TIMESTAMP)
+    ON CONFLICT (campaign, username)
+    DO UPDATE SET state = EXCLUDED.state, updated_at = CURRENT_TIMESTAMP;
+"""
+
+
+class DialogStore:
+    """Состояние диалогов кампании в Postgres с подгрузкой по требованию.
+
+    В памяти держатся только недавние диалоги: get() подгружает состояние из таблицы
+    dialog_state, когда пользователь пишет снова. Диалог без активности дольше
+    DIALOG_IDLE_TTL секунд выгружается, а при превышении DIALOG_MAX_RESIDENT
+    выгружаются самые давние. Изменённые состояния (mark_dirty) записываются
+    раз в DIALOG_FLUSH_INTERVAL секунд и перед выгрузкой; save() пишет сразу.
+
+    is_busy(username) сообщает, что диалог сейчас обрабатывается, — такие не выгружаются.
+    """
+
+    def __init__(self, pool, campaign, idle_ttl=None, max_resident=None, flush_interval=None, is_busy=None):
+        self.pool = pool
+        self.campaign = campaign
+        self.idle_ttl = idle_ttl or float(os.getenv("DIALOG_IDLE_TTL", 3600))
+        self.max_resident = max_resident or int(os.getenv("DIALOG_MAX_RESIDENT", 5000))
+        self.flush_interval = flush_interval or float(os.getenv("DIALOG_FLUSH_INTERVAL", 5))
+        self.is_busy = is_busy or (lambda username: False)
+        # username -> (состояние, время последнего обращения); порядок — от давних к недавним
+        self._resident = OrderedDict()
+        self._dirty = set()
+        self._loading = {}
+        self._task = None
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._gauge = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._gauge = OPEN_DIALOGS.track(lambda: len(self._resident), campaign=self.campaign)
+        return self
+
+    def __len__(self):
+        return len(self._resident)
+
+    def __contains__(self, username):
+        return username in self._resident
+
+    def _touch(self, username, state):
+        self._resident[username] = (state, time.monotonic())
+        self._resident.move_to_end(username)
+
+    async def get(self, username, create=True):
+        """Состояние диалога: из памяти, из базы или новое (если create=True, иначе None)."""
+        entry = self._resident.get(username)
+        if entry is not None:
+            self._touch(username, entry[0])
+            return entry[0]
+
+        # Одновременные сообщения одного пользователя ждут одну загрузку, а не создают две копии
+        loading = self._loading.get(username)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(username))
+            self._loading[username] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(username, None))
+        state = await asyncio.shield(loading)
+
+        if state is None:
+            if not create:
+                return None
+            state = new_dialog_state()
+            self._dirty.add(username)
+        entry = self._resident.get(username)
+        if entry is not None:
+            # Пока ждали загрузку, состояние уже появилось в памяти — используем его
+            state = entry[0]
+        self._touch(username, state)
+        if len(self._resident) > self.max_resident:
+            self._wakeup.set()
+        return state
+
+    async def _load(self, username):
+        value = await self.pool.fetchval(
+            "SELECT state FROM dialog_state WHERE campaign = $1 AND username = $2;", self.campaign, username
+        )
+        if value is None:
+            return None
+        state = new_dialog_state()
+        state.update(json.loads(value))
+        return state
+
+    def mark_dirty(self, username):
+        """Отмечает, что состояние изменилось и должно быть записано при следующем сбросе."""
+        if username in self._resident:
+            self._dirty.add(username)
+
+    async def save(self, username):
+        """Сразу записывает состояние диалога в базу."""
+        entry = self._resident.get(username)
+        if entry is None:
+            return
+        self._dirty.discard(username)
+        try:
+            with DB_WRITE_LATENCY.time(table="dialog_state"):
+                await self.pool.execute(_UPSERT_SQL, self.campaign, username, json.dumps(entry[0], ensure_ascii=False),
+                                        retry=True)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении состояния диалога {username}: {e}")
+            self._dirty.add(username)
+
+    async def flush(self):
+        """Записывает все изменённые состояния одной пачкой."""
+        if not self._dirty:
+            return
+        usernames, self._dirty = [u for u in self._dirty if u in self._resident], set()
+        records = [
+            (self.campaign, username, json.dumps(self._resident[username][0], ensure_ascii=False))
+            for username in usernames
+        ]
+        try:
+            with DB_WRITE_LATENCY.time(table="dialog_state"):
+                await self.pool.executemany(_UPSERT_SQL, records, retry=True)
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении состояния диалогов: {e}")
+            self._dirty.update(usernames)
+
+    async def _evict(self):
+        now = time.monotonic()
+        evicted = []
+        overflow = len(self._resident) - self.max_resident
+        # Обход от самых давних: сначала выгружаем простаивающие, затем лишние сверх лимита
+        for username, (state, touched_at) in list(self._resident.items()):
+            if now - touched_at < self.idle_ttl and overflow <= 0:
+                break
+            if self.is_busy(username):
+                continue
+            evicted.append(username)
+            overflow -= 1
+        if not evicted:
+            return
+
+        dirty = [username for username in evicted if username in self._dirty]
+        if dirty:
+            records = [
+                (self.campaign, username, json.dumps(self._resident[username][0], ensure_ascii=False))
+                for username in dirty
+            ]
+            try:
+                with DB_WRITE_LATENCY.time(table="dialog_state"):
+                    await self.pool.executemany(_UPSERT_SQL, records, retry=True)
+            except Exception as e:
+                logging.error(f"Ошибка при сохранении выгружаемых диалогов: {e}")
+                return
+            self._dirty.difference_update(dirty)
+
+        for username in evicted:
+            entry = self._resident.get(username)
+            # За время записи к диалогу могли обратиться снова — тогда оставляем его в памяти
+            if entry is not None and entry[1] <= now and username not in self._dirty:
+                del self._resident[username]
+        logging.info(f"Выгружено из памяти диалогов: {len(evicted)}, в памяти осталось: {len(self._resident)}")
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                await self._evict()
+            except Exception as e:
+                logging.error(f"Ошибка фонового сохранения диалогов: {e}")
+
+    async def close(self):
+        """Останавливает фоновую задачу и записывает все изменённые состояния."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        OPEN_DIALOGS.untrack(self._gauge)
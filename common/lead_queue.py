@@ -0,0 +1,99 @@
+import logging
+import os
+import socket
+from contextlib import asynccontextmanager
+
+# Идентификатор процесса, который забрал лид (для диагностики)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Версия файла лидов, которая уже импортирована в очередь: campaign -> mtime
+_imported_versions = {}
+
+
+# Создание таблицы общей очереди лидов
+async def create_leads_table(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS leads (
+        id BIGSERIAL PRIMARY KEY,
+        campaign VARCHAR(255) NOT NULL,
+        position INT NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        name VARCHAR(255),
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        claimed_by VARCHAR(255),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        processed_at TIMESTAMP,
+        UNIQUE (campaign, username)
+    );
+    """)
+    await conn.execute("""
+    CREATE INDEX IF NOT EXISTS leads_pending_idx ON leads (campaign, position) WHERE status = 'pending';
+    """)
+
+
+async def import_leads(conn, campaign, lead_source, sent_before=0):
+    """Загружает лиды из файла в очередь кампании, уже известные юзернеймы пропускаются.
+
+    Лиды с позицией меньше sent_before сразу помечаются как отправленные — так очередь
+    продолжает работу с места, на котором остановился старый курсор processing_index.
+    """
+    version = lead_source.version
+    if _imported_versions.get(campaign) == version:
+        return 0
+    rows = lead_source.rows()
+
+    records = [(position, username, name) for position, (username, name) in enumerate(rows)]
+    async with conn.transaction():
+        await conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS leads_import (
+                position INT,
+                username VARCHAR(255),
+                name VARCHAR(255)
+            ) ON COMMIT DELETE ROWS;
+        """)
+        await conn.copy_records_to_table('leads_import', records=records)
+        result = await conn.execute("""
+            INSERT INTO leads (campaign, position, username, name, status)
+            SELECT DISTINCT ON (username) $1, position, username, name,
+                   CASE WHEN position < $2 THEN 'sent' ELSE 'pending' END
+            FROM leads_import
+            ORDER BY username, position
+            ON CONFLICT (campaign, username) DO NOTHING;
+        """, campaign, sent_before)
+
+    _imported_versions[campaign] = version
+    inserted = int(result.split()[-1])
+    logging.info(f"В очередь {campaign} добавлено {inserted} новых лидов")
+    return inserted
+
+
+@asynccontextmanager
+async def claim_lead(conn, campaign):
+    """Забирает следующий свободный лид кампании и держит его заблокированным до конца блока.
+
+    Выборка, отправка и смена статуса выполняются в одной транзакции: параллельные
+    экземпляры пропускают заблокированные строки (SKIP LOCKED), а если процесс упадёт
+    до конца блока, транзакция откатится и лид снова окажется в очереди.
+    Внутри блока можно выставить lead['status'] ('sent', 'failed', 'skipped'), по умолчанию 'sent'.
+    """
+    async with conn.transaction():
+        row = await conn.fetchrow("""
+            SELECT id, username, name FROM leads
+            WHERE campaign = $1 AND status = 'pending'
+            ORDER BY position
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED;
+        """, campaign)
+        if row is None:
+            yield None
+            return
+
+        lead = dict(row)
+        lead['status'] = 'sent'
+        yield lead
+
+        await conn.execute("""
+            UPDATE leads
+            SET status = $2, claimed_by = $3, processed_at = CURRENT_TIMESTAMP
+            WHERE id = $1;
+        """, lead['id'], lead['status'], WORKER_ID)
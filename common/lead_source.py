@@ -0,0 +1,110 @@
+import csv
+import logging
+import os
+import threading
+
+# Кэш открытых источников лидов: (путь, столбец юзернеймов, столбец имён) -> LeadSource
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+def _clean(value):
+    """Приводит значение ячейки к строке, пустые ячейки и NaN превращает в None."""
+    if value is None:
+        return None
+    if isinstance(value, float) and value != value:  # NaN из pandas
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+class LeadSource:
+    """Таблица лидов (Excel или CSV), которая читается один раз и перечитывается только при изменении файла."""
+
+    def __init__(self, path, username_column, name_column):
+        self.path = path
+        self.username_column = username_column
+        self.name_column = name_column
+        self._usernames = []
+        self._names = []
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _read_csv(self):
+        usernames, names = [], []
+        with open(self.path, newline='', encoding='utf-8-sig') as file:
+            reader = csv.reader(file)
+            header = next(reader, [])
+            try:
+                username_pos = header.index(self.username_column)
+                name_pos = header.index(self.name_column)
+            except ValueError:
+                raise KeyError(f"В файле {self.path} нет столбцов {self.username_column}/{self.name_column}")
+            for row in reader:
+                username = _clean(row[username_pos]) if username_pos < len(row) else None
+                if username is None:
+                    continue
+                usernames.append(username)
+                names.append(_clean(row[name_pos]) if name_pos < len(row) else None)
+        return usernames, names
+
+    def _read_excel(self):
+        # pandas нужен только для Excel, CSV читается без него
+        import pandas as pd
+
+        df = pd.read_excel(self.path, usecols=[self.username_column, self.name_column], dtype=object)
+        usernames, names = [], []
+        for username, name in zip(df[self.username_column].tolist(), df[self.name_column].tolist()):
+            username = _clean(username)
+            if username is None:
+                continue
+            usernames.append(username)
+            names.append(_clean(name))
+        return usernames, names
+
+    def _reload_if_changed(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        if os.path.splitext(self.path)[1].lower() == '.csv':
+            usernames, names = self._read_csv()
+        else:
+            usernames, names = self._read_excel()
+        self._usernames, self._names, self._mtime = usernames, names, mtime
+        logging.info(f"Загружено {len(usernames)} лидов из {self.path}")
+
+    @property
+    def version(self):
+        """mtime загруженной версии файла — меняется, когда файл перечитан."""
+        with self._lock:
+            self._reload_if_changed()
+            return self._mtime
+
+    def __len__(self):
+        with self._lock:
+            self._reload_if_changed()
+            return len(self._usernames)
+
+    def get(self, position):
+        """Возвращает (username, имя) по позиции курсора или (None, None), если лиды закончились."""
+        with self._lock:
+            self._reload_if_changed()
+            if position < 0 or position >= len(self._usernames):
+                return None, None
+            return self._usernames[position], self._names[position]
+
+    def rows(self, start=0):
+        """Возвращает снимок пар (username, имя), начиная с позиции start."""
+        with self._lock:
+            self._reload_if_changed()
+            return list(zip(self._usernames[start:], self._names[start:]))
+
+
+def get_lead_source(path, username_column, name_column):
+    """Возвращает общий для процесса LeadSource для файла и пары столбцов."""
+    key = (os.path.abspath(path), username_column, name_column)
+    with _sources_lock:
+        source = _sources.get(key)
+        if source is None:
+            source = _sources[key] = LeadSource(path, username_column, name_column)
+        return source
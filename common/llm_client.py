@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+
+import aiohttp
+import openai
+
+from common.tokens import count_tokens
+from common.metrics import LLM_LATENCY, LLM_FIRST_TOKEN, LLM_ATTEMPTS, LLM_ERRORS
+
+# Ошибки, при которых повтор не поможет
+FATAL_ERRORS = (
+    openai.error.InvalidRequestError,
+    openai.error.AuthenticationError,
+    openai.error.PermissionError,
+)
+
+
+class LLMError(Exception):
+    """Не удалось получить ответ от модели (исчерпаны попытки или запрос некорректен)."""
+
+
+class TokenBucket:
+    """Токен-бакет: capacity единиц в минуту, пополняется равномерно.
+
+    Ожидающие обслуживаются по очереди, поэтому всплеск запросов растягивается
+    во времени, а не упирается в лимит API.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount):
+        # Запрос больше ёмкости бакета ждёт полного бакета, иначе он не прошёл бы никогда
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount):
+        """Корректирует бакет на разницу между оценкой и фактическим расходом (может уйти в минус)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class LLMClient:
+    """Общий для процесса клиент OpenAI.
+
+    Держит одну aiohttp-сессию с keep-alive, ограничивает число одновременных запросов,
+    расходует RPM/TPM-бакеты перед каждым запросом и повторяет неудачные запросы
+    с экспоненциальной паузой и джиттером, учитывая Retry-After.
+    """
+
+    def __init__(self, model=None, rpm=None, tpm=None, max_concurrency=None, backoff_base=None,
+                 backoff_max=None, request_timeout=None):
+        self.model = model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+        self.requests = TokenBucket(rpm or int(os.getenv("OPENAI_RPM", 500)))
+        self.tokens = TokenBucket(tpm or int(os.getenv("OPENAI_TPM", 200000)))
+        self.max_concurrency = max_concurrency or int(os.getenv("OPENAI_MAX_CONCURRENCY", 8))
+        self.backoff_base = backoff_base or float(os.getenv("OPENAI_BACKOFF_BASE", 1))
+        self.backoff_max = backoff_max or float(os.getenv("OPENAI_BACKOFF_MAX", 60))
+        self.request_timeout = request_timeout or float(os.getenv("OPENAI_REQUEST_TIMEOUT", 60))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = None
+        # После 429 с Retry-After ждут все запросы процесса, а не только получивший ошибку
+        self._paused_until = 0.0
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _retry_delay(self, attempt, error):
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after-ms")
+        if retry_after is not None:
+            return float(retry_after) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        # Экспоненциальная пауза с «полным» джиттером
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _wait_for_capacity(self, estimated_tokens):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    async def _handle_error(self, error, attempt, max_retries, label):
+        """Учитывает неудачную попытку: некорректный запрос — LLMError, иначе пауза перед повтором."""
+        LLM_ERRORS.inc(prompt=label, error=type(error).__name__)
+        if isinstance(error, FATAL_ERRORS):
+            raise LLMError(f"Некорректный запрос к OpenAI API: {error}") from error
+        # Лимиты, обрывы соединения, таймауты и ошибки сервера повторяем
+        delay = self._retry_delay(attempt, error)
+        if isinstance(error, openai.error.RateLimitError):
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        if attempt + 1 < max_retries:
+            logging.warning(f"Ошибка запроса к OpenAI API (попытка {attempt + 1}/{max_retries}): {error}. "
+                            f"Повтор через {delay:.1f} сек")
+            await asyncio.sleep(delay)
+        else:
+            # Повтора не будет: вызывающий получит LLMError
+            logging.warning(f"Ошибка запроса к OpenAI API (попытка {attempt + 1}/{max_retries}): {error}. "
+                            f"Попытки исчерпаны")
+
+    async def create(self, messages, max_retries=3, label="other", **params):
+        """Отправляет запрос ChatCompletion и возвращает ответ API целиком.
+
+        label — имя промпта в метриках: время запроса, число попыток и ошибки.
+        """
+        params.setdefault("model", self.model)
+        estimated_tokens = count_tokens(messages) + params.get("max_tokens", 500)
+
+        started = time.monotonic()
+        attempts = 0
+        last_error = None
+        try:
+            for attempt in range(max_retries):
+                attempts = attempt + 1
+                await self._wait_for_capacity(estimated_tokens)
+                try:
+                    async with self._semaphore:
+                        openai.aiosession.set(self._get_session())
+                        response = await openai.ChatCompletion.acreate(
+                            messages=messages,
+                            request_timeout=self.request_timeout,
+                            **params
+                        )
+                except Exception as e:
+                    last_error = e
+                    await self._handle_error(e, attempt, max_retries, label)
+                    continue
+
+                usage = response.get("usage") or {}
+                if usage.get("total_tokens"):
+                    self.tokens.adjust(usage["total_tokens"] - estimated_tokens)
+                return response
+        finally:
+            LLM_LATENCY.observe(time.monotonic() - started, prompt=label)
+            if attempts:
+                LLM_ATTEMPTS.observe(attempts, prompt=label)
+
+        raise LLMError(f"Не удалось получить ответ после {max_retries} попыток: {last_error}")
+
+    async def complete(self, messages, max_retries=3, label="other", **params):
+        """Отправляет запрос и возвращает текст ответа модели."""
+        response = await self.create(messages, max_retries=max_retries, label=label, **params)
+        return response["choices"][0]["message"]["content"]
+
+    async def stream(self, messages, max_retries=3, label="other", **params):
+        """Потоковый запрос ChatCompletion: отдаёт текст ответа кусками по мере генерации.
+
+        Повторяется только попытка, по которой ещё ничего не пришло; если ответ оборвался
+        на середине, отданные куски не отзываются — поднимается LLMError. Место в лимите
+        одновременных запросов занято, пока ответ не дочитан или генератор не закрыт.
+        """
+        params.setdefault("model", self.model)
+        estimated_tokens = count_tokens(messages) + params.get("max_tokens", 500)
+
+        started = time.monotonic()
+        attempts = 0
+        last_error = None
+        try:
+            for attempt in range(max_retries):
+                attempts = attempt + 1
+                await self._wait_for_capacity(estimated_tokens)
+                parts = []
+                try:
+                    async with self._semaphore:
+                        openai.aiosession.set(self._get_session())
+                        response = await openai.ChatCompletion.acreate(
+                            messages=messages,
+                            request_timeout=self.request_timeout,
+                            stream=True,
+                            **params
+                        )
+                        try:
+                            async for chunk in response:
+                                delta = chunk["choices"][0].get("delta", {}).get("content")
+                                if not delta:
+                                    continue
+                                if not parts:
+                                    LLM_FIRST_TOKEN.observe(time.monotonic() - started, prompt=label)
+                                parts.append(delta)
+                                yield delta
+                        finally:
+                            await response.aclose()
+                except Exception as e:
+                    if parts:
+                        LLM_ERRORS.inc(prompt=label, error=type(e).__name__)
+                        raise LLMError(f"Ответ модели оборвался: {e}") from e
+                    last_error = e
+                    await self._handle_error(e, attempt, max_retries, label)
+                    continue
+
+                # В потоковом ответе нет usage — расход считаем по тексту ответа
+                answer = {"role": "assistant", "content": "".join(parts)}
+                self.tokens.adjust(count_tokens(messages + [answer]) - estimated_tokens)
+                return
+        finally:
+            LLM_LATENCY.observe(time.monotonic() - started, prompt=label)
+            if attempts:
+                LLM_ATTEMPTS.observe(attempts, prompt=label)
+
+        raise LLMError(f"Не удалось получить ответ после {max_retries} попыток: {last_error}")
+
+
+async def paragraphs(chunks):
+    """Собирает куски потокового ответа в абзацы (разделитель — пустая строка) и отдаёт каждый, как только он закончен."""
+    buffer = ""
+    try:
+        async for chunk in chunks:
+            buffer += chunk
+            *ready, buffer = re.split(r"\n\s*\n", buffer)
+            for paragraph in ready:
+                if paragraph.strip():
+                    yield paragraph.strip()
+        if buffer.strip():
+            yield buffer.strip()
+    finally:
+        # Если абзацы дочитали не до конца, запрос закрывается сразу и освобождает место в лимите
+        await chunks.aclose()
+
+
+_client = None
+
+
+def get_llm_client():
+    """Возвращает общий для процесса LLMClient (создаётся при первом обращении)."""
+    global _client
+    if _client is None:
+        _client = LLMClient()
+    return _client
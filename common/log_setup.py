@@ -0,0 +1,160 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Диалог, к которому относится текущая задача: "кампания/username" или "-"
+_dialog = contextvars.ContextVar("log_dialog", default="-")
+
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] [%(dialog)s] %(message)s'
+
+
+def set_log_dialog(campaign, username=None):
+    """Помечает записи лога текущей задачи (и порождённых ею задач) идентификатором диалога.
+
+    Без username записи помечаются только кампанией.
+    """
+    _dialog.set(f"{campaign}/{username}" if username is not None else str(campaign))
+
+
+class DialogFilter(logging.Filter):
+    """Добавляет в запись поле dialog; работает в потоке, который пишет в лог, где виден contextvar."""
+
+    def filter(self, record):
+        record.dialog = _dialog.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень, логгер, диалог, сообщение."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "dialog": getattr(record, "dialog", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler, который в вызывающем потоке только подставляет аргументы в сообщение.
+
+    Стандартный prepare() целиком форматирует запись (время, формат) в потоке
+    цикла событий; здесь это делает поток QueueListener.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Трейсбек нельзя передать в другой поток как объект — сохраняем текстом
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def setup_logging(log_file=None, level=None, fmt=None):
+    """Настраивает корневой логгер: записи уходят в очередь, в файл и консоль их пишет отдельный поток.
+
+    Уровень — LOG_LEVEL (по умолчанию INFO), формат — LOG_FORMAT: text или json.
+    Файл log_file ротируется по LOG_FILE_MAX_BYTES, хранится LOG_FILE_BACKUP_COUNT старых файлов.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    fmt = fmt or os.getenv("LOG_FORMAT", "text")
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(RotatingFileHandler(
+            log_file, maxBytes=int(os.getenv("LOG_FILE_MAX_BYTES", 10 * 1024 * 1024)),
+            backupCount=int(os.getenv("LOG_FILE_BACKUP_COUNT", 5)), encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(DialogFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # Остаток очереди дописывается при выходе из процесса
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает записи из очереди и останавливает поток логирования."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class PayloadLogger:
+    """Отладочный вывод больших данных (промпты, ответы модели) с ограничением частоты.
+
+    Пишется только при уровне DEBUG, не чаще LOG_PAYLOAD_PER_MINUTE записей в минуту
+    и не длиннее LOG_PAYLOAD_MAX_CHARS символов. Данные превращаются в строку, только
+    если запись действительно будет выведена; пропущенные записи подсчитываются.
+    """
+
+    def __init__(self, per_minute=None, max_chars=None, logger=None):
+        self.per_minute = per_minute or int(os.getenv("LOG_PAYLOAD_PER_MINUTE", 30))
+        self.max_chars = max_chars or int(os.getenv("LOG_PAYLOAD_MAX_CHARS", 2000))
+        self.logger = logger or logging.getLogger()
+        self.tokens = float(self.per_minute)
+        self.updated_at = time.monotonic()
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def _allow(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.per_minute, self.tokens + (now - self.updated_at) * self.per_minute / 60)
+            self.updated_at = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return 0
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed + 1
+
+    def __call__(self, label, payload):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        allowed = self._allow()
+        if not allowed:
+            return
+        text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False, default=str)
+        if len(text) > self.max_chars:
+            text = text[:self.max_chars] + f"... (ещё {len(text) - self.max_chars} символов)"
+        skipped = f" (пропущено записей: {allowed - 1})" if allowed > 1 else ""
+        self.logger.debug(f"{label}{skipped}: {text}")
+
+
+# Общий ограничитель отладочного вывода процесса
+log_payload = PayloadLogger()
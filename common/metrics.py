@@ -0,0 +1,281 @@
+import asyncio
+import bisect
+import logging
+import os
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import aiohttp
+from aiohttp import web
+
+# Границы корзин по умолчанию (секунды): от быстрых запросов к базе до долгих ответов модели
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Метрика с набором меток; значения хранятся по кортежу значений меток."""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _label_pairs(self, key):
+        return tuple(zip(self.labels, key))
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        return [f"{self.name}{_format_labels(self._label_pairs(key))} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """Значение на момент запроса; функции, добавленные через track(), опрашиваются при каждом запросе."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._functions = []
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def track(self, function, **labels):
+        """function() возвращает число (для labels) или список пар (метки, значение)."""
+        entry = (function, labels)
+        self._functions.append(entry)
+        return entry
+
+    def untrack(self, entry):
+        if entry in self._functions:
+            self._functions.remove(entry)
+
+    def expose(self):
+        values = dict(self._values)
+        for function, labels in self._functions:
+            try:
+                result = function()
+            except Exception as e:
+                logging.warning(f"Не удалось получить значение метрики {self.name}: {e}")
+                continue
+            if isinstance(result, (int, float)):
+                values[self._key(labels)] = result
+            else:
+                for extra_labels, value in result:
+                    values[self._key({**labels, **extra_labels})] = value
+        return [f"{self.name}{_format_labels(self._label_pairs(key))} {_format_value(value)}"
+                for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # Счётчики по корзинам (последняя — +Inf) и сумма наблюдений
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Измеряет время выполнения блока with."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def expose(self):
+        lines = []
+        for key, (counts, total) in self._values.items():
+            pairs = self._label_pairs(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    def expose(self):
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Метрики рассылки
+LLM_LATENCY = Histogram("llm_request_seconds", "Время запроса к модели с учётом ожидания лимитов и повторов", ("prompt",))
+LLM_FIRST_TOKEN = Histogram("llm_first_token_seconds", "Время до первого куска потокового ответа модели",
+                            ("prompt",))
+LLM_ATTEMPTS = Histogram("llm_request_attempts", "Число попыток на один запрос к модели", ("prompt",),
+                         buckets=(1, 2, 3, 4, 5))
+LLM_ERRORS = Counter("llm_request_errors_total", "Неудачные попытки запроса к модели", ("prompt", "error"))
+DEBOUNCE_WAIT = Histogram("debounce_wait_seconds", "Время от первого неотвеченного сообщения до начала ответа",
+                          ("campaign",))
+DB_WRITE_LATENCY = Histogram("db_write_seconds", "Время пакетной записи в базу данных", ("table",))
+MESSAGES_SENT = Counter("messages_sent_total", "Отправленные сообщения", ("campaign", "kind"))
+TELEGRAM_LIMITS = Counter("telegram_limits_total", "Ограничения Telegram (FloodWait, PeerFlood)", ("account", "error"))
+OPEN_DIALOGS = Gauge("open_dialogs", "Диалоги в памяти процесса", ("campaign",))
+PENDING_TIMERS = Gauge("pending_timers", "Ожидающие таймеры колеса по типу", ("kind",))
+RUNNING_TIMERS = Gauge("running_timer_tasks", "Выполняющиеся обработчики сработавших таймеров")
+ASYNCIO_TASKS = Gauge("asyncio_tasks", "Все задачи цикла событий процесса")
+
+
+async def _handle_metrics(request):
+    return web.Response(text=registry.expose(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-cache"})
+
+
+async def start_metrics_server(port=None, host=None):
+    """Запускает HTTP-эндпоинт /metrics (METRICS_HOST:METRICS_PORT, по умолчанию 127.0.0.1:9108).
+
+    METRICS_PORT=0 отключает эндпоинт. Возвращает AppRunner (для cleanup()) или None.
+    """
+    port = int(port if port is not None else os.getenv("METRICS_PORT", 9108))
+    host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+    if not port:
+        return None
+    ASYNCIO_TASKS.track(lambda: len(asyncio.all_tasks()))
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Порт занят (например, второй экземпляр скрипта) — работаем без метрик
+        logging.warning(f"Не удалось открыть эндпоинт метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(text):
+    """Разбирает текстовый формат Prometheus в список (имя, словарь меток, значение)."""
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = _SAMPLE_RE.match(line.strip())
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        labels = {
+            key: raw.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
+            for key, raw in _LABEL_RE.findall(labels or "")
+        }
+        samples.append((name, labels, float(value)))
+    return samples
+
+
+async def fetch_metrics(url, timeout=5):
+    """Забирает метрики другого процесса по HTTP и возвращает разобранные значения."""
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return parse_metrics(await response.text())
+
+
+def sum_samples(samples, name, label=None):
+    """Сумма значений метрики по всем процессам; с label — по значениям этой метки."""
+    if label is None:
+        return sum(value for sample_name, _, value in samples if sample_name == name)
+    totals = defaultdict(float)
+    for sample_name, labels, value in samples:
+        if sample_name == name:
+            totals[labels.get(label, "")] += value
+    return dict(totals)
+
+
+def histogram_summary(samples, name, label, quantile=0.95):
+    """Сводка гистограммы по значениям метки label: {значение: (число наблюдений, среднее, квантиль)}.
+
+    Квантиль оценивается по верхней границе корзины, в которую он попал.
+    """
+    buckets = defaultdict(lambda: defaultdict(float))
+    sums = defaultdict(float)
+    counts = defaultdict(float)
+    for sample_name, labels, value in samples:
+        group = labels.get(label, "")
+        if sample_name == name + "_bucket":
+            buckets[group][float(labels["le"])] += value
+        elif sample_name == name + "_sum":
+            sums[group] += value
+        elif sample_name == name + "_count":
+            counts[group] += value
+
+    summary = {}
+    for group, count in counts.items():
+        if not count:
+            continue
+        bound = None
+        finite = [le for le in sorted(buckets[group]) if le != float("inf")]
+        for le in finite:
+            if buckets[group][le] >= quantile * count:
+                bound = le
+                break
+        if bound is None and finite:
+            bound = finite[-1]
+        summary[group] = (int(count), sums[group] / count, bound)
+    return summary
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import logging
+
+# Счётчики воронки, которые обновляются триггерами вместе с user_stats.
+# Панель статистики читает несколько строк отсюда вместо полного прохода по user_stats.
+#   total                 – всего строк в user_stats
+#   contacted             – отправлено первое сообщение
+#   replied               – пользователь ответил
+#   contact_shared        – отправлены контакты менеджера
+#   consultation_agreed   – согласился на консультацию
+#   qualification:<...>   – квалификация лида (холодный/теплый/горячий)
+
+# Ведра, в которые попадает одна строка user_stats (r — алиас строки)
+_BUCKETS_LATERAL = """
+    CROSS JOIN LATERAL (VALUES
+        ('total', TRUE),
+        ('contacted', r.initial_message_sent IS TRUE),
+        ('replied', r.user_replied IS TRUE),
+        ('contact_shared', r.sensitive_info_sent IS TRUE),
+        ('consultation_agreed', r.consultation_agreed IS TRUE),
+        ('qualification:' || lower(trim(r.qualification)), r.qualification IS NOT NULL)
+    ) AS b(bucket, hit)
+"""
+
+# Изменения оператора дописываются строками в user_stats_counter_deltas: обычный INSERT не
+# блокирует ничьих строк, поэтому записи в user_stats из разных процессов идут параллельно
+# (общие строки счётчиков вроде total иначе выстраивали бы все транзакции в очередь).
+# В user_stats_counters изменения переносит compact_counters()
+_APPLY_DELTAS = """
+        INSERT INTO user_stats_counter_deltas (bucket, value)
+        SELECT bucket, SUM(delta) FROM ({deltas}) d
+        GROUP BY bucket
+        HAVING SUM(delta) <> 0;
+"""
+
+_NEW_ROWS = "SELECT b.bucket, 1 AS delta FROM new_rows r" + _BUCKETS_LATERAL + "WHERE b.hit"
+_OLD_ROWS = "SELECT b.bucket, -1 AS delta FROM old_rows r" + _BUCKETS_LATERAL + "WHERE b.hit"
+
+# Ключ advisory-блокировки, чтобы несколько скриптов не создавали таблицы и триггеры одновременно
+_SCHEMA_LOCK_KEY = 7310001
+
+_SCHEMA_SQL = f"""
+    CREATE TABLE IF NOT EXISTS user_stats_counters (
+        bucket VARCHAR(100) PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS user_stats_counter_deltas (
+        id BIGSERIAL PRIMARY KEY,
+        bucket VARCHAR(100) NOT NULL,
+        value BIGINT NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION user_stats_counters_apply() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {_APPLY_DELTAS.format(deltas=_NEW_ROWS)}
+        ELSIF TG_OP = 'UPDATE' THEN
+            {_APPLY_DELTAS.format(deltas=_NEW_ROWS + " UNION ALL " + _OLD_ROWS)}
+        ELSE
+            {_APPLY_DELTAS.format(deltas=_OLD_ROWS)}
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# Триггеры создаются, только если их ещё нет: пересоздание брало бы блокировку user_stats
+# при каждом запуске скрипта. Функция выше заменяется на месте, и триггеры сразу вызывают новую
+_TRIGGERS = {
+    "user_stats_counters_insert": """
+        CREATE TRIGGER user_stats_counters_insert AFTER INSERT ON user_stats
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION user_stats_counters_apply();
+    """,
+    "user_stats_counters_update": """
+        CREATE TRIGGER user_stats_counters_update AFTER UPDATE ON user_stats
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION user_stats_counters_apply();
+    """,
+    "user_stats_counters_delete": """
+        CREATE TRIGGER user_stats_counters_delete AFTER DELETE ON user_stats
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION user_stats_counters_apply();
+    """,
+}
+
+# Перенос накопленных изменений в счётчики. Строки, которые уже переносит другой процесс,
+# пропускаются (SKIP LOCKED), а незакоммиченные изменения не видны — перенос никого не ждёт.
+# Строки счётчиков блокируются в порядке bucket, поэтому параллельные переносы не попадают в deadlock
+_COMPACT_SQL = """
+    WITH moved AS (
+        DELETE FROM user_stats_counter_deltas
+        WHERE id IN (
+            SELECT id FROM user_stats_counter_deltas
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING bucket, value
+    )
+    INSERT INTO user_stats_counters AS c (bucket, value)
+    SELECT bucket, SUM(value) FROM moved
+    GROUP BY bucket
+    ORDER BY bucket
+    ON CONFLICT (bucket) DO UPDATE SET value = c.value + EXCLUDED.value;
+"""
+
+
+async def rebuild_counters(conn):
+    """Пересчитывает все счётчики с нуля по текущему содержимому user_stats."""
+    async with conn.transaction():
+        # Блокируем запись в user_stats, чтобы пересчёт не разошёлся с триггерами
+        await conn.execute("LOCK TABLE user_stats IN SHARE MODE;")
+        await conn.execute("DELETE FROM user_stats_counter_deltas;")
+        await conn.execute("DELETE FROM user_stats_counters;")
+        await conn.execute(
+            "INSERT INTO user_stats_counters (bucket, value) "
+            "SELECT b.bucket, COUNT(*) FROM user_stats r" + _BUCKETS_LATERAL +
+            "WHERE b.hit GROUP BY b.bucket;"
+        )
+    logging.info("Счётчики статистики пересчитаны")
+
+
+async def create_counters(conn):
+    """Создаёт таблицы счётчиков и недостающие триггеры; при первом запуске заполняет счётчики по user_stats.
+
+    Возвращает True, если счётчики только что пересчитаны с нуля.
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1);", _SCHEMA_LOCK_KEY)
+        await conn.execute(_SCHEMA_SQL)
+        rows = await conn.fetch("""
+            SELECT tgname FROM pg_trigger
+            WHERE tgrelid = 'user_stats'::regclass AND tgname = ANY($1::name[]);
+        """, list(_TRIGGERS))
+        existing = {row['tgname'] for row in rows}
+        for name, sql in _TRIGGERS.items():
+            if name not in existing:
+                await conn.execute(sql)
+        initialized = await conn.fetchval("SELECT EXISTS (SELECT 1 FROM user_stats_counters WHERE bucket = 'total');")
+        if not initialized:
+            await rebuild_counters(conn)
+        return not initialized
+
+
+async def compact_counters(pool, limit=50000):
+    """Переносит накопленные изменения в user_stats_counters, чтобы таблица изменений оставалась короткой."""
+    try:
+        await pool.execute(_COMPACT_SQL, limit)
+    except Exception as e:
+        logging.warning(f"Не удалось перенести изменения счётчиков статистики: {e}")
+
+
+async def fetch_counters(pool):
+    """Возвращает словарь bucket -> значение (счётчики вместе с ещё не перенесёнными изменениями)."""
+    rows = await pool.fetch("""
+        SELECT bucket, SUM(value)::BIGINT AS value FROM (
+            SELECT bucket, value FROM user_stats_counters
+            UNION ALL
+            SELECT bucket, value FROM user_stats_counter_deltas
+        ) AS t
+        GROUP BY bucket;
+    """)
+    return {row['bucket']: row['value'] for row in rows}
+
+
+async def _main():
+    from dotenv import load_dotenv
+    from common.db import create_db_pool
+
+    parser = argparse.ArgumentParser(description="Счётчики статистики user_stats")
+    parser.add_argument('--rebuild', action='store_true', help='Пересчитать счётчики с нуля')
+    args = parser.parse_args()
+
+    load_dotenv()
+    pool = await create_db_pool(min_size=1, max_size=1)
+    try:
+        async with pool.acquire() as conn:
+            rebuilt = await create_counters(conn)
+            # На новой базе create_counters уже пересчитал счётчики
+            if args.rebuild and not rebuilt:
+                await rebuild_counters(conn)
+        await compact_counters(pool)
+        for bucket, value in sorted((await fetch_counters(pool)).items()):
+            print(f"{bucket}: {value}")
+    finally:
+        await pool.close()
+
+
+# Пересчёт счётчиков: python -m common.stats_counters --rebuild
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    asyncio.run(_main())
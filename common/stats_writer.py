@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import time
+
+from common.metrics import DB_WRITE_LATENCY
+from common.stats_counters import compact_counters
+
+# Столбцы user_stats, которые обновляет рассылка
+STATS_COLUMNS = (
+    'user_replied', 'message_count', 'sensitive_info_sent', 'initial_message_sent',
+    'qualification', 'summary', 'monthly_budget', 'consultation_agreed',
+)
+
+_STAGING_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS user_stats_staging (
+        username VARCHAR(255),
+        user_replied BOOLEAN,
+        message_count INT,
+        sensitive_info_sent BOOLEAN,
+        initial_message_sent BOOLEAN,
+        qualification VARCHAR(50),
+        summary TEXT,
+        monthly_budget INT,
+        consultation_agreed BOOLEAN
+    ) ON COMMIT DELETE ROWS;
+"""
+
+# NULL в staging означает «поле не менялось» — текущее значение в user_stats сохраняется.
+# Строки блокируются в порядке username, чтобы параллельные пачки не попадали в deadlock.
+_MERGE_SQL = """
+    INSERT INTO user_stats (
+        username, user_replied, message_count, sensitive_info_sent,
+        initial_message_sent, qualification, summary, monthly_budget,
+        consultation_agreed
+    )
+    SELECT username, user_replied, message_count, sensitive_info_sent,
+           initial_message_sent, qualification, summary, monthly_budget,
+           consultation_agreed
+    FROM user_stats_staging
+    ORDER BY username
+    ON CONFLICT (username)
+    DO UPDATE SET
+        user_replied = COALESCE(EXCLUDED.user_replied, user_stats.user_replied),
+        message_count = COALESCE(EXCLUDED.message_count, user_stats.message_count),
+        sensitive_info_sent = COALESCE(EXCLUDED.sensitive_info_sent, user_stats.sensitive_info_sent),
+        initial_message_sent = COALESCE(EXCLUDED.initial_message_sent, user_stats.initial_message_sent),
+        qualification = COALESCE(EXCLUDED.qualification, user_stats.qualification),
+        summary = COALESCE(EXCLUDED.summary, user_stats.summary),
+        monthly_budget = COALESCE(EXCLUDED.monthly_budget, user_stats.monthly_budget),
+        consultation_agreed = COALESCE(EXCLUDED.consultation_agreed, user_stats.consultation_agreed),
+        updated_at = CURRENT_TIMESTAMP;
+"""
+
+
+class StatsWriter:
+    """Отложенная запись user_stats: обновления копятся в памяти и сливаются в базу пачками.
+
+    Несколько обновлений одного пользователя между сбросами объединяются в одну строку
+    (поля со значением None не меняют уже записанное). Пачка сбрасывается раз в
+    STATS_FLUSH_INTERVAL_MS миллисекунд или сразу, когда набралось STATS_FLUSH_MAX_ROWS
+    пользователей: COPY во временную таблицу и один INSERT ... ON CONFLICT из неё.
+    Раз в STATS_COUNTERS_COMPACT_INTERVAL секунд изменения счётчиков воронки, которые
+    дописали триггеры, переносятся в user_stats_counters.
+    """
+
+    def __init__(self, pool, flush_interval_ms=None, max_rows=None):
+        self.pool = pool
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None
+                               else int(os.getenv("STATS_FLUSH_INTERVAL_MS", 1000))) / 1000
+        self.max_rows = max_rows if max_rows is not None else int(os.getenv("STATS_FLUSH_MAX_ROWS", 500))
+        self.compact_interval = float(os.getenv("STATS_COUNTERS_COMPACT_INTERVAL", 60))
+        self._compacted_at = time.monotonic()
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def update(self, username, **fields):
+        """Ставит обновление пользователя в очередь на запись."""
+        pending = self._pending.setdefault(username, {})
+        for column, value in fields.items():
+            if value is not None:
+                pending[column] = value
+        if len(self._pending) >= self.max_rows:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if time.monotonic() - self._compacted_at >= self.compact_interval:
+                self._compacted_at = time.monotonic()
+                await compact_counters(self.pool)
+
+    async def flush(self):
+        """Записывает накопленные обновления; при ошибке возвращает их в очередь до следующего сброса."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            records = [
+                (username, *(fields.get(column) for column in STATS_COLUMNS))
+                for username, fields in batch.items()
+            ]
+            try:
+                async with self.pool.acquire() as conn:
+                    with DB_WRITE_LATENCY.time(table="user_stats"):
+                        async with conn.transaction():
+                            await conn.execute(_STAGING_TABLE_SQL)
+                            await conn.copy_records_to_table(
+                                'user_stats_staging', records=records, columns=('username',) + STATS_COLUMNS
+                            )
+                            await conn.execute(_MERGE_SQL)
+                logging.debug(f"Записано в user_stats: {len(records)} строк")
+            except Exception as e:
+                logging.error(f"Ошибка при записи статистики в базу данных: {e}")
+                # Более свежие обновления, пришедшие во время записи, важнее возвращаемых
+                for username, fields in batch.items():
+                    self._pending[username] = {**fields, **self._pending.get(username, {})}
+
+    async def close(self):
+        """Останавливает фоновый сброс и записывает всё, что осталось в очереди."""
+        # Задачу не отменяем, чтобы не прервать запись посреди транзакции
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import re
+
+from common.llm_client import get_llm_client
+from common.log_setup import log_payload
+
+# Проверка типа JSON-схемы для значения Python (bool — не число, хотя это подкласс int)
+_TYPES = {
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "null": lambda value: value is None,
+}
+
+REPAIR_PROMPT = (
+    "Исправь ответ так, чтобы он был JSON-объектом по схеме. Значения, которые подходят, не меняй; "
+    "недостающие или неверные поля заполни по смыслу исходного ответа допустимыми значениями. "
+    "Пришли только JSON без пояснений."
+)
+
+
+def compile_schema(schema):
+    """Собирает JSON-схему в функцию проверки: value -> список ошибок (пустой, если значение подходит).
+
+    Поддерживается подмножество, которое принимает строгий режим structured outputs:
+    type (строка или список), enum, properties, required, additionalProperties и items.
+    """
+    checks = []
+
+    types = schema.get("type")
+    if types is not None:
+        types = [types] if isinstance(types, str) else list(types)
+        predicates = [_TYPES[name] for name in types]
+
+        def check_type(value, path, errors):
+            if not any(predicate(value) for predicate in predicates):
+                errors.append(f"{path}: ожидается {' или '.join(types)}, получено {json.dumps(value, ensure_ascii=False)}")
+                return False
+            return True
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = list(schema["enum"])
+
+        def check_enum(value, path, errors):
+            if value not in allowed:
+                errors.append(f"{path}: допустимые значения {json.dumps(allowed, ensure_ascii=False)}, "
+                              f"получено {json.dumps(value, ensure_ascii=False)}")
+                return False
+            return True
+        checks.append(check_enum)
+
+    if "properties" in schema or "required" in schema:
+        properties = {name: compile_schema(sub) for name, sub in (schema.get("properties") or {}).items()}
+        required = list(schema.get("required") or [])
+        extra_allowed = schema.get("additionalProperties", True) is not False
+
+        def check_object(value, path, errors):
+            if not isinstance(value, dict):
+                return True
+            ok = True
+            for name in required:
+                if name not in value:
+                    errors.append(f"{path}.{name}: обязательное поле отсутствует")
+                    ok = False
+            for name, item in value.items():
+                check = properties.get(name)
+                if check is not None:
+                    ok = check(item, f"{path}.{name}", errors) and ok
+                elif not extra_allowed:
+                    errors.append(f"{path}.{name}: лишнее поле")
+                    ok = False
+            return ok
+        checks.append(check_object)
+
+    if "items" in schema:
+        check_item = compile_schema(schema["items"])
+
+        def check_items(value, path, errors):
+            if not isinstance(value, list):
+                return True
+            ok = True
+            for index, item in enumerate(value):
+                ok = check_item(item, f"{path}[{index}]", errors) and ok
+            return ok
+        checks.append(check_items)
+
+    def check(value, path, errors):
+        # Дальше типа не проверяем: ошибки вложенных полей у значения не того типа бессмысленны
+        for step in checks:
+            if not step(value, path, errors):
+                return False
+        return True
+    return check
+
+
+def parse_json(content):
+    """JSON-объект из ответа модели; если вокруг него есть текст или разметка — объект между первой и последней скобкой."""
+    if not content:
+        return None
+    try:
+        value = json.loads(content)
+    except json.JSONDecodeError:
+        start, end = content.find('{'), content.rfind('}')
+        if start < 0 or end <= start:
+            return None
+        try:
+            value = json.loads(content[start:end + 1])
+        except json.JSONDecodeError:
+            return None
+    return value if isinstance(value, dict) else None
+
+
+# Число с необязательным множителем: "50000", "50 000", "1,5 млн", "15к", "15 тыс."
+_AMOUNT = re.compile(r"(\d+(?:[.,]\d+)?)\s*(млн|тыс|т\.|к\b|k\b|m\b)?")
+# Разделитель тысяч внутри числа: "50 000", "50.000", "50,000"
+_THOUSANDS = re.compile(r"(?<=\d)[\s.,](?=\d{3}(?!\d))")
+
+
+def coerce_amount(value):
+    """Сумма из ответа модели в целое число: 50000, "около 50 000", "15к", "1,5 млн". Без числа — None."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        text = _THOUSANDS.sub("", str(value).lower())
+        match = _AMOUNT.search(text)
+        if not match:
+            return None
+        number = float(match.group(1).replace(",", "."))
+        multiplier = match.group(2)
+        if multiplier:
+            number *= 1000000 if multiplier in ("млн", "m") else 1000
+    number = int(round(number))
+    # Столбцы бюджета — INT
+    return number if 0 <= number <= 2 ** 31 - 1 else None
+
+
+class StructuredOutput:
+    """Ответ модели по JSON-схеме с проверкой и одним запросом на исправление.
+
+    Схема собирается в функцию проверки один раз при создании. Формат запроса задаёт
+    ANALYSIS_RESPONSE_FORMAT: json_schema — строгая схема (по умолчанию), json_object —
+    любой JSON-объект (для моделей без structured outputs), text — без ограничений.
+    Ответ разбирается, приводится функцией coerce и проверяется. Если он не подходит,
+    делается один короткий запрос на исправление: в нём только неудачный ответ, схема
+    и ошибки, без диалога. Если не помогло и это, request() возвращает поля, которые
+    прошли проверку, и список ошибок.
+    """
+
+    def __init__(self, name, schema, coerce=None, response_format=None):
+        self.name = name
+        self.schema = schema
+        self.coerce = coerce
+        self.response_format = response_format or os.getenv("ANALYSIS_RESPONSE_FORMAT", "json_schema")
+        self._check = compile_schema(schema)
+
+    def validate(self, value):
+        errors = []
+        self._check(value, "$", errors)
+        return errors
+
+    def _params(self):
+        if self.response_format == "json_schema":
+            return {"response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": self.name, "schema": self.schema, "strict": True},
+            }}
+        if self.response_format == "json_object":
+            return {"response_format": {"type": "json_object"}}
+        return {}
+
+    def parse(self, content):
+        """Разбирает, приводит и проверяет ответ: (результат или None, ошибки)."""
+        result = parse_json(content)
+        if result is None:
+            return None, ["$: ответ не содержит JSON-объекта"]
+        if self.coerce is not None:
+            result = self.coerce(dict(result))
+        return result, self.validate(result)
+
+    def salvage(self, result, errors):
+        """Поля результата без ошибок (схема — объект), чтобы не потерять то, что модель ответила верно."""
+        if not result:
+            return None
+        broken = {error.split(":", 1)[0].split(".")[1].split("[")[0] for error in errors if error.startswith("$.")}
+        known = self.schema.get("properties") or {}
+        salvaged = {name: value for name, value in result.items() if name in known and name not in broken}
+        return salvaged or None
+
+    async def request(self, messages, label, max_retries=3, **params):
+        """Запрос к модели с разбором по схеме: (результат или None, ошибки последней попытки)."""
+        client = get_llm_client()
+        content = await client.complete(messages, max_retries=max_retries, label=label, **self._params(), **params)
+        log_payload(f"Ответ модели {self.name}", content)
+        result, errors = self.parse(content)
+        if not errors:
+            return result, []
+
+        logging.warning(f"Ответ модели {self.name} не соответствует схеме, запрашиваем исправление: {'; '.join(errors)}")
+        repair = [
+            {"role": "system", "content": REPAIR_PROMPT},
+            {"role": "user", "content": (
+                f"Схема:\n{json.dumps(self.schema, ensure_ascii=False)}\n\n"
+                f"Ответ:\n{content}\n\n"
+                "Ошибки:\n" + "\n".join(f"- {error}" for error in errors)
+            )},
+        ]
+        repaired = await client.complete(repair, max_retries=max_retries, label=f"{label}_repair",
+                                         **self._params(), temperature=0)
+        log_payload(f"Исправленный ответ модели {self.name}", repaired)
+        repaired_result, repaired_errors = self.parse(repaired)
+        if not repaired_errors:
+            return repaired_result, []
+
+        logging.warning(f"Исправленный ответ модели {self.name} тоже не соответствует схеме: {'; '.join(repaired_errors)}")
+        # Из двух ответов берём тот, в котором больше верных полей
+        first = self.salvage(result, errors) or {}
+        second = self.salvage(repaired_result, repaired_errors) or {}
+        return (second if len(second) >= len(first) else first) or None, repaired_errors
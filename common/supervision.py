@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import os
+import signal
+
+# Задача пульса: цикл событий держит задачи только по слабой ссылке, поэтому ссылка хранится здесь
+_heartbeat_task = None
+
+
+async def _heartbeat(path, interval):
+    while True:
+        with open(path, 'a'):
+            os.utime(path, None)
+        await asyncio.sleep(interval)
+
+
+def start_heartbeat(interval=None):
+    """Периодически обновляет файл пульса HEARTBEAT_FILE, если процесс запущен супервизором run.py.
+
+    Файл обновляет задача в цикле событий, поэтому зависший цикл супервизор тоже заметит.
+    """
+    global _heartbeat_task
+    path = os.getenv("HEARTBEAT_FILE")
+    if not path:
+        return None
+    interval = interval or float(os.getenv("HEARTBEAT_INTERVAL", 15))
+    _heartbeat_task = asyncio.create_task(_heartbeat(path, interval))
+    return _heartbeat_task
+
+
+def cancel_on_sigterm():
+    """По SIGTERM отменяет текущую задачу, чтобы отработали блоки finally и накопленные данные были записаны."""
+    task = asyncio.current_task()
+
+    def on_sigterm():
+        logging.info("Получен SIGTERM, завершаем работу")
+        task.cancel()
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, on_sigterm)
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import Counter
+
+from common.metrics import PENDING_TIMERS, RUNNING_TIMERS
+
+
+class TimerWheel:
+    """Колесо таймеров: все отложенные действия процесса обслуживает одна фоновая задача.
+
+    Таймер задаётся ключом вида (тип, username), например ("reply", username) —
+    окно склейки сообщений перед ответом или ("reminder", username) — напоминание.
+    Время делится на тики по TIMER_TICK секунд, таймер кладётся в ячейку своего тика
+    (ячеек TIMER_SLOTS, по кругу), поэтому постановка, перенос и отмена — O(1),
+    а не новая задача и cancel() на каждое сообщение пользователя. Таймер дальше
+    одного оборота колеса просто остаётся в ячейке до своего оборота.
+
+    Сработавший таймер запускает callback(*args) отдельной задачей; пока она идёт,
+    is_active(key) возвращает True.
+    """
+
+    def __init__(self, tick=None, slots=None):
+        self.tick = tick or float(os.getenv("TIMER_TICK", 0.5))
+        self.slots = [dict() for _ in range(slots or int(os.getenv("TIMER_SLOTS", 512)))]
+        self._timers = {}  # key -> (deadline, номер ячейки, callback, args)
+        self._running = {}  # key -> задача сработавшего таймера
+        self._counts = Counter()  # число ожидающих таймеров по типу
+        self._origin = time.monotonic()
+        self._processed = -1  # последний обработанный тик
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._gauges = []
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._gauges = [
+            (PENDING_TIMERS, PENDING_TIMERS.track(lambda: [({"kind": kind}, count) for kind, count in self._counts.items()])),
+            (RUNNING_TIMERS, RUNNING_TIMERS.track(lambda: len(self._running))),
+        ]
+        return self
+
+    def _current_tick(self):
+        return int((time.monotonic() - self._origin) // self.tick)
+
+    def schedule(self, key, delay, callback, *args):
+        """Ставит таймер или переносит уже поставленный с тем же ключом на delay секунд от текущего момента."""
+        self._remove(key)
+        deadline = time.monotonic() + delay
+        # Тик, который драйвер уже обработал, пропустил бы таймер на целый оборот
+        tick = max(math.ceil((deadline - self._origin) / self.tick), self._processed + 1)
+        slot = tick % len(self.slots)
+        self.slots[slot][key] = deadline
+        self._timers[key] = (deadline, slot, callback, args)
+        self._counts[key[0]] += 1
+        self._wakeup.set()
+
+    def _remove(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        del self.slots[timer[1]][key]
+        self._counts[key[0]] -= 1
+        return True
+
+    def cancel(self, key, running=False):
+        """Снимает ожидающий таймер; с running=True отменяет и уже сработавший обработчик."""
+        removed = self._remove(key)
+        if running:
+            task = self._running.get(key)
+            if task is not None and not task.done():
+                task.cancel()
+                removed = True
+        return removed
+
+    def is_pending(self, key):
+        return key in self._timers
+
+    def is_active(self, key):
+        """Таймер ожидает срабатывания или его обработчик ещё выполняется."""
+        task = self._running.get(key)
+        return key in self._timers or (task is not None and not task.done())
+
+    def pending_count(self, kind=None):
+        """Число ожидающих таймеров: всех или одного типа ("reply", "reminder", ...)."""
+        if kind is None:
+            return len(self._timers)
+        return self._counts[kind]
+
+    def _fire(self, key):
+        _, _, callback, args = self._timers[key]
+        self._remove(key)
+        task = asyncio.create_task(callback(*args))
+        self._running[key] = task
+        task.add_done_callback(lambda done: self._finished(key, done))
+
+    def _finished(self, key, task):
+        if self._running.get(key) is task:
+            del self._running[key]
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Ошибка в обработчике таймера {key}: {task.exception()}")
+
+    def _process(self, tick, now):
+        slot = self.slots[tick % len(self.slots)]
+        due = [key for key, deadline in slot.items() if deadline <= now]
+        for key in due:
+            self._fire(key)
+
+    async def _run(self):
+        while True:
+            if not self._timers:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                # Пока таймеров не было, тики обрабатывать было нечего
+                self._processed = max(self._processed, self._current_tick() - 1)
+                continue
+
+            current = self._current_tick()
+            now = time.monotonic()
+            # Если цикл событий задержался, обходим пропущенные тики (не больше одного оборота)
+            first = max(self._processed + 1, current - len(self.slots) + 1)
+            for tick in range(first, current + 1):
+                self._process(tick, now)
+            self._processed = current
+
+            next_tick_at = self._origin + (current + 1) * self.tick
+            await asyncio.sleep(max(0.0, next_tick_at - time.monotonic()))
+
+    async def close(self):
+        """Останавливает колесо; ожидающие таймеры снимаются, выполняющиеся обработчики отменяются."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._running.values()):
+            task.cancel()
+        self._timers.clear()
+        for slot in self.slots:
+            slot.clear()
+        self._counts.clear()
+        for gauge, entry in self._gauges:
+            gauge.untrack(entry)
+        self._gauges = []
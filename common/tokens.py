@@ -0,0 +1,37 @@
+import logging
+from functools import lru_cache
+
+# Служебные токены, которые API добавляет на каждое сообщение
+TOKENS_PER_MESSAGE = 4
+
+_encoder = None
+_encoder_loaded = False
+
+
+def _get_encoder():
+    """Загружает токенизатор tiktoken, если он установлен и доступен, иначе возвращает None."""
+    global _encoder, _encoder_loaded
+    if not _encoder_loaded:
+        _encoder_loaded = True
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # tiktoken может быть не установлен или не суметь скачать словарь — считаем приблизительно
+            logging.info(f"Токенизатор tiktoken недоступен, используется приблизительный подсчёт: {e}")
+            _encoder = None
+    return _encoder
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text):
+    """Число токенов в строке (для кириллицы без tiktoken — примерно 3 символа на токен)."""
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text))
+    return len(text) // 3 + 1
+
+
+def count_tokens(messages):
+    """Число токенов в списке сообщений чата вместе со служебными токенами."""
+    return sum(count_text_tokens(message.get("content") or "") + TOKENS_PER_MESSAGE for message in messages)
@@ -0,0 +1,204 @@
+import asyncio
+import glob
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+
+# Начало реплики в файле диалога: "User: ..." или "Assistant: ..."
+_TURN_START = re.compile(r"^(User|Assistant): ?(.*)$")
+
+
+def format_turns(messages):
+    """Реплики в формате файла диалога: "Role: текст" с пустой строкой между репликами."""
+    return "".join(f"{message['role'].capitalize()}: {message['content']}\n\n" for message in messages)
+
+
+def parse_transcript(text):
+    """Реплики файла диалога: список (роль, текст) в порядке записи."""
+    messages = []
+    for line in text.splitlines():
+        match = _TURN_START.match(line)
+        if match:
+            messages.append([match.group(1).lower(), [match.group(2)]])
+        elif messages:
+            messages[-1][1].append(line)
+    return [(role, "\n".join(lines).strip()) for role, lines in messages]
+
+
+def collapse_repeated_history(messages):
+    """Реплики без повторов истории.
+
+    Раньше файл диалога дописывался всей историей перед каждым ответом, и в старых файлах
+    она повторяется: [u1] [u1, a1, u2] [u1, a1, u2, a2, u3]. Каждая следующая копия
+    начинается с предыдущей целиком (первая может состоять из одной реплики). Такие копии
+    пропускаются, остаётся одна история; в файлах без повторов ничего не меняется.
+    """
+    history = []
+    index = 0
+    while index < len(messages):
+        size = len(history)
+        if size and messages[index:index + size] == history:
+            index += size
+            continue
+        history.append(messages[index])
+        index += 1
+    return history
+
+
+def read_transcript(path):
+    """Текст диалога вместе со сжатыми при ротации частями (<username>.txt.N.gz, от старых к новым)."""
+    parts = []
+    for backup in glob.glob(glob.escape(path) + ".*.gz"):
+        suffix = backup[len(path) + 1:-len(".gz")]
+        if suffix.isdigit():
+            parts.append((int(suffix), backup))
+    text = ""
+    for _, backup in sorted(parts, reverse=True):
+        with gzip.open(backup, "rt", encoding="utf-8") as file:
+            text += file.read()
+    with open(path, encoding="utf-8") as file:
+        text += file.read()
+    return text
+
+
+class TranscriptWriter:
+    """Запись диалогов в файлы <каталог>/<username>.txt.
+
+    В файл дописываются только новые реплики: сколько сообщений диалога уже записано,
+    хранится в его состоянии (transcript_written), поэтому после перезапуска повторов
+    тоже нет. Запись идёт в отдельном потоке: append() только кладёт текст в очередь,
+    и время обработки сообщения не зависит от длины диалога. Поток держит открытыми
+    до TRANSCRIPT_MAX_OPEN файлов, сбрасывает буферы после каждой пачки и делает
+    fsync раз в TRANSCRIPT_FSYNC_INTERVAL секунд. Файл больше TRANSCRIPT_MAX_BYTES
+    сжимается в <username>.txt.1.gz (старые части сдвигаются, хранится не больше
+    TRANSCRIPT_BACKUP_COUNT), а запись продолжается в новый файл.
+    """
+
+    def __init__(self, directory, fsync_interval=None, max_bytes=None, backup_count=None, max_open=None):
+        self.directory = directory
+        self.fsync_interval = fsync_interval or float(os.getenv("TRANSCRIPT_FSYNC_INTERVAL", 5))
+        self.max_bytes = max_bytes or int(os.getenv("TRANSCRIPT_MAX_BYTES", 1024 * 1024))
+        self.backup_count = backup_count or int(os.getenv("TRANSCRIPT_BACKUP_COUNT", 5))
+        self.max_open = max_open or int(os.getenv("TRANSCRIPT_MAX_OPEN", 256))
+        self._queue = queue.Queue()
+        self._files = OrderedDict()  # username -> открытый файл; порядок — от давних к недавним
+        self._unsynced = set()
+        self._synced_at = time.monotonic()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="transcripts", daemon=True)
+        self._thread.start()
+        return self
+
+    def append(self, username, state):
+        """Ставит в очередь на запись реплики диалога, которых ещё нет в файле; True, если такие были."""
+        written = state.get("transcript_written", 0)
+        turns = state["messages"][written:]
+        if not turns:
+            return False
+        self._queue.put((username, format_turns(turns)))
+        state["transcript_written"] = len(state["messages"])
+        return True
+
+    def path(self, username):
+        return os.path.join(self.directory, f"{username}.txt")
+
+    def _run(self):
+        running = True
+        while running:
+            timeout = max(0.0, self._synced_at + self.fsync_interval - time.monotonic()) if self._unsynced else None
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+                # Всё, что накопилось, пишем одной пачкой
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                try:
+                    self._write(*item)
+                except OSError as e:
+                    logging.error(f"Ошибка записи диалога {item[0]} в файл: {e}")
+
+            for file in self._files.values():
+                file.flush()
+            if not running or time.monotonic() - self._synced_at >= self.fsync_interval:
+                self._sync()
+        self._sync()
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+
+    def _write(self, username, text):
+        data = text.encode('utf-8')
+        file = self._open(username)
+        if file.tell() and file.tell() + len(data) > self.max_bytes:
+            self._rotate(username)
+            file = self._open(username)
+        file.write(data)
+        self._unsynced.add(username)
+
+    def _open(self, username):
+        file = self._files.get(username)
+        if file is not None:
+            self._files.move_to_end(username)
+            return file
+        if len(self._files) >= self.max_open:
+            # Закрываем самый давний файл; его данные сбрасываются на диск при закрытии
+            old_username, old_file = self._files.popitem(last=False)
+            old_file.flush()
+            if old_username in self._unsynced:
+                os.fsync(old_file.fileno())
+                self._unsynced.discard(old_username)
+            old_file.close()
+        file = open(self.path(username), 'ab')
+        self._files[username] = file
+        return file
+
+    def _rotate(self, username):
+        file = self._files.pop(username)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        self._unsynced.discard(username)
+
+        path = self.path(username)
+        # <username>.txt.1.gz — самая свежая часть, дальше старше; последняя удаляется
+        for number in range(self.backup_count - 1, 0, -1):
+            source = f"{path}.{number}.gz"
+            if os.path.exists(source):
+                os.replace(source, f"{path}.{number + 1}.gz")
+        with open(path, 'rb') as source, gzip.open(f"{path}.1.gz", 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.remove(path)
+
+    def _sync(self):
+        for username in self._unsynced:
+            file = self._files.get(username)
+            if file is not None:
+                file.flush()
+                os.fsync(file.fileno())
+        self._unsynced.clear()
+        self._synced_at = time.monotonic()
+
+    async def close(self):
+        """Дописывает очередь, сбрасывает файлы на диск и останавливает поток записи."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
@@ -0,0 +1,102 @@
+from collections import deque
+
+# Действия, которые может вызвать триггер в ответе модели, и их обязательные параметры
+ACTIONS = {
+    "switch_prompt": (),      # переход с первого промпта на второй или третий по анализу соцсетей
+    "send_document": ("document",),
+    "send_message": ("text",),
+    "sensitive_info": (),     # пользователю отправлены контакты менеджера
+    "qualify": (),            # анализ квалификации диалога
+}
+
+
+class AhoCorasick:
+    """Автомат Ахо — Корасик: все вхождения набора подстрок за один проход по тексту (без учёта регистра)."""
+
+    def __init__(self, patterns):
+        self.patterns = [pattern.lower() for pattern in patterns]
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]  # номера подстрок, которые заканчиваются в узле (с учётом ссылок неудач)
+
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = next_node
+            self._out[node].append(index)
+
+        # Ссылки неудач строятся обходом в ширину: у узла глубины 1 — корень
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find(self, text):
+        """Номера подстрок, которые встречаются в тексте."""
+        found = set()
+        node = 0
+        for char in text.lower():
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            if self._out[node]:
+                found.update(self._out[node])
+        return found
+
+
+class Triggers:
+    """Триггеры кампании, собранные в один автомат.
+
+    Правило — объект с подстроками match (строка или список), действием action,
+    его параметрами и необязательным списком prompts — на каких промптах (1–3)
+    правило действует. match() за один проход по ответу возвращает правила,
+    которые сработали, в порядке их описания.
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        patterns = []
+        owners = []  # номер подстроки -> номер правила
+        for rule in rules:
+            action = rule.get("action")
+            if action not in ACTIONS:
+                raise ValueError(f"Неизвестное действие триггера {action!r}: {rule}")
+            missing = [name for name in ACTIONS[action] if not rule.get(name)]
+            if missing:
+                raise ValueError(f"У триггера {action} не указаны {', '.join(missing)}: {rule}")
+            match = rule.get("match")
+            match = [match] if isinstance(match, str) else list(match or [])
+            if not match or not all(isinstance(pattern, str) and pattern for pattern in match):
+                raise ValueError(f"У триггера {action} нет подстрок match: {rule}")
+
+            for pattern in match:
+                patterns.append(pattern)
+                owners.append(len(self.rules))
+            self.rules.append(dict(rule, match=match))
+        self._owners = owners
+        self._matcher = AhoCorasick(patterns)
+
+    def match(self, text, prompt=None):
+        """Сработавшие на тексте правила; с prompt — только действующие на этом промпте."""
+        hits = sorted({self._owners[index] for index in self._matcher.find(text)})
+        rules = [self.rules[number] for number in hits]
+        if prompt is not None:
+            rules = [rule for rule in rules if not rule.get("prompts") or prompt in rule["prompts"]]
+        return rules
+
+    def has(self, text, action, prompt=None):
+        """Есть ли в тексте триггер действия action."""
+        return any(rule["action"] == action for rule in self.match(text, prompt))
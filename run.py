@@ -1,7 +1,12 @@
 import subprocess
 import os
+import sys
 import time
-from concurrent.futures import ThreadPoolExecutor
+import signal
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+from dotenv import load_dotenv
 
 # Корневая папка
 root_folder = os.path.dirname(os.path.abspath(__file__))
@@ -9,38 +14,208 @@ root_folder = os.path.dirname(os.path.abspath(__file__))
 # Отдельный скрипт для tgbot.py
 tgbot_script = os.path.join(root_folder, "tgbot.py")
 
-# Список путей к Python-скриптам, которые нужно запустить
+# Скрипты рассылки: (путь, имя процесса, аргументы). Все кампании из campaigns.json работают
+# в одном процессе с общим пулом соединений, клиентом OpenAI и кэшами
 scripts = [
-    (os.path.join(root_folder, "script1", "script1.py"), "script1_index"),
-    (os.path.join(root_folder, "script2", "script2.py"), "script2_index"),
-    (os.path.join(root_folder, "script3", "script3.py"), "script3_index"),
-    (os.path.join(root_folder, "script4", "script4.py"), "script4_index"),
-    (os.path.join(root_folder, "script5", "script5.py"), "script5_index")
+    (os.path.join(root_folder, "script_version_2", "script.py"), "campaigns",
+     ["--campaigns", os.path.join(root_folder, "campaigns.json")]),
 ]
 
-# Функция для запуска одного скрипта с задержкой
-def run_script(script, index_name=None, delay=0):
-    try:
-        print(f"Запуск {script} с задержкой {delay} секунд...")
-        time.sleep(delay)
-        if index_name:
-            result = subprocess.run(["python", script, "--index_name", index_name], check=True, capture_output=True, text=True)
-        else:
-            result = subprocess.run(["python", script], check=True, capture_output=True, text=True)
-        print(f"{script} завершён успешно с результатом: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        print(f"Ошибка при выполнении {script}: {e}")
-        print(f"Вывод ошибки: {e.stderr}")
-    except FileNotFoundError:
-        print(f"Скрипт {script} не найден.")
-
-# Запуск всех скриптов параллельно с задержкой
+# Настройки супервизора (из окружения или .env)
+load_dotenv()
+LOG_DIR = os.getenv("SUPERVISOR_LOG_DIR", os.path.join(root_folder, "process_logs"))
+LOG_MAX_BYTES = int(os.getenv("SUPERVISOR_LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("SUPERVISOR_LOG_BACKUP_COUNT", 5))
+# Сколько секунд ждать первого пульса нового процесса, прежде чем запускать следующий
+START_TIMEOUT = float(os.getenv("SUPERVISOR_START_TIMEOUT", 60))
+# Процесс без пульса дольше этого времени считается зависшим и перезапускается
+HEARTBEAT_TIMEOUT = float(os.getenv("SUPERVISOR_HEARTBEAT_TIMEOUT", 120))
+RESTART_BACKOFF_MAX = float(os.getenv("SUPERVISOR_RESTART_BACKOFF_MAX", 300))
+# Процесс, проработавший дольше этого времени, считается стабильным — пауза перед перезапуском сбрасывается
+STABLE_AFTER = float(os.getenv("SUPERVISOR_STABLE_AFTER", 600))
+STOP_TIMEOUT = float(os.getenv("SUPERVISOR_STOP_TIMEOUT", 30))
+# Каждый скрипт — один асинхронный процесс, поэтому по умолчанию не больше одного на ядро
+MAX_WORKERS = int(os.getenv("SUPERVISOR_MAX_WORKERS", 0)) or (os.cpu_count() or 1)
+
+logger = logging.getLogger("supervisor")
+
+
+def create_output_logger(name):
+    """Логгер с ротацией файла для вывода одного дочернего процесса."""
+    output_logger = logging.getLogger(f"supervisor.output.{name}")
+    output_logger.propagate = False
+    if not output_logger.handlers:
+        handler = RotatingFileHandler(
+            os.path.join(LOG_DIR, f"{name}.log"), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        )
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        output_logger.addHandler(handler)
+        output_logger.setLevel(logging.INFO)
+    return output_logger
+
+
+class Worker:
+    """Дочерний процесс под наблюдением: запуск, пульс, перезапуск с нарастающей паузой."""
+
+    def __init__(self, script, name=None, args=()):
+        self.script = script
+        self.args = list(args)
+        self.name = name or os.path.splitext(os.path.basename(script))[0]
+        self.heartbeat_file = os.path.join(LOG_DIR, f"{self.name}.heartbeat")
+        self.output = create_output_logger(self.name)
+        self.process = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.backoff = 1.0
+        self.restarts = 0
+
+    def command(self):
+        return [sys.executable, self.script] + self.args
+
+    def start(self):
+        if os.path.exists(self.heartbeat_file):
+            os.remove(self.heartbeat_file)
+        env = dict(os.environ, HEARTBEAT_FILE=self.heartbeat_file, PYTHONUNBUFFERED="1")
+        logger.info(f"Запуск {self.name}: {' '.join(self.command())}")
+        # Вывод процесса читается построчно и сразу пишется в файл, а не копится в памяти
+        self.process = subprocess.Popen(
+            self.command(), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+            text=True, encoding='utf-8', errors='replace', bufsize=1
+        )
+        self.started_at = time.monotonic()
+        threading.Thread(target=self._pump_output, args=(self.process,), daemon=True).start()
+
+    def _pump_output(self, process):
+        for line in process.stdout:
+            self.output.info(line.rstrip('\n'))
+        process.stdout.close()
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def last_heartbeat(self):
+        """Время последнего пульса в секундах назад или None, если пульса ещё не было."""
+        try:
+            return time.time() - os.path.getmtime(self.heartbeat_file)
+        except OSError:
+            return None
+
+    def starting(self):
+        """Процесс запущен, но ещё не прислал первый пульс и не вышел за время запуска."""
+        return (self.running() and self.last_heartbeat() is None
+                and time.monotonic() - self.started_at < START_TIMEOUT)
+
+    def check(self):
+        """Проверяет процесс: упавший планируется к перезапуску, зависший завершается."""
+        if self.process is None or self.restart_at:
+            return
+        code = self.process.poll()
+        if code is None:
+            age = self.last_heartbeat()
+            uptime = time.monotonic() - self.started_at
+            if age is None and uptime > HEARTBEAT_TIMEOUT:
+                logger.warning(f"{self.name} не прислал пульс за {uptime:.0f} сек, перезапускаем")
+                self.stop()
+            elif age is not None and age > HEARTBEAT_TIMEOUT:
+                logger.warning(f"{self.name} не присылал пульс {age:.0f} сек, перезапускаем")
+                self.stop()
+            else:
+                return
+            code = self.process.returncode
+
+        uptime = time.monotonic() - self.started_at
+        if uptime > STABLE_AFTER:
+            self.backoff = 1.0
+        self.restarts += 1
+        self.restart_at = time.monotonic() + self.backoff
+        logger.error(f"{self.name} завершился с кодом {code} после {uptime:.0f} сек работы, "
+                     f"перезапуск №{self.restarts} через {self.backoff:.0f} сек")
+        self.backoff = min(self.backoff * 2, RESTART_BACKOFF_MAX)
+
+    def restart_due(self):
+        return self.restart_at and time.monotonic() >= self.restart_at
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Посылает SIGTERM и ждёт завершения; по истечении времени завершает процесс принудительно."""
+        if not self.running():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{self.name} не завершился за {timeout:.0f} сек, завершаем принудительно")
+            self.process.kill()
+            self.process.wait()
+
+
+def create_workers():
+    workers = [Worker(tgbot_script)]
+    for script, name, args in scripts:
+        if not os.path.exists(script):
+            logger.error(f"Скрипт {script} не найден.")
+            continue
+        workers.append(Worker(script, name, args))
+    if len(workers) - 1 > MAX_WORKERS:
+        logger.warning(f"Скриптов рассылки {len(workers) - 1}, а ядер под них {MAX_WORKERS}: "
+                       f"лишние не запускаются (SUPERVISOR_MAX_WORKERS)")
+        workers = workers[:MAX_WORKERS + 1]
+    return workers
+
+
+def supervise(workers, stop_event):
+    """Основной цикл: запуск по очереди, проверка пульса и перезапуск упавших процессов."""
+    pending = list(workers)
+    while not stop_event.is_set():
+        # Следующий процесс запускается, когда предыдущий прислал первый пульс, а не через фиксированную паузу
+        if pending and not any(worker.starting() for worker in workers):
+            pending.pop(0).start()
+
+        for worker in workers:
+            worker.check()
+            if worker.restart_due() and not stop_event.is_set():
+                worker.restart_at = 0.0
+                worker.start()
+
+        stop_event.wait(1)
+
+
+def shutdown(workers):
+    logger.info("Остановка всех процессов...")
+    for worker in workers:
+        if worker.running():
+            worker.process.terminate()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for worker in workers:
+        worker.stop(timeout=max(0.0, deadline - time.monotonic()))
+    logger.info("Все процессы остановлены")
+
+
+# Запуск всех скриптов под наблюдением супервизора
 if __name__ == "__main__":
-    with ThreadPoolExecutor(max_workers=len(scripts) + 1) as executor:
-        # Запуск tgbot.py без index_name
-        executor.submit(run_script, tgbot_script, delay=0)
-
-        # Запуск остальных скриптов с index_name
-        for i, (script, index_name) in enumerate(scripts):
-            delay = (i + 1) * 30  # Увеличение задержки для каждого последующего скрипта
-            executor.submit(run_script, script, index_name, delay)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            RotatingFileHandler(os.path.join(LOG_DIR, "supervisor.log"), maxBytes=LOG_MAX_BYTES,
+                                backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+        ]
+    )
+
+    stop_event = threading.Event()
+
+    def on_signal(signum, frame):
+        logger.info(f"Получен сигнал {signal.Signals(signum).name}")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    workers = create_workers()
+    try:
+        supervise(workers, stop_event)
+    finally:
+        shutdown(workers)
@@ -5,35 +5,52 @@ import openai
 import asyncpg
 from dotenv import load_dotenv
 from pyrogram import Client
-import pandas as pd
-from asyncpg import exceptions
 import argparse
-from datetime import datetime, timedelta
-import re
-from collections import defaultdict
-import json  # Добавлено для работы с JSON
+import sys
+import time
 import random
 
 
-# Инициализация контекста и словаря сообщений для каждого пользователя
-context = defaultdict(list)
-user_messages = defaultdict(list)
-timers = {}
+# Корневая папка проекта, чтобы импортировать общие модули из common/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.lead_source import get_lead_source
+from common.lead_queue import create_leads_table, import_leads, claim_lead
+from common.db import create_db_pool
+from common.stats_writer import StatsWriter
+from common.stats_counters import create_counters
+from common.llm_client import get_llm_client, LLMError, paragraphs
+from common.dialog_context import DialogContext
+from common.dialog_store import DialogStore, create_dialog_state_table
+from common.timer_wheel import TimerWheel
+from common.account_pool import AccountPool
+from common.supervision import start_heartbeat, cancel_on_sigterm
+from common.transcripts import TranscriptWriter
+from common.log_setup import setup_logging, set_log_dialog, log_payload
+from common.metrics import start_metrics_server, MESSAGES_SENT, DEBOUNCE_WAIT
+from common.triggers import Triggers
+
+# Таймеры ответа и напоминаний всех пользователей обслуживает одно колесо таймеров (запускается в main)
+timer_wheel = TimerWheel()
+# Когда пришло первое из ещё не отвеченных сообщений (для метрики ожидания ответа)
+debounce_started = {}
+# Состояние диалогов (история, этап промпта, статистика) хранится в Postgres
+# и подгружается при новом сообщении пользователя (создаётся в main)
+dialogs = None
+# Аккаунты для первых сообщений с дневной квотой и паузами после FloodWait (создаётся в main)
+account_pool = None
+# Отложенная запись статистики в user_stats (создаётся в main)
+stats_writer = None
+# В запрос к нейросети уходят конспект старой части диалога и последние реплики, а не вся история
+dialog_context = DialogContext()
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Настройка логгера
+# Настройка логгера: записи уходят в очередь, в файл и консоль их пишет отдельный поток
+# (уровень и формат — LOG_LEVEL и LOG_FORMAT в .env)
 log_filename = os.path.join(os.path.dirname(__file__), 'script_logs.txt')
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging(log_filename)
 
 # Загрузка аргументов командной строки
 parser = argparse.ArgumentParser(description="Запуск скрипта с уникальным именем индекса")
@@ -47,12 +64,32 @@ EXCEL_FILE = '/yourpath/usernames.xlsx'
 COLUMN_NAME = 'Script1'
 COLUMN_NAME = 'Script1name'
 BATCH_SIZE = 4
+# Ответ уходит пользователю по абзацам, пока модель дописывает остальные (STREAM_REPLIES=1 в .env)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+# Темп первых сообщений на аккаунт по умолчанию — 4 в день, раз в час (ACCOUNT_DAILY_QUOTA и SEND_RATE_PER_HOUR в .env)
+ACCOUNT_DAILY_QUOTA = int(os.getenv("ACCOUNT_DAILY_QUOTA", 4))
+SEND_RATE_PER_HOUR = float(os.getenv("SEND_RATE_PER_HOUR", 1))
+
+# Триггеры в ответах модели: подстрока без учёта регистра -> действие.
+# Собираются в один автомат при запуске и проверяются за один проход по ответу
+TRIGGERS = [
+    # Отправлена ссылка на вебинар
+    {"match": ["https://pvvk.ru/veb"], "action": "sensitive_info"},
+    {"match": ["прочитать наш гайд"], "action": "send_message", "text": (
+        "Конечно сложно уместить в гайд всю важность употребления качественной воды для нашего организма, "
+        "поэтому предлагаю посетить наш бесплатный вебинар, чтобы узнать больше информации о нашей компании, "
+        "а также об отличиях разных фильтров и принципов работы.\n\n"
+        "Подскажите, вам было бы интересно посетить наш вебинар?"
+    )},
+]
+triggers = Triggers(TRIGGERS)
 
 # Путь к директории логов
 LOGS_DIR = '/yourpath/Logs'
-os.makedirs(LOGS_DIR, exist_ok=True)
+# Файлы диалогов дописываются в отдельном потоке только новыми репликами (поток запускается в main)
+transcripts = TranscriptWriter(LOGS_DIR)
 
-# Асинхронное подключение к базе данных PostgreSQL
+# Асинхронное подключение к базе данных PostgreSQL (для разовых операций, остальная работа идёт через пул)
 async def create_db_connection():
     return await asyncpg.connect(
         database=os.getenv("DB_NAME"),
@@ -88,6 +125,10 @@ async def create_tables():
         current_index INT DEFAULT 0
     );
     """)
+    await create_leads_table(conn)
+    # Счётчики воронки для бота статистики, обновляются триггерами на user_stats
+    await create_counters(conn)
+    await create_dialog_state_table(conn)
     await conn.close()
 
 # Вызов функции создания таблиц
@@ -95,70 +136,45 @@ async def initialize_tables():
     await create_tables()
 
 # Функция для получения текущего индекса из базы данных
-async def get_current_index(conn, index_name):
-    row = await conn.fetchrow("""
+async def get_current_index(pool, index_name):
+    row = await pool.fetchrow("""
         SELECT current_index FROM processing_index WHERE index_name=$1;
     """, index_name)
     if row:
-        print(f"Индекс найден для {index_name}: {row['current_index']}")
+        logging.info(f"Индекс найден для {index_name}: {row['current_index']}")
         return row['current_index']
     else:
-        print(f"Индекс не найден для {index_name}, создаем новый.")
-        await conn.execute("""
+        logging.info(f"Индекс не найден для {index_name}, создаем новый.")
+        await pool.execute("""
             INSERT INTO processing_index (index_name, current_index) VALUES ($1, 0)
             ON CONFLICT (index_name) DO NOTHING;
-        """, index_name)
+        """, index_name, retry=True)
         return 0
 
-# Функция для обновления индекса в базе данных
-async def update_current_index(conn, new_index, index_name):
-    await conn.execute("""
-        UPDATE processing_index SET current_index=$1 WHERE index_name=$2;
-    """, new_index, index_name)
-    print(f"Индекс обновлен для {index_name}: {new_index}")
-
 # Асинхронная функция для обновления статистики
-async def log_and_update_stats_db(conn, username, user_replied, message_count, sensitive_info_sent,
+# Запись отложенная: обновления копятся в stats_writer и уходят в базу пачкой раз в STATS_FLUSH_INTERVAL_MS
+async def log_and_update_stats_db(username, user_replied, message_count, sensitive_info_sent,
                                   initial_message_sent, qualification=None, summary=None,
                                   monthly_budget=None, consultation_agreed=None):
-    try:
-        print(f"Запись в БД: username={username}, user_replied={user_replied}, message_count={message_count}, "
-              f"sensitive_info_sent={sensitive_info_sent}, initial_message_sent={initial_message_sent}, "
-              f"qualification={qualification}, summary={summary}, monthly_budget={monthly_budget}, "
-              f"consultation_agreed={consultation_agreed}")
-        await conn.execute("""
-            INSERT INTO user_stats (
-                username, user_replied, message_count, sensitive_info_sent, 
-                initial_message_sent, qualification, summary, monthly_budget, 
-                consultation_agreed
-            )
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-            ON CONFLICT (username) 
-            DO UPDATE SET 
-                user_replied = EXCLUDED.user_replied,
-                message_count = EXCLUDED.message_count,
-                sensitive_info_sent = EXCLUDED.sensitive_info_sent,
-                initial_message_sent = EXCLUDED.initial_message_sent,
-                qualification = EXCLUDED.qualification,
-                summary = EXCLUDED.summary,
-                monthly_budget = EXCLUDED.monthly_budget,
-                consultation_agreed = EXCLUDED.consultation_agreed,
-                updated_at = CURRENT_TIMESTAMP;
-        """, username, user_replied, message_count, sensitive_info_sent, initial_message_sent,
-           qualification, summary, monthly_budget, consultation_agreed)
-    except exceptions.PostgresError as e:
-        print(f"Ошибка при записи в базу данных: {e}")
-
-# Функция для чтения одного юзернейма из Excel файла
-def load_single_username_from_excel(username_column, name_column, start_index):
-    df = pd.read_excel(EXCEL_FILE)
-    usernames = df[username_column].dropna().tolist()
-    names = df[name_column].dropna().tolist()
-
-    if start_index >= len(usernames):
-        return None, None, start_index
-
-    return usernames[start_index], names[start_index], start_index + 1
+    stats_writer.update(
+        username,
+        user_replied=user_replied,
+        message_count=message_count,
+        sensitive_info_sent=sensitive_info_sent,
+        initial_message_sent=initial_message_sent,
+        qualification=qualification,
+        summary=summary,
+        monthly_budget=monthly_budget,
+        consultation_agreed=consultation_agreed
+    )
+
+# Функция для загрузки новых лидов из Excel (или CSV) файла в общую очередь leads
+# Лиды до старого курсора processing_index считаются уже обработанными
+async def load_leads_to_queue(pool, username_column, name_column, index_name):
+    lead_source = get_lead_source(EXCEL_FILE, username_column, name_column)
+    start_index = await get_current_index(pool, index_name)
+    async with pool.acquire() as conn:
+        return await import_leads(conn, index_name, lead_source, sent_before=start_index)
 
 
 
@@ -252,289 +268,291 @@ prompt_template_1 = [
 ]
 
 
-def validate_messages(messages):
-    if not isinstance(messages, list):
-        raise ValueError("Expected 'messages' to be a list.")
-    for msg in messages:
-        if not isinstance(msg, dict):
-            raise ValueError("Each message should be a dictionary.")
-        if "role" not in msg or "content" not in msg:
-            raise ValueError("Each message dictionary should contain 'role' and 'content'.")
+# Ответ-заглушка, если нейросеть так и не ответила
+FALLBACK_ANSWER = "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
+
+# Общий вызов нейросети: один клиент на процесс с keep-alive, лимитами RPM/TPM и повторами с паузой
+async def ask_model(full_context, max_retries, temperature, top_p, label="get_4o_answer"):
+    try:
+        content = await get_llm_client().complete(
+            full_context,
+            max_retries=max_retries,
+            temperature=temperature,
+            top_p=top_p,
+            label=label
+        )
+    except LLMError as e:
+        logging.error(f"Не удалось получить ответ от модели: {e}")
+        return FALLBACK_ANSWER
+    content = content.strip()
+    log_payload("Ответ от модели", content)  # Полный текст — только на уровне DEBUG
+    return content
 
 # Обновленная функция для получения ответа от нейросети 1
 async def get_4o_answer(messages, max_retries=3, temperature=0.7, top_p=0.6):
-    retries = 0
     # Объединяем начальный промпт с контекстом сообщений
     full_context = prompt_template_1.copy()
     full_context.extend(messages)
 
-    print(f"Запускаем get_4o_answer с контекстом: {full_context}")  # Лог перед отправкой в API
-    while retries < max_retries:
-        try:
-            print(f"Попытка #{retries + 1} отправки запроса к OpenAI API")  # Лог попытки вызова API
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-4o-mini",
-                messages=full_context,
-                temperature=temperature,
-                top_p=top_p
-            )
-            content = response['choices'][0]['message']['content'].strip()
-            print(f"Ответ от модели: {content}")  # Логируем ответ
-            return content
-        except openai.error.RateLimitError as e:
-            print(f"Превышен лимит запросов к OpenAI API: {e}")
-            retries += 1
-        except openai.error.APIConnectionError as e:
-            print(f"Ошибка подключения к OpenAI API: {e}")
-            retries += 1
-        except openai.error.InvalidRequestError as e:
-            print(f"Некорректный запрос к OpenAI API: {e}")
-            break
-        except Exception as e:
-            print(f"Неизвестная ошибка при запросе к OpenAI API: {e}")
-            retries += 1
+    log_payload("Запрос к модели get_4o_answer", full_context)  # Контекст запроса — только на уровне DEBUG
+    return await ask_model(full_context, max_retries, temperature, top_p)
+
+
+# Потоковый ответ: каждый готовый абзац сразу уходит пользователю и добавляется в sent, пока модель пишет следующие
+async def stream_answer(client, username, messages, sent, max_retries=3, temperature=0.7, top_p=0.6):
+    full_context = prompt_template_1.copy()
+    full_context.extend(messages)
+    log_payload("Запрос к модели get_4o_answer", full_context)  # Контекст запроса — только на уровне DEBUG
 
-    print(f"Не удалось получить ответ после {retries} попыток")
-    return "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
+    try:
+        async for paragraph in paragraphs(get_llm_client().stream(
+                full_context, max_retries=max_retries, temperature=temperature, top_p=top_p, label="get_4o_answer")):
+            await client.send_message(username, paragraph)
+            MESSAGES_SENT.inc(campaign=index_name, kind="reply")
+            sent.append(paragraph)
+    except LLMError as e:
+        logging.error(f"Не удалось получить ответ от модели: {e}")
+        # Если пользователь ещё ничего не получил, отвечаем заглушкой; начало ответа уже не отзываем
+        return "\n\n".join(sent) if sent else FALLBACK_ANSWER
 
+    content = "\n\n".join(sent)
+    log_payload("Ответ от модели", content)  # Полный текст — только на уровне DEBUG
+    return content
 
 
 
-# Функция для сохранения диалога в файл
-def save_dialog_to_file(username, messages):
-    user_log_file = os.path.join(LOGS_DIR, f"{username}.txt")
-    with open(user_log_file, 'a', encoding='utf-8') as file:
-        for message in messages:
-            file.write(f"{message['role'].capitalize()}: {message['content']}\n\n")
 
 # Функция для отправки приветственного сообщения и запуска таймера
-async def send_message(client, username, client_name, context, conn):
+async def send_message(account, username, client_name):
+    client = account.client
+    set_log_dialog(index_name, username)
     try:
         # Случайный выбор приветственного сообщения
         initial_message = random.choice(initial_messages)
         personalized_message = initial_message.replace('Script1name', client_name)
 
-        logging.info(f"Отправка сообщения пользователю {username}: {personalized_message}")
+        logging.info(f"Отправка сообщения пользователю {username}")
+        log_payload("Текст первого сообщения", personalized_message)
 
-        # Инициализация статистики в context
-        if 'stats' not in context:
-            context['stats'] = {}
+        # Вызывается внутри транзакции claim_lead: здесь только запрос к Telegram, без второго соединения с базой
+        await client.send_message(username, personalized_message)
+        MESSAGES_SENT.inc(campaign=index_name, kind="initial")
+        account_pool.record_sent(account)
+        logging.info(f"Приветственное сообщение успешно отправлено пользователю {username} с аккаунта {account.name}")
+        return True
+    except Exception as e:
+        # FloodWait/PeerFlood ставят аккаунт на паузу, а лид возвращается в очередь (None)
+        if account_pool.report_error(client, e):
+            logging.warning(f"Аккаунт {account.name} не смог написать пользователю {username}: {e}")
+            return None
+        logging.error(f"Ошибка при отправке сообщения пользователю {username}: {e}")
+        return False
 
-        if username not in context['stats']:
-            context['stats'][username] = {
-                "user_replied": False,
-                "message_count": 0,
-                "sensitive_info_sent": False,
-                "initial_message_sent": True,
-                "reminder_sent": False
-            }
 
-        await client.send_message(username, personalized_message)
-        logging.info(f"Приветственное сообщение успешно отправлено пользователю {username}")
+# Диалог после отправки первого сообщения: состояние, статистика и таймер напоминания.
+# Вызывается после того, как статус лида зафиксирован и соединение очереди вернулось в пул
+async def start_dialog(account, username, pool):
+    set_log_dialog(index_name, username)
+    try:
+        # Состояние диалога создаётся при первой отправке; диалог закрепляется за аккаунтом
+        state = await dialogs.get(username)
+        state["account"] = account.name
+        stats = state["stats"]
+        stats["initial_message_sent"] = True
+        dialogs.mark_dirty(username)
 
         # Логирование в базу данных
         await log_and_update_stats_db(
-            conn,
             username=username,
             user_replied=False,
-            message_count=context['stats'][username].get('message_count', 0) + 1,
+            message_count=stats.get('message_count', 0) + 1,
             sensitive_info_sent=False,
             initial_message_sent=True
         )
 
         # Таймер для напоминания
-        asyncio.create_task(reminder_timer(client, username, context, conn))
-        await asyncio.sleep(1)
+        timer_wheel.schedule(("reminder", username), 7200, reminder_timer, account.client, username, pool)
     except Exception as e:
-        logging.error(f"Ошибка при отправке сообщения пользователю {username}: {e}")
+        logging.error(f"Ошибка при сохранении диалога после первого сообщения пользователю {username}: {e}")
 
 
-# Функция, запускающая таймер на 2 часа
-async def reminder_timer(client, username, context, conn):
+# Напоминание пользователю, который не ответил (вызывается колесом таймеров)
+async def reminder_timer(client, username, pool):
+    set_log_dialog(index_name, username)
     reminder_message = (
         "Хотелось бы задать вам буквально пару вопросов. Это не займет много времени\n"
         "Буду рада вашему ответу!"
     )
     try:
-        # Ждем 2 часа (7200 секунд)
-        await asyncio.sleep(7200)
-
         # Проверяем, если пользователь не ответил и напоминание еще не отправлено
-        if not context['stats'][username]['user_replied'] and not context['stats'][username]['reminder_sent']:
+        # Диалог могли выгрузить из памяти за время ожидания — подгружаем из базы
+        stats = (await dialogs.get(username))["stats"]
+        if not stats['user_replied'] and not stats['reminder_sent']:
             await client.send_message(username, reminder_message)
-            context['stats'][username]['reminder_sent'] = True
+            MESSAGES_SENT.inc(campaign=index_name, kind="reminder")
+            stats['reminder_sent'] = True
+            dialogs.mark_dirty(username)
             # Логируем отправку напоминания в базу данных
             await log_and_update_stats_db(
-                conn,
                 username=username,
                 user_replied=False,
-                message_count=context['stats'][username].get('message_count', 0),
+                message_count=stats.get('message_count', 0),
                 sensitive_info_sent=False,
-                initial_message_sent=context['stats'][username].get('initial_message_sent', False)
+                initial_message_sent=stats.get('initial_message_sent', False)
             )
     except asyncio.CancelledError:
         # Если таймер был отменен, просто выходим
         return
-
-context = {}
+    except Exception as e:
+        account_pool.report_error(client, e)
+        logging.error(f"Ошибка при отправке напоминания пользователю {username}: {e}")
 
 # Обработчик ответов от пользователей
-async def handle_response(client, context, conn):
+async def handle_response(client, pool):
     @client.on_message()
     async def on_message(client, message):
-        print("Получено сообщение от пользователя")
         username = message.chat.username if message.chat.username else "unknown_user"
+        set_log_dialog(index_name, username)
+        logging.debug("Получено сообщение от пользователя")
 
-        # Проверяем, если пользователь уже есть в статистике
-        if username in context['stats']:
-            context['stats'][username]['user_replied'] = True
+        # Состояние диалога подгружается из базы, если его нет в памяти
+        state = await dialogs.get(username)
+        stats = state['stats']
+        stats['user_replied'] = True
+        dialogs.mark_dirty(username)
 
 
-        # Если таймер на напоминание существует, отменяем его
-        if username in timers:
-            timers[username].cancel()
-            del timers[username]
+        # Пользователь ответил — напоминание больше не нужно
+        timer_wheel.cancel(("reminder", username))
 
         # Логируем ответ пользователя в базу данных
         await log_and_update_stats_db(
-            conn,
             username=username,
             user_replied=True,
-            message_count=context['stats'][username].get('message_count', 0) + 1,
+            message_count=stats.get('message_count', 0) + 1,
             sensitive_info_sent=False,
-            initial_message_sent=context['stats'][username].get('initial_message_sent', False)
+            initial_message_sent=stats.get('initial_message_sent', False)
         )
 
         # Проверка на тип сообщения (голосовое сообщение, стикеры и т.д.)
         if message.voice or message.video_note:
-            print(f"Пользователь {username} отправил неподдерживаемый тип сообщения.")
+            logging.info(f"Пользователь {username} отправил неподдерживаемый тип сообщения.")
             ai_response = "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
             await client.send_message(username, ai_response)
+            MESSAGES_SENT.inc(campaign=index_name, kind="reply")
             return
 
         if message.sticker:
-            print(f"Пользователь {username} отправил стикер.")
+            logging.info(f"Пользователь {username} отправил стикер.")
             ai_response = "Извините, мне сейчас неудобно обрабатывать стикеры. Можете написать текстом?"
             await client.send_message(username, ai_response)
+            MESSAGES_SENT.inc(campaign=index_name, kind="reply")
             return
 
-        # Инициализация контекста для нового пользователя
-        if username not in context:
-            print(f"Инициализация контекста для {username}")
-            context[username] = []
-
-        # Добавляем сообщение пользователя в буфер (user_messages)
-        user_messages[username].append({"role": "user", "content": message.text})
+        # Добавляем сообщение пользователя в буфер ещё не отвеченных сообщений
+        state["pending"].append({"role": "user", "content": message.text})
+        dialogs.mark_dirty(username)
 
         # Сбрасываем таймер на 15 секунд, после которого будет отправлен ответ
-        await reset_timer(username, client, conn)
+        await reset_timer(username, client, pool)
 
 # Функция для сброса и обновления таймера
-async def reset_timer(username, client, conn):
-    # Проверяем, есть ли активный таймер для пользователя, и отменяем его
-    if username in timers:
-        print(f"Сбрасываем таймер для пользователя {username}")
-        timers[username].cancel()  # Отменяем предыдущий таймер
+async def reset_timer(username, client, pool):
+    # Если таймер уже идёт или ответ ещё формируется, сбрасываем его
+    if timer_wheel.cancel(("reply", username), running=True):
+        logging.debug("Сбрасываем таймер для пользователя %s", username)
 
-    # Запускаем новый таймер
-    timers[username] = asyncio.create_task(start_timer(username, client, conn))
+    # Ответ формируется через 15 секунд после последнего сообщения
+    debounce_started.setdefault(("reply", username), time.monotonic())
+    timer_wheel.schedule(("reply", username), 15, start_timer, username, client, pool)
 
 # Обновление функции start_timer для анализа и переключения на следующий промпт
-async def start_timer(username, client, conn):
-    print(f"Запускаем таймер для пользователя {username} на 15 секунд")
-    await asyncio.sleep(15)  # Ожидаем 15 секунд
-
-
-# Проверка и инициализация context['stats'] для пользователя
-    if 'stats' not in context:
-        context['stats'] = {}
-
-# Проверка, есть ли уже запись для пользователя; если да, сохраняем текущие значения
-    if username not in context['stats']:
-        context['stats'][username] = {
-            "user_replied": False,
-            "message_count": 0,
-            "sensitive_info_sent": False,
-            "initial_message_sent": True,
-            "reminder_sent": False
-        }
-    else:
-    # Сохраняем текущие значения, если запись для пользователя существует
-        current_stats = context['stats'][username]
-        context['stats'][username] = {
-            "user_replied": current_stats.get("user_replied", False),
-            "message_count": current_stats.get("message_count", 0),
-            "sensitive_info_sent": current_stats.get("sensitive_info_sent", False),
-            "initial_message_sent": current_stats.get("initial_message_sent", True),
-            "reminder_sent": current_stats.get("reminder_sent", False)
-        }
-
-
-    if username in user_messages and user_messages[username]:
-        print(f"Таймер для пользователя {username} истек. Формируем запрос к нейросети.")
-
-        # Инициализация контекста, если это новый пользователь
-        if username not in context:
-            context[username] = {
-                "messages": [],
-                "use_alternate_prompt": False,
-                "in_secondary_prompt": False,
-                "current_prompt": 1  # Начинаем с первого промпта
-            }
-
-        # Добавляем временные сообщения в основной контекст
-        context[username]["messages"].extend(user_messages[username])
-        user_messages[username].clear()  # Очищаем временный буфер сообщений
-
-        save_dialog_to_file(username, context[username]["messages"])  # Сохраняем сообщения пользователя
-
+# (вызывается колесом таймеров, когда истекло окно склейки сообщений)
+async def start_timer(username, client, pool):
+    set_log_dialog(index_name, username)
+    state = await dialogs.get(username)
+    stats = state["stats"]
+
+    # Сколько пользователь ждал ответа с первого неотвеченного сообщения
+    started = debounce_started.pop(("reply", username), None)
+    if started is not None:
+        DEBOUNCE_WAIT.observe(time.monotonic() - started, campaign=index_name)
+
+    if state["pending"]:
+        logging.debug("Таймер для пользователя %s истек. Формируем запрос к нейросети.", username)
+
+        # Переносим буфер сообщений в историю диалога
+        state["messages"].extend(state["pending"])
+        state["pending"].clear()
+        dialogs.mark_dirty(username)
+
+        # Абзацы ответа, которые в потоковом режиме уже ушли пользователю
+        sent = []
+        answered = False
         try:
-            # Получение ответа от нейросети
-            ai_response = await get_4o_answer(context[username]["messages"])
+            # Получение ответа от нейросети (в потоковом режиме абзацы уже отправлены пользователю)
+            if STREAM_REPLIES:
+                ai_response = await stream_answer(client, username, dialog_context.history(state), sent)
+            else:
+                ai_response = await get_4o_answer(dialog_context.history(state))
 
 
-            # Проверка наличия ссылки на менеджера в ответе
-            sensitive_info_sent = "https://pvvk.ru/veb" in ai_response
+            # Все триггеры ответа находятся за один проход (в том числе ссылка на вебинар)
+            actions = triggers.match(ai_response)
+            sensitive_info_sent = any(action["action"] == "sensitive_info" for action in actions)
 
 
             # Отправляем ответ пользователю и добавляем в контекст
             if ai_response:
-                print(f"Отправляем ответ пользователю {username}: {ai_response}")
-                await client.send_message(username, ai_response)
-                context[username]["messages"].append({"role": "assistant", "content": ai_response})
+                logging.info(f"Отправляем ответ пользователю {username}")
+                log_payload("Ответ пользователю", ai_response)
+                # Потоковый ответ уже ушёл по абзацам; целиком отправляем обычный ответ и заглушку
+                if "\n\n".join(sent) != ai_response:
+                    await client.send_message(username, ai_response)
+                    MESSAGES_SENT.inc(campaign=index_name, kind="reply")
+                state["messages"].append({"role": "assistant", "content": ai_response})
+                answered = True
+                # Старые реплики сворачиваются в конспект в фоне, ответ пользователю не ждёт
+                dialog_context.schedule_summary(username, state, on_update=lambda key, _: dialogs.mark_dirty(key))
 
 
             # Обновляем sensitive_info_sent в контексте
-            context['stats'][username]['sensitive_info_sent'] = sensitive_info_sent
+            stats['sensitive_info_sent'] = sensitive_info_sent
 
             # Логирование в базу данных после отправки ответа
             await log_and_update_stats_db(
-                conn,
                 username=username,
                 user_replied=True,
-                message_count=context['stats'][username].get('message_count', 0) + 1,
+                message_count=stats.get('message_count', 0) + 1,
                 sensitive_info_sent=sensitive_info_sent,
-                initial_message_sent=context['stats'][username].get('initial_message_sent', False)
+                initial_message_sent=stats.get('initial_message_sent', False)
             )
 
 
-            if any(keyword in ai_response.lower() for keyword in ["прочитать наш гайд"]):
-                print(f"Найдено упоминание 'КП'. Отправляем документ.")
-                await client.send_message(
-                    chat_id=username,
-                    text=("Конечно сложно уместить в гайд всю важность употребления качественной воды для нашего организма, "
-                          "поэтому предлагаю посетить наш бесплатный вебинар, чтобы узнать больше информации о нашей компании, "
-                          "а также об отличиях разных фильтров и принципов работы.\n\n"
-                          "Подскажите, вам было бы интересно посетить наш вебинар?")
-
-
-                )
-
-            
+            for action in actions:
+                if action["action"] == "send_message":
+                    logging.info(f"Найден триггер {action['match']}. Отправляем сообщение.")
+                    await client.send_message(chat_id=username, text=action["text"])
+                    MESSAGES_SENT.inc(campaign=index_name, kind="reply")
+                elif action["action"] == "send_document":
+                    logging.info(f"Найден триггер {action['match']}. Отправляем документ.")
+                    await client.send_document(chat_id=username, document=action["document"])
+
+        except asyncio.CancelledError:
+            # Новое сообщение прервало потоковый ответ: абзацы, которые пользователь уже видел, остаются в истории
+            if sent and not answered:
+                state["messages"].append({"role": "assistant", "content": "\n\n".join(sent)})
+                dialogs.mark_dirty(username)
+            raise
         except Exception as e:
-            print(f"Ошибка при получении ответа от модели для пользователя {username}: {e}")
+            account_pool.report_error(client, e)
+            logging.error(f"Ошибка при получении ответа от модели для пользователя {username}: {e}")
+
+        # Новые реплики дописываем в файл диалога, ход диалога записываем сразу, не дожидаясь фонового сброса
+        transcripts.append(username, state)
+        await dialogs.save(username)
     else:
-        print(f"Новое сообщение от пользователя {username} пришло, таймер сброшен.")
+        logging.debug("Новое сообщение от пользователя %s пришло, таймер сброшен.", username)
 
 
 
@@ -544,69 +562,96 @@ name_column = 'Script1name'
 
 # Основная функция выполнения программы
 async def main(index_name):
+    global stats_writer, dialogs, account_pool
     clients = []
-    context = {}
-    users_processed = 0
-    max_users_per_day = 4
-
-    conn = await create_db_connection()
+    # Под супервизором run.py: пульс для проверки живости и корректная остановка по SIGTERM
+    cancel_on_sigterm()
+    start_heartbeat()
+    # Метрики процесса в формате Prometheus на localhost (METRICS_PORT)
+    metrics_server = await start_metrics_server()
+    # Темп, дневная квота и часы рассылки задаются на каждый аккаунт (SEND_*, ACCOUNT_* в .env)
+    account_pool = AccountPool(daily_quota=ACCOUNT_DAILY_QUOTA, rate_per_hour=SEND_RATE_PER_HOUR)
+
+    # Общий пул соединений для рассылки, обработчика сообщений, таймеров и напоминаний
+    pool = await create_db_pool()
+    stats_writer = StatsWriter(pool).start()
+    timer_wheel.start()
+    transcripts.start()
+    # Диалог с запущенным таймером ответа обрабатывается и из памяти не выгружается
+    dialogs = DialogStore(pool, index_name, is_busy=lambda username: timer_wheel.is_active(("reply", username))).start()
+    await load_leads_to_queue(pool, username_column, name_column, index_name)
 
     for account in accounts:
         client = Client(account['session_name'])
         await client.start()
         clients.append(client)
+        account_pool.add(client, account['session_name'])
 
-        # Регистрация обработчика сообщений
-        asyncio.create_task(handle_response(clients[0], context, conn))
+        # Регистрация обработчика сообщений: пользователю отвечает тот аккаунт, которому он написал
+        asyncio.create_task(handle_response(client, pool))
+    account_pool.log_projection()
 
     try:
         while True:
-            if users_processed < max_users_per_day:
-                start_index = await get_current_index(conn, index_name)
-                logging.info(f"Текущий индекс в работе: {start_index}")  # Логируем индекс
-                
-                # Вызов функции и передача названий столбцов
-                username, client_name, next_index = load_single_username_from_excel(username_column, name_column, start_index)
-
-                if username and client_name:
-                    logging.info(f"Username взят в работу: {username}, Имя клиента: {client_name}")  # Логируем username и имя
-                    
-                    # Форматируем приветственное сообщение с использованием имени клиента
-                    initial_message = random.choice(initial_messages)
-                    
-                    # Отправляем сообщение
-                    await send_message(clients[0], username, client_name, context, conn)
-                    
-                    # Обновляем индекс
-                    await update_current_index(conn, next_index, index_name)
-                    
-                    users_processed += 1
-
-                    if users_processed < max_users_per_day:
-                        await asyncio.sleep(3600)  # Ждем 1200 сек 20 мин перед обработкой следующего пользователя
-                else:
+            # Записи лога рассылки помечаются кампанией, пока не взят очередной лид
+            set_log_dialog(index_name)
+            account = account_pool.pick()
+            if account is not None:
+                # Подгружаем в очередь новые строки, если файл с лидами изменился
+                await load_leads_to_queue(pool, username_column, name_column, index_name)
+
+                # Выборка лида, отправка и смена его статуса проходят в одной транзакции;
+                # состояние диалога и пауза — уже после неё, чтобы не держать соединение очереди
+                sent = False
+                async with pool.acquire() as conn, claim_lead(conn, index_name) as lead:
+                    if lead:
+                        username, client_name = lead['username'], lead['name']
+                        logging.info(f"Username взят в работу: {username}, Имя клиента: {client_name}")  # Логируем username и имя
+
+                        if client_name:
+                            # Отправляем сообщение (приветствие выбирается случайно внутри send_message)
+                            sent = await send_message(account, username, client_name)
+                            if sent is None:
+                                # Аккаунт получил ограничение Telegram — лид достанется следующему аккаунту
+                                lead['status'] = 'pending'
+                            else:
+                                lead['status'] = 'sent' if sent else 'failed'
+                        else:
+                            logging.info(f"У лида {username} не указано имя, пропускаем")
+                            lead['status'] = 'skipped'
+
+                if lead is None:
                     logging.info("Нет больше пользователей для обработки")
                     break
+                if sent:
+                    await start_dialog(account, lead['username'], pool)
+                    await asyncio.sleep(1)
             else:
-                now = datetime.now()
-                tomorrow = now + timedelta(days=1)
-                next_run_time = datetime(tomorrow.year, tomorrow.month, tomorrow.day, 11, 0, 0)
-
-                wait_time = (next_run_time - now).total_seconds()
-                logging.info(f"Все пользователи обработаны. Ждем до {next_run_time}")
-                await asyncio.sleep(wait_time)
-
-                users_processed = 0
+                # Ждём токен в бакете аккаунта, конец паузы после FloodWait, окно активности или сброс дневных квот
+                wait_time = account_pool.seconds_until_available()
+                logging.info(f"Нет аккаунтов, готовых к отправке. Ждем {wait_time:.0f} сек")
+                await asyncio.sleep(max(wait_time, 1))
 
         # Бесконечный цикл для удержания скрипта активным
         while True:
             await asyncio.sleep(4800)  # Периодически спим, чтобы не занимать ресурсы
     finally:
-        await conn.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        # Дописываем состояние диалогов и накопленную статистику перед закрытием пула
+        await timer_wheel.close()
+        await transcripts.close()
+        await dialogs.close()
+        await stats_writer.close()
+        await pool.close()
+        await get_llm_client().close()
         for client in clients:
             await client.stop()
 
 # Запуск скрипта с указанием уникального имени индекса
 if __name__ == "__main__":
     asyncio.run(initialize_tables())  # Инициализируем таблицы перед запуском main
-    asyncio.run(main(index_name))
+    try:
+        asyncio.run(main(index_name))
+    except asyncio.CancelledError:
+        logging.info("Скрипт остановлен")
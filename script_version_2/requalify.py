@@ -0,0 +1,215 @@
+"""Анализ квалификации по уже записанным диалогам, без рассылки.
+
+    python script_version_2/requalify.py --logs /yourpath/Logs --concurrency 8
+    python script_version_2/requalify.py --campaign my_campaign --campaigns campaigns.json
+
+В разговоре квалификация считается только после #спасибо, поэтому у многих законченных
+диалогов в user_stats пусто. Скрипт берёт диалоги из файлов Logs/ или из таблицы
+dialog_state кампании, пропускает тех, у кого квалификация уже есть, и прогоняет остальных
+через analyze_qualification не больше --concurrency одновременно (лимиты OPENAI_RPM и
+OPENAI_TPM действуют как в рассылке). Результаты пишутся пачками через
+update_database_with_analysis, после каждой пачки обработанные пользователи дописываются
+в файл --checkpoint: повторный запуск продолжает с того же места.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import sys
+
+import script
+from common.llm_client import get_llm_client
+from common.transcripts import collapse_repeated_history, parse_transcript, read_transcript
+
+
+def logs_dialogs(directory):
+    """Диалоги из файлов <каталог>/<username>.txt: (username, история в формате state["messages"])."""
+    for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+        username = os.path.basename(path)[:-len(".txt")]
+        try:
+            text = read_transcript(path)
+        except OSError as e:
+            logging.error(f"Не удалось прочитать файл диалога {path}: {e}")
+            continue
+        # В старых файлах история повторяется на каждом ходу — в анализ идёт одна её копия
+        messages = collapse_repeated_history(parse_transcript(text))
+        yield username, [{"role": role, "content": content} for role, content in messages if content]
+
+
+async def stored_dialogs(pool, campaign, page_size=500):
+    """Диалоги кампании из dialog_state постранично по username (без долгой транзакции на всё время прогона)."""
+    last_username = ""
+    while True:
+        rows = await pool.fetch("""
+            SELECT username, state->'messages' AS messages FROM dialog_state
+            WHERE campaign = $1 AND username > $2
+            ORDER BY username
+            LIMIT $3;
+        """, campaign, last_username, page_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row["username"], json.loads(row["messages"] or "[]")
+        last_username = rows[-1]["username"]
+
+
+async def source_dialogs(args, pool):
+    if args.campaign and not args.logs:
+        async for item in stored_dialogs(pool, args.campaign):
+            yield item
+    else:
+        for item in logs_dialogs(args.logs or script.LOGS_DIR):
+            yield item
+
+
+def load_checkpoint(path):
+    """Пользователи, которые уже обработаны в прошлых запусках."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                done.add(json.loads(line)["username"])
+            except (ValueError, KeyError):
+                # Строка, оборванная при остановке посреди записи
+                continue
+    return done
+
+
+def save_checkpoint(path, entries):
+    with open(path, "a", encoding="utf-8") as file:
+        for username, status in entries:
+            file.write(json.dumps({"username": username, "status": status}, ensure_ascii=False) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+async def qualified_usernames(pool, usernames):
+    """Кто из пачки уже с квалификацией в user_stats."""
+    rows = await pool.fetch("""
+        SELECT username FROM user_stats
+        WHERE username = ANY($1::varchar[]) AND qualification IS NOT NULL;
+    """, usernames)
+    return {row["username"] for row in rows}
+
+
+class Requalifier:
+    def __init__(self, args, pool, prompt_template):
+        self.args = args
+        self.pool = pool
+        self.prompt_template = prompt_template
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.counts = {"written": 0, "partial": 0, "missing": 0, "empty": 0, "failed": 0, "skipped": 0}
+
+    async def analyze(self, username, messages):
+        async with self.semaphore:
+            try:
+                return username, await script.analyze_qualification(messages, self.prompt_template)
+            except Exception as e:
+                logging.error(f"Ошибка анализа квалификации пользователя {username}: {e}")
+                return username, None
+
+    async def process(self, batch):
+        """Анализ пачки, запись результатов одним запросом и отметка в checkpoint."""
+        if not self.args.force:
+            qualified = await qualified_usernames(self.pool, [username for username, _ in batch])
+            self.counts["skipped"] += len(qualified)
+            save_checkpoint(self.args.checkpoint, [(username, "qualified") for username in sorted(qualified)])
+            batch = [(username, messages) for username, messages in batch if username not in qualified]
+
+        results = await asyncio.gather(*(self.analyze(username, messages) for username, messages in batch))
+        analyses = [(username, result) for username, result in results if result]
+        # Пустой результат (модель не ответила, ошибка) в checkpoint не попадает — повторится при следующем запуске
+        empty = [username for username, result in results if not result]
+        written = await script.update_database_with_analysis(analyses, self.pool)
+        if written is None:
+            self.counts["failed"] += len(results)
+            return
+        # В checkpoint только те, чья строка в user_stats действительно обновлена: без строки результат
+        # некуда записать, и при следующем запуске такой диалог проанализируется снова (из кэша)
+        missing = [username for username, _ in analyses if username not in written]
+        for username in missing:
+            logging.warning(f"У пользователя {username} нет строки в user_stats, квалификация не записана.")
+        # Неполный анализ (не все поля прошли проверку) записан, но в checkpoint не попадает — повторится
+        partial = {username for username, result in analyses
+                   if username in written and script.QUALIFICATION_OUTPUT.validate(result)}
+        save_checkpoint(self.args.checkpoint, [(username, "written") for username in sorted(written - partial)])
+        self.counts["written"] += len(written) - len(partial)
+        self.counts["partial"] += len(partial)
+        self.counts["missing"] += len(missing)
+        self.counts["empty"] += len(empty)
+        logging.info(f"Пачка обработана: записано {len(written) - len(partial)}, частично {len(partial)}, "
+                     f"без строки в user_stats {len(missing)}, без результата {len(empty)}; всего {self.counts}")
+
+    async def run(self):
+        done = load_checkpoint(self.args.checkpoint)
+        batch = []
+        taken = 0
+        async for username, messages in source_dialogs(self.args, self.pool):
+            if username in done:
+                continue
+            if sum(1 for message in messages if message.get("role") == "user") < self.args.min_user_messages:
+                self.counts["skipped"] += 1
+                continue
+            batch.append((username, messages))
+            taken += 1
+            if len(batch) >= self.args.batch_size:
+                await self.process(batch)
+                batch = []
+            if self.args.limit and taken >= self.args.limit:
+                break
+        if batch:
+            await self.process(batch)
+        return self.counts
+
+
+def campaign_prompt(args):
+    """Промпт квалификации кампании из файла кампаний или промпт скрипта по умолчанию."""
+    if not args.campaigns:
+        return script.qualification_prompt_template
+    for config in script.load_campaign_configs(args.campaigns):
+        if config["index_name"] == args.campaign:
+            return (config.get("prompts") or {}).get("qualification_prompt_template",
+                                                     script.qualification_prompt_template)
+    raise ValueError(f"Кампании {args.campaign} нет в {args.campaigns}")
+
+
+async def main(args):
+    prompt_template = campaign_prompt(args)
+    await script.initialize_tables()
+    pool = await script.create_db_pool()
+    # Уже посчитанные анализы (в том числе прошлых запусков) берутся из кэша, а не у модели
+    script.analysis_cache.attach(pool)
+    try:
+        return await Requalifier(args, pool, prompt_template).run()
+    finally:
+        await pool.close()
+        await get_llm_client().close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Анализ квалификации по записанным диалогам")
+    parser.add_argument("--logs", help="Каталог с файлами диалогов (по умолчанию LOGS_DIR скрипта)")
+    parser.add_argument("--campaign", help="index_name кампании: без --logs диалоги берутся из dialog_state")
+    parser.add_argument("--campaigns", help="JSON-файл кампаний, из которого берётся промпт квалификации --campaign")
+    parser.add_argument("--checkpoint", default="requalify_checkpoint.jsonl", help="Файл обработанных пользователей")
+    parser.add_argument("--concurrency", type=int, default=8, help="Одновременных анализов, не больше")
+    parser.add_argument("--batch-size", type=int, default=200, help="Диалогов в одной пачке записи")
+    parser.add_argument("--min-user-messages", type=int, default=2, help="Пропускать диалоги, где пользователь написал меньше")
+    parser.add_argument("--limit", type=int, help="Обработать не больше стольких диалогов за запуск")
+    parser.add_argument("--force", action="store_true", help="Анализировать и тех, у кого квалификация уже есть")
+    args = parser.parse_args(argv)
+    if args.campaigns and not args.campaign:
+        parser.error("--campaigns указывается вместе с --campaign")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    counts = asyncio.run(main(args))
+    print(f"Записано: {counts['written']}, частично: {counts['partial']}, без строки в user_stats: {counts['missing']}, "
+          f"без результата: {counts['empty']}, не записано из-за ошибки базы: {counts['failed']}, пропущено: {counts['skipped']}")
+    sys.exit(1 if counts["failed"] else 0)
@@ -5,40 +5,52 @@ import openai
 import asyncpg
 from dotenv import load_dotenv
 from pyrogram import Client
-import pandas as pd
-from asyncpg import exceptions
 import argparse
-from datetime import datetime, timedelta
-import re
-from collections import defaultdict
-import json  # Добавлено для работы с JSON
-
-# Инициализация контекста и словаря сообщений для каждого пользователя
-context = defaultdict(list)
-user_messages = defaultdict(list)
-timers = {}
+import sys
+import time
+
+# Корневая папка проекта, чтобы импортировать общие модули из common/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.lead_source import get_lead_source
+from common.lead_queue import create_leads_table, import_leads, claim_lead
+from common.db import create_db_pool
+from common.stats_writer import StatsWriter
+from common.stats_counters import create_counters
+from common.llm_client import get_llm_client, LLMError, paragraphs
+from common.dialog_context import DialogContext
+from common.dialog_store import DialogStore, create_dialog_state_table
+from common.timer_wheel import TimerWheel
+from common.account_pool import AccountPool
+from common.supervision import start_heartbeat, cancel_on_sigterm
+from common.transcripts import TranscriptWriter
+from common.log_setup import setup_logging, set_log_dialog, log_payload
+from common.metrics import start_metrics_server, MESSAGES_SENT, DEBOUNCE_WAIT, DB_WRITE_LATENCY
+from common.campaign_config import load_campaign_configs
+from common.analysis_cache import AnalysisCache, Uncached, create_analysis_cache_table
+from common.triggers import Triggers
+from common.structured import StructuredOutput, coerce_amount
+
+# Таймеры ответа и напоминаний всех кампаний обслуживает одно колесо таймеров (запускается в main)
+timer_wheel = TimerWheel()
+# Когда пришло первое из ещё не отвеченных сообщений (для метрики ожидания ответа)
+debounce_started = {}
+# Отложенная запись статистики в user_stats (создаётся в main)
+stats_writer = None
+# В запрос к нейросети уходят конспект старой части диалога и последние реплики, а не вся история
+dialog_context = DialogContext()
+# Результаты анализа диалогов по версии промпта и хэшу диалога (пул подключается в main)
+analysis_cache = AnalysisCache()
+# Заранее запущенные анализы ведения соцсетей: цикл событий держит задачи по слабой ссылке, без этого их соберёт GC
+seti_speculations = set()
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Настройка логгера
+# Настройка логгера: записи уходят в очередь, в файл и консоль их пишет отдельный поток
+# (уровень и формат — LOG_LEVEL и LOG_FORMAT в .env)
 log_filename = os.path.join(os.path.dirname(__file__), 'script_logs.txt')
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
-
-# Загрузка аргументов командной строки
-parser = argparse.ArgumentParser(description="Запуск скрипта с уникальным именем индекса")
-parser.add_argument('--index_name', type=str, required=True, help='Уникальное имя индекса для скрипта')
-args = parser.parse_args()
-
-index_name = args.index_name
+setup_logging(log_filename)
 
 # Путь к Excel файлу с юзернеймами
 EXCEL_FILE = '/yourpath/usernames.xlsx'
@@ -46,11 +58,27 @@ COLUMN_NAME = 'Script1'
 COLUMN_NAME = 'Script1name'
 BATCH_SIZE = 2
 
+# Окно склейки сообщений пользователя перед ответом и задержка напоминания, в секундах
+REPLY_DELAY = 15
+REMINDER_DELAY = 30
+# Ответ уходит пользователю по абзацам, пока модель дописывает остальные (STREAM_REPLIES=1 в .env)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+# Анализ ведения соцсетей запускается заранее, вместе с запросом к первому промпту (SETI_SPECULATIVE=0 отключает)
+SETI_SPECULATIVE = os.getenv("SETI_SPECULATIVE", "1") == "1"
+# Темп первых сообщений на аккаунт по умолчанию — 2 в день, раз в 20 минут (ACCOUNT_DAILY_QUOTA и SEND_RATE_PER_HOUR в .env)
+ACCOUNT_DAILY_QUOTA = int(os.getenv("ACCOUNT_DAILY_QUOTA", 2))
+SEND_RATE_PER_HOUR = float(os.getenv("SEND_RATE_PER_HOUR", 3))
+
+# Определяем названия столбцов для юзернеймов и имен клиентов
+username_column = 'Script1'
+name_column = 'Script1name'
+
 # Путь к директории логов
 LOGS_DIR = '/yourpath/Logs'
-os.makedirs(LOGS_DIR, exist_ok=True)
+# Файлы диалогов дописываются в отдельном потоке только новыми репликами (поток запускается в main)
+transcripts = TranscriptWriter(LOGS_DIR)
 
-# Асинхронное подключение к базе данных PostgreSQL
+# Асинхронное подключение к базе данных PostgreSQL (для разовых операций, остальная работа идёт через пул)
 async def create_db_connection():
     return await asyncpg.connect(
         database=os.getenv("DB_NAME"),
@@ -86,6 +114,11 @@ async def create_tables():
         current_index INT DEFAULT 0
     );
     """)
+    await create_leads_table(conn)
+    # Счётчики воронки для бота статистики, обновляются триггерами на user_stats
+    await create_counters(conn)
+    await create_dialog_state_table(conn)
+    await create_analysis_cache_table(conn)
     await conn.close()
 
 # Вызов функции создания таблиц
@@ -93,75 +126,50 @@ async def initialize_tables():
     await create_tables()
 
 # Функция для получения текущего индекса из базы данных
-async def get_current_index(conn, index_name):
-    row = await conn.fetchrow("""
+async def get_current_index(pool, index_name):
+    row = await pool.fetchrow("""
         SELECT current_index FROM processing_index WHERE index_name=$1;
     """, index_name)
     if row:
-        print(f"Индекс найден для {index_name}: {row['current_index']}")
+        logging.info(f"Индекс найден для {index_name}: {row['current_index']}")
         return row['current_index']
     else:
-        print(f"Индекс не найден для {index_name}, создаем новый.")
-        await conn.execute("""
+        logging.info(f"Индекс не найден для {index_name}, создаем новый.")
+        await pool.execute("""
             INSERT INTO processing_index (index_name, current_index) VALUES ($1, 0)
             ON CONFLICT (index_name) DO NOTHING;
-        """, index_name)
+        """, index_name, retry=True)
         return 0
 
-# Функция для обновления индекса в базе данных
-async def update_current_index(conn, new_index, index_name):
-    await conn.execute("""
-        UPDATE processing_index SET current_index=$1 WHERE index_name=$2;
-    """, new_index, index_name)
-    print(f"Индекс обновлен для {index_name}: {new_index}")
-
 # Асинхронная функция для обновления статистики
-async def log_and_update_stats_db(conn, username, user_replied, message_count, sensitive_info_sent,
+# Запись отложенная: обновления копятся в stats_writer и уходят в базу пачкой раз в STATS_FLUSH_INTERVAL_MS
+async def log_and_update_stats_db(username, user_replied, message_count, sensitive_info_sent,
                                   initial_message_sent, qualification=None, summary=None,
                                   monthly_budget=None, consultation_agreed=None):
-    try:
-        print(f"Запись в БД: username={username}, user_replied={user_replied}, message_count={message_count}, "
-              f"sensitive_info_sent={sensitive_info_sent}, initial_message_sent={initial_message_sent}, "
-              f"qualification={qualification}, summary={summary}, monthly_budget={monthly_budget}, "
-              f"consultation_agreed={consultation_agreed}")
-        await conn.execute("""
-            INSERT INTO user_stats (
-                username, user_replied, message_count, sensitive_info_sent, 
-                initial_message_sent, qualification, summary, monthly_budget, 
-                consultation_agreed
-            )
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-            ON CONFLICT (username) 
-            DO UPDATE SET 
-                user_replied = EXCLUDED.user_replied,
-                message_count = EXCLUDED.message_count,
-                sensitive_info_sent = EXCLUDED.sensitive_info_sent,
-                initial_message_sent = EXCLUDED.initial_message_sent,
-                qualification = EXCLUDED.qualification,
-                summary = EXCLUDED.summary,
-                monthly_budget = EXCLUDED.monthly_budget,
-                consultation_agreed = EXCLUDED.consultation_agreed,
-                updated_at = CURRENT_TIMESTAMP;
-        """, username, user_replied, message_count, sensitive_info_sent, initial_message_sent,
-           qualification, summary, monthly_budget, consultation_agreed)
-    except exceptions.PostgresError as e:
-        print(f"Ошибка при записи в базу данных: {e}")
-
-# Функция для чтения одного юзернейма из Excel файла
-def load_single_username_from_excel(username_column, name_column, start_index):
-    df = pd.read_excel(EXCEL_FILE)
-    usernames = df[username_column].dropna().tolist()
-    names = df[name_column].dropna().tolist()
-
-    if start_index >= len(usernames):
-        return None, None, start_index
-
-    return usernames[start_index], names[start_index], start_index + 1
+    stats_writer.update(
+        username,
+        user_replied=user_replied,
+        message_count=message_count,
+        sensitive_info_sent=sensitive_info_sent,
+        initial_message_sent=initial_message_sent,
+        qualification=qualification,
+        summary=summary,
+        monthly_budget=monthly_budget,
+        consultation_agreed=consultation_agreed
+    )
+
+# Функция для загрузки новых лидов кампании из Excel (или CSV) файла в общую очередь leads
+# Лиды до старого курсора processing_index считаются уже обработанными
+async def load_leads_to_queue(campaign):
+    lead_source = get_lead_source(campaign.leads_file, campaign.username_column, campaign.name_column)
+    start_index = await get_current_index(campaign.pool, campaign.index_name)
+    async with campaign.pool.acquire() as conn:
+        return await import_leads(conn, campaign.index_name, lead_source, sent_before=start_index)
 
 
 
 # Список аккаунтов с данными для авторизации
-accounts = [{'session_name': '+79999999999}]
+accounts = [{'session_name': '+79999999999'}]
 
 # Определение начального сообщения (будет заменено новым промптом)
 initial_message = (
@@ -515,163 +523,212 @@ seti_prompt_template = [
     ]
 
 
+# Триггеры в ответах модели по умолчанию (кампания может задать свои в "triggers"):
+# подстрока без учёта регистра -> действие, prompts — на каких промптах правило действует
+TRIGGERS = [
+    # Первый промпт закончил свои вопросы: ответ не отправляется, выбираем второй или третий промпт
+    {"match": ["хорошо <3"], "action": "switch_prompt", "prompts": [1]},
+    {"match": ["коммерческое предложение"], "action": "send_document", "document": "/yourpath/example.pdf"},
+    # Отправлены контакты менеджера
+    {"match": ["https://t.me/Telegram_example", "https://t.me/AI_griban"], "action": "sensitive_info"},
+    # Диалог на втором или третьем промпте завершён — анализируем квалификацию
+    {"match": ["#спасибо"], "action": "qualify", "prompts": [2, 3]},
+]
+
+
+# Кампания: источник лидов, промпты, аккаунты и имя индекса. Несколько кампаний работают
+# в одном процессе и делят пул соединений, клиент OpenAI, колесо таймеров и кэши.
+# Незаданные в конфигурации значения берутся из констант выше.
+class Campaign:
+    def __init__(self, config, pool):
+        self.index_name = config["index_name"]
+        self.pool = pool
+        self.leads_file = config.get("leads_file", EXCEL_FILE)
+        self.username_column = config.get("username_column", username_column)
+        self.name_column = config.get("name_column", name_column)
+        self.session_names = config.get("accounts") or [account['session_name'] for account in accounts]
+
+        prompts = config.get("prompts") or {}
+        self.initial_message = prompts.get("initial_message", initial_message)
+        self.prompt_template_1 = prompts.get("prompt_template_1", prompt_template_1)
+        self.prompt_template_2 = prompts.get("prompt_template_2", prompt_template_2)
+        self.prompt_template_3 = prompts.get("prompt_template_3", prompt_template_3)
+        self.qualification_prompt_template = prompts.get("qualification_prompt_template", qualification_prompt_template)
+        self.seti_prompt_template = prompts.get("seti_prompt_template", seti_prompt_template)
+        self.stream_replies = config.get("stream_replies", STREAM_REPLIES)
+        # Триггеры собираются в один автомат при запуске кампании и проверяются за один проход по ответу
+        self.triggers = Triggers(config.get("triggers", TRIGGERS))
+
+        # Темп, дневная квота и часы рассылки задаются на каждый аккаунт (SEND_*, ACCOUNT_* в .env)
+        self.account_pool = AccountPool(daily_quota=ACCOUNT_DAILY_QUOTA, rate_per_hour=SEND_RATE_PER_HOUR)
+        # Диалог с запущенным таймером ответа обрабатывается и из памяти не выгружается
+        self.dialogs = DialogStore(
+            pool, self.index_name, is_busy=lambda username: timer_wheel.is_active(("reply", self.index_name, username))
+        )
+        self.clients = []
+
+    async def start(self):
+        self.dialogs.start()
+        await load_leads_to_queue(self)
+        for session_name in self.session_names:
+            client = Client(session_name)
+            await client.start()
+            self.clients.append(client)
+            self.account_pool.add(client, session_name)
+
+            # Регистрация обработчика сообщений: пользователю отвечает тот аккаунт, которому он написал
+            await handle_response(self, client)
+        logging.info(f"Кампания {self.index_name} запущена")
+        self.account_pool.log_projection()
+
+    async def close(self):
+        await self.dialogs.close()
+        for client in self.clients:
+            await client.stop()
+
 
-def validate_messages(messages):
-    if not isinstance(messages, list):
-        raise ValueError("Expected 'messages' to be a list.")
-    for msg in messages:
-        if not isinstance(msg, dict):
-            raise ValueError("Each message should be a dictionary.")
-        if "role" not in msg or "content" not in msg:
-            raise ValueError("Each message dictionary should contain 'role' and 'content'.")
+# Ответ-заглушка, если нейросеть так и не ответила
+FALLBACK_ANSWER = "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
+
+# Общий вызов нейросети: один клиент на процесс с keep-alive, лимитами RPM/TPM и повторами с паузой
+async def ask_model(full_context, max_retries, temperature, top_p, label="get_4o_answer"):
+    try:
+        content = await get_llm_client().complete(
+            full_context,
+            max_retries=max_retries,
+            temperature=temperature,
+            top_p=top_p,
+            label=label
+        )
+    except LLMError as e:
+        logging.error(f"Не удалось получить ответ от модели: {e}")
+        return FALLBACK_ANSWER
+    content = content.strip()
+    log_payload("Ответ от модели", content)  # Полный текст — только на уровне DEBUG
+    return content
 
 # Обновленная функция для получения ответа от нейросети 1
-async def get_4o_answer(messages, max_retries=3, temperature=0.7, top_p=0.6):
-    retries = 0
+async def get_4o_answer(campaign, messages, max_retries=3, temperature=0.7, top_p=0.6):
     # Объединяем начальный промпт с контекстом сообщений
-    full_context = prompt_template_1.copy()
+    full_context = campaign.prompt_template_1.copy()
     full_context.extend(messages)
 
-    print(f"Запускаем get_4o_answer с контекстом: {full_context}")  # Лог перед отправкой в API
-    while retries < max_retries:
-        try:
-            print(f"Попытка #{retries + 1} отправки запроса к OpenAI API")  # Лог попытки вызова API
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-4o-mini",
-                messages=full_context,
-                temperature=temperature,
-                top_p=top_p
-            )
-            content = response['choices'][0]['message']['content'].strip()
-            print(f"Ответ от модели: {content}")  # Логируем ответ
-            return content
-        except openai.error.RateLimitError as e:
-            print(f"Превышен лимит запросов к OpenAI API: {e}")
-            retries += 1
-        except openai.error.APIConnectionError as e:
-            print(f"Ошибка подключения к OpenAI API: {e}")
-            retries += 1
-        except openai.error.InvalidRequestError as e:
-            print(f"Некорректный запрос к OpenAI API: {e}")
-            break
-        except Exception as e:
-            print(f"Неизвестная ошибка при запросе к OpenAI API: {e}")
-            retries += 1
-
-    print(f"Не удалось получить ответ после {retries} попыток")
-    return "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
+    log_payload("Запрос к модели get_4o_answer", full_context)  # Контекст запроса — только на уровне DEBUG
+    return await ask_model(full_context, max_retries, temperature, top_p)
 
 
 
 
 # Обновленная функция для получения ответа от нейросети 2
-async def get_4o_answer_vedet(messages, max_retries=3, temperature=0.5, top_p=0.7):
-    retries = 0
-    full_context = prompt_template_2.copy()
+async def get_4o_answer_vedet(campaign, messages, max_retries=3, temperature=0.5, top_p=0.7):
+    full_context = campaign.prompt_template_2.copy()
     full_context.extend(messages)
 
-    print(f"Запускаем get_4o_answer с контекстом: {full_context}")  # Лог перед отправкой в API
-    while retries < max_retries:
-        try:
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-4o-mini",
-                messages=full_context,
-                temperature=temperature,
-                top_p=top_p
-            )
-            content = response['choices'][0]['message']['content'].strip()
-            print(f"Ответ от модели: {content}")
-            return content
-        # Обработка исключений
-        except openai.error.RateLimitError as e:
-            print(f"Превышен лимит запросов к OpenAI API: {e}")
-            retries += 1
-        except openai.error.APIConnectionError as e:
-            print(f"Ошибка подключения к OpenAI API: {e}")
-            retries += 1
-        except openai.error.InvalidRequestError as e:
-            print(f"Некорректный запрос к OpenAI API: {e}")
-            break
-        except Exception as e:
-            print(f"Неизвестная ошибка при запросе к OpenAI API: {e}")
-            retries += 1
-
-    print(f"Не удалось получить ответ после {retries} попыток")
-    return "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
+    log_payload("Запрос к модели get_4o_answer_vedet", full_context)  # Контекст запроса — только на уровне DEBUG
+    return await ask_model(full_context, max_retries, temperature, top_p, label="get_4o_answer_vedet")
 
 
 
 
 # Обновленная функция для получения ответа от нейросети 3
-async def get_4o_answer_nevedet(messages, max_retries=3, temperature=0.5, top_p=0.7):
-    retries = 0
-    full_context = prompt_template_3.copy()
+async def get_4o_answer_nevedet(campaign, messages, max_retries=3, temperature=0.5, top_p=0.7):
+    full_context = campaign.prompt_template_3.copy()
     full_context.extend(messages)
 
-    print(f"Запускаем get_4o_answer с контекстом: {full_context}")  # Лог перед отправкой в API
-    while retries < max_retries:
-        try:
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-4o-mini",
-                messages=full_context,
-                temperature=temperature,
-                top_p=top_p
-            )
-            content = response['choices'][0]['message']['content'].strip()
-            print(f"Ответ от модели: {content}")
-            return content
-        # Обработка исключений
-        except openai.error.RateLimitError as e:
-            print(f"Превышен лимит запросов к OpenAI API: {e}")
-            retries += 1
-        except openai.error.APIConnectionError as e:
-            print(f"Ошибка подключения к OpenAI API: {e}")
-            retries += 1
-        except openai.error.InvalidRequestError as e:
-            print(f"Некорректный запрос к OpenAI API: {e}")
-            break
-        except Exception as e:
-            print(f"Неизвестная ошибка при запросе к OpenAI API: {e}")
-            retries += 1
+    log_payload("Запрос к модели get_4o_answer_nevedet", full_context)  # Контекст запроса — только на уровне DEBUG
+    return await ask_model(full_context, max_retries, temperature, top_p, label="get_4o_answer_nevedet")
 
-    print(f"Не удалось получить ответ после {retries} попыток")
-    return "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
 
+# Потоковый ответ: каждый готовый абзац сразу уходит пользователю и добавляется в sent, пока модель пишет следующие.
+# Абзац, на котором hold(абзац) истинно, не отправляется, и ответ дальше не читается (его заменит ответ другого промпта).
+async def stream_answer(campaign, client, username, prompt_template, messages, label, temperature, top_p, sent,
+                        max_retries=3, hold=None):
+    full_context = prompt_template.copy()
+    full_context.extend(messages)
+    log_payload(f"Запрос к модели {label}", full_context)  # Контекст запроса — только на уровне DEBUG
+
+    received = []
+    start = len(sent)
+    try:
+        async for paragraph in paragraphs(get_llm_client().stream(
+                full_context, max_retries=max_retries, temperature=temperature, top_p=top_p, label=label)):
+            received.append(paragraph)
+            if hold and hold(paragraph):
+                break
+            await client.send_message(username, paragraph)
+            MESSAGES_SENT.inc(campaign=campaign.index_name, kind="reply")
+            sent.append(paragraph)
+    except LLMError as e:
+        logging.error(f"Не удалось получить ответ от модели: {e}")
+        # Если пользователь ещё ничего не получил, отвечаем заглушкой; начало ответа уже не отзываем
+        return "\n\n".join(sent[start:]) if len(sent) > start else FALLBACK_ANSWER
+
+    content = "\n\n".join(received)
+    log_payload("Ответ от модели", content)  # Полный текст — только на уровне DEBUG
+    return content
+
+
+# Запускает анализ ведения соцсетей в фоне, пока первый промпт формирует ответ. Если ответ окажется
+# триггером "Хорошо <3", seti_analyze_qualification получит тот же диалог и возьмёт результат из кэша
+# анализа (или дождётся этого же запроса), так что переход на второй или третий промпт стоит одного запроса.
+def speculate_seti(campaign, state):
+    task = asyncio.create_task(seti_analyze_qualification(list(state["messages"]), campaign.seti_prompt_template))
+    seti_speculations.add(task)
+    task.add_done_callback(seti_speculations.discard)
+
+
+# Ответ по промпту 1, 2 или 3; в потоковом режиме отправленные пользователю абзацы добавляются в sent
+async def get_answer(campaign, client, username, prompt, messages, sent, hold=None):
+    if not campaign.stream_replies:
+        answer = {1: get_4o_answer, 2: get_4o_answer_vedet, 3: get_4o_answer_nevedet}[prompt]
+        return await answer(campaign, messages)
+    if prompt == 1:
+        return await stream_answer(campaign, client, username, campaign.prompt_template_1, messages,
+                                   "get_4o_answer", 0.7, 0.6, sent, hold=hold)
+    if prompt == 2:
+        return await stream_answer(campaign, client, username, campaign.prompt_template_2, messages,
+                                   "get_4o_answer_vedet", 0.5, 0.7, sent)
+    return await stream_answer(campaign, client, username, campaign.prompt_template_3, messages,
+                               "get_4o_answer_nevedet", 0.5, 0.7, sent)
 
 
 
-# Функция для сохранения диалога в файл
-def save_dialog_to_file(username, messages):
-    user_log_file = os.path.join(LOGS_DIR, f"{username}.txt")
-    with open(user_log_file, 'a', encoding='utf-8') as file:
-        for message in messages:
-            file.write(f"{message['role'].capitalize()}: {message['content']}\n\n")
 
 # Функция для отправки приветственного сообщения и запуска таймера
-async def send_message(client, username, initial_message, context, conn):
+async def send_message(campaign, account, username, initial_message):
+    client = account.client
+    set_log_dialog(campaign.index_name, username)
     try:
-        logging.info(f"Отправка сообщения пользователю {username}: {initial_message}")
-
-        # Убедимся, что 'stats' есть в context
-        if 'stats' not in context:
-            context['stats'] = {}
-
-        # Убедимся, что для конкретного пользователя есть запись в 'stats'
-        if username not in context['stats']:
-            context['stats'][username] = {
-                "user_replied": False,
-                "message_count": 0,
-                "sensitive_info_sent": False,
-                "initial_message_sent": True,
-                "reminder_sent": False  # Инициализация reminder_sent
-            }
+        logging.info(f"Отправка сообщения пользователю {username}")
+        log_payload("Текст первого сообщения", initial_message)
 
+        # Вызывается внутри транзакции claim_lead: здесь только запрос к Telegram, без второго соединения с базой
         await client.send_message(username, initial_message)
-        logging.info(f"Приветственное сообщение успешно отправлено пользователю {username}")
+        MESSAGES_SENT.inc(campaign=campaign.index_name, kind="initial")
+        campaign.account_pool.record_sent(account)
+        logging.info(f"Приветственное сообщение успешно отправлено пользователю {username} с аккаунта {account.name}")
+        return True
+    except Exception as e:
+        # FloodWait/PeerFlood ставят аккаунт на паузу, а лид возвращается в очередь (None)
+        if campaign.account_pool.report_error(client, e):
+            logging.warning(f"Аккаунт {account.name} не смог написать пользователю {username}: {e}")
+            return None
+        logging.error(f"Ошибка при отправке сообщения пользователю {username}: {e}")
+        return False
+
+# Диалог после отправки первого сообщения: состояние, статистика и таймер напоминания.
+# Вызывается после того, как статус лида зафиксирован и соединение очереди вернулось в пул
+async def start_dialog(campaign, account, username):
+    set_log_dialog(campaign.index_name, username)
+    try:
+        # Состояние диалога создаётся при первой отправке; диалог закрепляется за аккаунтом
+        state = await campaign.dialogs.get(username)
+        state["account"] = account.name
+        state["stats"]["initial_message_sent"] = True
+        campaign.dialogs.mark_dirty(username)
 
         # Обновляем статистику после отправки сообщения
         await log_and_update_stats_db(
-            conn,
             username=username,
             user_replied=False,
             message_count=0,
@@ -680,434 +737,523 @@ async def send_message(client, username, initial_message, context, conn):
         )
 
         # Запускаем таймер на 2 часа для отправки напоминания
-        asyncio.create_task(reminder_timer(client, username, context, conn))
-        await asyncio.sleep(1)
+        timer_wheel.schedule(("reminder", campaign.index_name, username), REMINDER_DELAY, reminder_timer, campaign, account.client, username)
     except Exception as e:
-        logging.error(f"Ошибка при отправке сообщения пользователю {username}: {e}")
+        logging.error(f"Ошибка при сохранении диалога после первого сообщения пользователю {username}: {e}")
 
-# Функция, запускающая таймер на 2 часа
-async def reminder_timer(client, username, context, conn):
+# Напоминание пользователю, который не ответил (вызывается колесом таймеров)
+async def reminder_timer(campaign, client, username):
+    set_log_dialog(campaign.index_name, username)
     reminder_message = (
         "Хотелось бы задать вам буквально пару вопросов — это не займет много времени.\n"
         "Буду рада вашему ответу!"
     )
     try:
-        # Ждем 2 часа (7200 секунд)
-        await asyncio.sleep(30)
-
         # Проверяем, если пользователь не ответил и напоминание еще не отправлено
-        if not context['stats'][username]['user_replied'] and not context['stats'][username]['reminder_sent']:
+        # Диалог могли выгрузить из памяти за время ожидания — подгружаем из базы
+        stats = (await campaign.dialogs.get(username))["stats"]
+        if not stats['user_replied'] and not stats['reminder_sent']:
             await client.send_message(username, reminder_message)
-            context['stats'][username]['reminder_sent'] = True
+            MESSAGES_SENT.inc(campaign=campaign.index_name, kind="reminder")
+            stats['reminder_sent'] = True
+            campaign.dialogs.mark_dirty(username)
             # Логируем отправку напоминания в базу данных
             await log_and_update_stats_db(
-                conn,
                 username=username,
                 user_replied=False,
-                message_count=context['stats'][username].get('message_count', 0),
+                message_count=stats.get('message_count', 0),
                 sensitive_info_sent=False,
-                initial_message_sent=context['stats'][username].get('initial_message_sent', False)
+                initial_message_sent=stats.get('initial_message_sent', False)
             )
     except asyncio.CancelledError:
         # Если таймер был отменен, просто выходим
         return
-
-context = {}
+    except Exception as e:
+        campaign.account_pool.report_error(client, e)
+        logging.error(f"Ошибка при отправке напоминания пользователю {username}: {e}")
 
 # Обработчик ответов от пользователей
-async def handle_response(client, context, conn):
+async def handle_response(campaign, client):
     @client.on_message()
     async def on_message(client, message):
-        print("Получено сообщение от пользователя")
         username = message.chat.username if message.chat.username else "unknown_user"
+        set_log_dialog(campaign.index_name, username)
+        logging.debug("Получено сообщение от пользователя")
 
-        # Проверяем, если пользователь уже есть в статистике
-        if username in context['stats']:
-            context['stats'][username]['user_replied'] = True
+        # Состояние диалога подгружается из базы, если его нет в памяти
+        state = await campaign.dialogs.get(username)
+        stats = state['stats']
+        stats['user_replied'] = True
+        campaign.dialogs.mark_dirty(username)
 
 
-        # Если таймер на напоминание существует, отменяем его
-        if username in timers:
-            timers[username].cancel()
-            del timers[username]
+        # Пользователь ответил — напоминание больше не нужно
+        timer_wheel.cancel(("reminder", campaign.index_name, username))
 
         # Логируем ответ пользователя в базу данных
         await log_and_update_stats_db(
-            conn,
             username=username,
             user_replied=True,
-            message_count=context['stats'][username].get('message_count', 0) + 1,
+            message_count=stats.get('message_count', 0) + 1,
             sensitive_info_sent=False,
-            initial_message_sent=context['stats'][username].get('initial_message_sent', False)
+            initial_message_sent=stats.get('initial_message_sent', False)
         )
 
 
         # Проверка на тип сообщения (голосовое сообщение, стикеры и т.д.)
         if message.voice or message.video_note:
-            print(f"Пользователь {username} отправил неподдерживаемый тип сообщения.")
+            logging.info(f"Пользователь {username} отправил неподдерживаемый тип сообщения.")
             ai_response = "Извините, мне сейчас неудобно слушать ваше сообщение в таком формате. Можете написать текстом?"
             await client.send_message(username, ai_response)
+            MESSAGES_SENT.inc(campaign=campaign.index_name, kind="reply")
             return
 
         if message.sticker:
-            print(f"Пользователь {username} отправил стикер.")
+            logging.info(f"Пользователь {username} отправил стикер.")
             ai_response = "Извините, мне сейчас неудобно обрабатывать стикеры. Можете написать текстом?"
             await client.send_message(username, ai_response)
+            MESSAGES_SENT.inc(campaign=campaign.index_name, kind="reply")
             return
 
-        # Инициализация контекста для нового пользователя
-        if username not in context:
-            print(f"Инициализация контекста для {username}")
-            context[username] = []
+        # Добавляем сообщение пользователя в буфер ещё не отвеченных сообщений
+        state["pending"].append({"role": "user", "content": message.text})
+        campaign.dialogs.mark_dirty(username)
 
-        # Добавляем сообщение пользователя в буфер (user_messages)
-        user_messages[username].append({"role": "user", "content": message.text})
-
-        # Сбрасываем таймер на 15 секунд, после которого будет отправлен ответ
-        await reset_timer(username, client, conn)
+        # Сбрасываем таймер, по истечении которого будет отправлен ответ
+        await reset_timer(campaign, username, client)
 
 # Функция для сброса и обновления таймера
-async def reset_timer(username, client, conn):
-    # Проверяем, есть ли активный таймер для пользователя, и отменяем его
-    if username in timers:
-        print(f"Сбрасываем таймер для пользователя {username}")
-        timers[username].cancel()  # Отменяем предыдущий таймер
+async def reset_timer(campaign, username, client):
+    # Если таймер уже идёт или ответ ещё формируется, сбрасываем его
+    if timer_wheel.cancel(("reply", campaign.index_name, username), running=True):
+        logging.debug("Сбрасываем таймер для пользователя %s", username)
 
-    # Запускаем новый таймер
-    timers[username] = asyncio.create_task(start_timer(username, client, conn))
+    # Ответ формируется через REPLY_DELAY секунд после последнего сообщения
+    debounce_started.setdefault(("reply", campaign.index_name, username), time.monotonic())
+    timer_wheel.schedule(("reply", campaign.index_name, username), REPLY_DELAY, start_timer, campaign, username, client)
 
 # Обновление функции start_timer для анализа и переключения на следующий промпт
-async def start_timer(username, client, conn):
-    print(f"Запускаем таймер для пользователя {username} на 15 секунд")
-    await asyncio.sleep(15)  # Ожидаем 15 секунд
-
-    if username in user_messages and user_messages[username]:
-        print(f"Таймер для пользователя {username} истек. Формируем запрос к нейросети.")
-
-        # Инициализация контекста, если это новый пользователь
-        if username not in context:
-            context[username] = {
-                "messages": [],
-                "use_alternate_prompt": False,
-                "in_secondary_prompt": False,
-                "current_prompt": 1  # Начинаем с первого промпта
-            }
-
-        # Добавляем временные сообщения в основной контекст
-        context[username]["messages"].extend(user_messages[username])
-        user_messages[username].clear()  # Очищаем временный буфер сообщений
-
-        save_dialog_to_file(username, context[username]["messages"])  # Сохраняем сообщения пользователя
-
+# (вызывается колесом таймеров, когда истекло окно склейки сообщений)
+async def start_timer(campaign, username, client):
+    set_log_dialog(campaign.index_name, username)
+    dialogs = campaign.dialogs
+    state = await dialogs.get(username)
+
+    # Сколько пользователь ждал ответа с первого неотвеченного сообщения
+    started = debounce_started.pop(("reply", campaign.index_name, username), None)
+    if started is not None:
+        DEBOUNCE_WAIT.observe(time.monotonic() - started, campaign=campaign.index_name)
+
+    if state["pending"]:
+        logging.debug("Таймер для пользователя %s истек. Формируем запрос к нейросети.", username)
+
+        # Переносим буфер сообщений в историю диалога
+        state["messages"].extend(state["pending"])
+        state["pending"].clear()
+        dialogs.mark_dirty(username)
+
+        # Абзацы, которые в потоковом режиме уже ушли пользователю, и сколько из них — до перехода на другой промпт
+        sent = []
+        sent_before = 0
+        answered = False
         try:
             # Проверяем, если мы уже на втором или третьем промпте
-            if context[username]["in_secondary_prompt"]:
-                # Проверка на текущий промпт (2 или 3)
-                if context[username]["current_prompt"] == 2:
-                    ai_response = await get_4o_answer_vedet(context[username]["messages"])
-                elif context[username]["current_prompt"] == 3:
-                    ai_response = await get_4o_answer_nevedet(context[username]["messages"])
+            if state["in_secondary_prompt"]:
+                # Ответ по текущему промпту (2 или 3)
+                ai_response = await get_answer(
+                    campaign, client, username, state["current_prompt"], dialog_context.history(state), sent
+                )
             else:
-                # Используем первый промпт по умолчанию
-                full_context = prompt_template_1.copy()
-                full_context.extend(context[username]["messages"])  # Добавляем все сообщения пользователя
-                ai_response = await get_4o_answer(full_context)
-
-                # Проверка на триггер "Хорошо <3" в ответе нейросети
-                if "хорошо <3" in ai_response.lower():
-                    print(f"Найден триггер 'Хорошо <3' в ответе нейросети. Переключаемся на другой промпт.")
-                    context[username]["use_alternate_prompt"] = True
-                    context[username]["in_secondary_prompt"] = True  # Устанавливаем, что теперь в процессе второго или третьего промпта
-
-                    # Выполняем анализ для выбора второго или третьего промпта
-                    seti_analysis_result = await seti_analyze_qualification(context[username]["messages"])
+                if SETI_SPECULATIVE:
+                    speculate_seti(campaign, state)
+                # Используем первый промпт по умолчанию; абзац с триггером перехода пользователю не отправляется
+                ai_response = await get_answer(
+                    campaign, client, username, 1, dialog_context.history(state), sent,
+                    hold=lambda paragraph: campaign.triggers.has(paragraph, "switch_prompt", prompt=1)
+                )
+
+                # Проверка на триггер перехода ("Хорошо <3") в ответе нейросети
+                if campaign.triggers.has(ai_response, "switch_prompt", prompt=1):
+                    logging.info("Найден триггер перехода в ответе нейросети. Переключаемся на другой промпт.")
+                    state["use_alternate_prompt"] = True
+                    state["in_secondary_prompt"] = True  # Устанавливаем, что теперь в процессе второго или третьего промпта
+
+                    # Выполняем анализ для выбора второго или третьего промпта (обычно он уже готов — см. speculate_seti)
+                    seti_analysis_result = await seti_analyze_qualification(state["messages"], campaign.seti_prompt_template)
                     if seti_analysis_result:
                         Vedet = seti_analysis_result.get("Vedet")
-                        print(f"Анализ соцсетей после 'Хорошо <3': {seti_analysis_result}")
+                        logging.info(f"Анализ соцсетей после триггера перехода: {seti_analysis_result}")
 
                         if Vedet == "да":
-                            context[username]["current_prompt"] = 2  # Устанавливаем, что теперь используем второй промпт
-                            ai_response = await get_4o_answer_vedet(context[username]["messages"])
+                            state["current_prompt"] = 2  # Устанавливаем, что теперь используем второй промпт
                         elif Vedet == "нет":
-                            context[username]["current_prompt"] = 3  # Переключаемся на третий промпт
-                            ai_response = await get_4o_answer_nevedet(context[username]["messages"])
+                            state["current_prompt"] = 3  # Переключаемся на третий промпт
+
+                        sent_before = len(sent)
+                        if Vedet in ("да", "нет"):
+                            ai_response = await get_answer(
+                                campaign, client, username, state["current_prompt"], dialog_context.history(state), sent
+                            )
                         else:
                             ai_response = "Извините, мне сейчас неудобно обработать ваш запрос."
 
             # Отправляем ответ пользователю и добавляем в контекст
             if ai_response:
-                print(f"Отправляем ответ пользователю {username}: {ai_response}")
-                await client.send_message(username, ai_response)
-                context[username]["messages"].append({"role": "assistant", "content": ai_response})
-
-            if "коммерческое предложение" in ai_response.lower():
-                print(f"Найдено упоминание 'коммерческое предложение'. Отправляем документ.")
-                await client.send_document(
-                    chat_id=username,
-                    document="/yourpath/example.pdf"
+                logging.info(f"Отправляем ответ пользователю {username}")
+                log_payload("Ответ пользователю", ai_response)
+                # Потоковый ответ уже ушёл по абзацам; целиком отправляем обычный ответ и заглушки
+                delivered = "\n\n".join(sent[sent_before:])
+                if delivered != ai_response:
+                    # Из потокового ответа досылаем только то, что пользователь ещё не видел: придержанный
+                    # абзац с триггером, если анализ соцсетей не дал результата и промпт остался прежним
+                    if delivered and ai_response.startswith(delivered + "\n\n"):
+                        rest = ai_response[len(delivered) + 2:]
+                    else:
+                        rest = ai_response
+                    await client.send_message(username, rest)
+                    MESSAGES_SENT.inc(campaign=campaign.index_name, kind="reply")
+                state["messages"].append({"role": "assistant", "content": "\n\n".join(sent[:sent_before] + [ai_response])})
+                answered = True
+                # Старые реплики сворачиваются в конспект в фоне, ответ пользователю не ждёт
+                dialog_context.schedule_summary(
+                    (campaign.index_name, username), state, on_update=lambda key, _: dialogs.mark_dirty(username)
                 )
 
+            # Все триггеры ответа находятся за один проход; действия выполняются в порядке описания
+            actions = campaign.triggers.match(ai_response, prompt=state["current_prompt"])
+            for action in actions:
+                if action["action"] == "send_document":
+                    logging.info(f"Найден триггер {action['match']}. Отправляем документ.")
+                    await client.send_document(chat_id=username, document=action["document"])
+                elif action["action"] == "send_message":
+                    logging.info(f"Найден триггер {action['match']}. Отправляем сообщение.")
+                    await client.send_message(username, action["text"])
+                    MESSAGES_SENT.inc(campaign=campaign.index_name, kind="reply")
+            sensitive_info_sent = any(action["action"] == "sensitive_info" for action in actions)
+
             await log_and_update_stats_db(
-                conn,
                 username=username,
                 user_replied=True,
-                message_count=len(context[username]["messages"]),
-                sensitive_info_sent=("https://t.me/Telegram_example" in ai_response),
+                message_count=len(state["messages"]),
+                sensitive_info_sent=sensitive_info_sent,
                 initial_message_sent=True
             )
 
-            # Проверка на хештег "#спасибо" в ответе
-            if "#спасибо" in ai_response.lower() and context[username]["in_secondary_prompt"]:
-                print(f"Найден хештег '#спасибо' в ответе пользователю {username}. Запускаем анализ квалификации.")
-                analysis_result = await analyze_qualification(context[username]["messages"])
+            # Триггер анализа квалификации ("#спасибо") на втором или третьем промпте
+            if state["in_secondary_prompt"] and any(action["action"] == "qualify" for action in actions):
+                logging.info(f"Найден триггер квалификации в ответе пользователю {username}. Запускаем анализ квалификации.")
+                analysis_result = await analyze_qualification(state["messages"], campaign.qualification_prompt_template)
 
                 if analysis_result:
-                    consultation_agreed = analysis_result.get('consultation_agreed', False)
-                    consultation_agreed = consultation_agreed.lower() == 'да' if isinstance(consultation_agreed, str) else consultation_agreed
                     await log_and_update_stats_db(
-                        conn,
                         username=username,
                         user_replied=True,
-                        message_count=len(context[username]["messages"]),
-                        sensitive_info_sent=("https://t.me/AI_griban" in ai_response),
+                        message_count=len(state["messages"]),
+                        sensitive_info_sent=sensitive_info_sent,
                         initial_message_sent=True,
                         qualification=analysis_result.get("qualification"),
                         summary=analysis_result.get("summary"),
                         monthly_budget=analysis_result.get("monthly_budget"),
-                        consultation_agreed=consultation_agreed
+                        consultation_agreed=consultation_agreed_flag(analysis_result.get("consultation_agreed"))
                     )
                 else:
-                    print(f"Не удалось получить результат анализа квалификации для пользователя {username}.")
+                    logging.warning(f"Не удалось получить результат анализа квалификации для пользователя {username}.")
 
 
+        except asyncio.CancelledError:
+            # Новое сообщение прервало потоковый ответ: абзацы, которые пользователь уже видел, остаются в истории
+            if sent and not answered:
+                state["messages"].append({"role": "assistant", "content": "\n\n".join(sent)})
+                dialogs.mark_dirty(username)
+            raise
         except Exception as e:
-            print(f"Ошибка при получении ответа от модели для пользователя {username}: {e}")
-    else:
-        print(f"Новое сообщение от пользователя {username} пришло, таймер сброшен.")
-
+            campaign.account_pool.report_error(client, e)
+            logging.error(f"Ошибка при получении ответа от модели для пользователя {username}: {e}")
 
-async def update_database_with_analysis(analysis_result, username, conn):
+        # Новые реплики дописываем в файл диалога, ход диалога записываем сразу, не дожидаясь фонового сброса
+        transcripts.append(username, state)
+        await dialogs.save(username)
+    else:
+        logging.debug("Новое сообщение от пользователя %s пришло, таймер сброшен.", username)
+
+
+# Ответ consultation_agreed анализа квалификации в BOOLEAN: "неясно" и пустое — None (записанное не меняется)
+def consultation_agreed_flag(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ('да', 'нет'):
+            return value == 'да'
+    return None
+
+
+# Результаты анализа квалификации пачкой: analyses — список (username, результат анализа).
+# Пустые поля не затирают записанное; строки блокируются в порядке username, как в StatsWriter.
+# Возвращает множество пользователей, чьи строки обновлены (у кого строки в user_stats нет, туда не входят),
+# или None при ошибке записи
+async def update_database_with_analysis(analyses, pool):
+    records = sorted(
+        (username,
+         analysis_result.get('qualification'),
+         analysis_result.get('summary'),
+         analysis_result.get('monthly_budget'),
+         consultation_agreed_flag(analysis_result.get('consultation_agreed')))
+        for username, analysis_result in analyses
+    )
+    if not records:
+        return set()
     try:
-        qualification = analysis_result.get('qualification')
-        summary = analysis_result.get('summary')
-        monthly_budget = analysis_result.get('monthly_budget')
-        consultation_agreed = analysis_result.get('consultation_agreed', False)
-
-        await conn.execute("""
-            UPDATE user_stats
-            SET qualification = $1,
-                summary = $2,
-                monthly_budget = $3,
-                consultation_agreed = $4,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE username = $5;
-        """, qualification, summary, monthly_budget, consultation_agreed, username)
-        print(f"База данных успешно обновлена для пользователя {username}.")
+        async with pool.acquire() as conn:
+            with DB_WRITE_LATENCY.time(table="user_stats"):
+                async with conn.transaction():
+                    rows = await conn.fetch("""
+                        SELECT username FROM user_stats
+                        WHERE username = ANY($1::varchar[])
+                        ORDER BY username
+                        FOR UPDATE;
+                    """, [record[0] for record in records])
+                    written = {row['username'] for row in rows}
+                    await conn.executemany("""
+                        UPDATE user_stats
+                        SET qualification = COALESCE($2, qualification),
+                            summary = COALESCE($3, summary),
+                            monthly_budget = COALESCE($4, monthly_budget),
+                            consultation_agreed = COALESCE($5, consultation_agreed),
+                            updated_at = CURRENT_TIMESTAMP
+                        WHERE username = $1;
+                    """, [record for record in records if record[0] in written])
+        missing = len(records) - len(written)
+        logging.info(f"Результаты анализа квалификации записаны в базу данных: {len(written)} пользователей"
+                     + (f", без строки в user_stats: {missing}." if missing else "."))
+        return written
     except Exception as e:
-        print(f"Ошибка при обновлении базы данных для пользователя {username}: {e}")
+        logging.error(f"Ошибка при записи результатов анализа квалификации в базу данных: {e}")
+        return None
 
 
+# Ответы анализов по JSON-схеме: запрос со structured outputs, проверка и одно исправление (common/structured.py)
+def coerce_seti(result):
+    vedet = result.get("Vedet")
+    if isinstance(vedet, str):
+        result["Vedet"] = vedet.strip().lower()
+    return result
+
+
+def coerce_qualification(result):
+    qualification = result.get("qualification")
+    if isinstance(qualification, str) and qualification.strip():
+        # "Горячий клиент" -> "горячий"
+        result["qualification"] = qualification.strip().lower().replace("ё", "е").split()[0]
+    if "monthly_budget" in result:
+        # "около 50000", "15к" -> число; бюджет без числа — null, а не ошибка записи в INT
+        result["monthly_budget"] = coerce_amount(result["monthly_budget"])
+    consultation_agreed = result.get("consultation_agreed")
+    if isinstance(consultation_agreed, bool):
+        result["consultation_agreed"] = "да" if consultation_agreed else "нет"
+    elif isinstance(consultation_agreed, str):
+        result["consultation_agreed"] = consultation_agreed.strip().lower()
+    return result
+
+
+SETI_OUTPUT = StructuredOutput("seti_analysis", {
+    "type": "object",
+    "properties": {
+        "Vedet": {"type": "string", "enum": ["да", "нет", "неясно"]},
+    },
+    "required": ["Vedet"],
+    "additionalProperties": False,
+}, coerce=coerce_seti)
+
+QUALIFICATION_OUTPUT = StructuredOutput("qualification_analysis", {
+    "type": "object",
+    "properties": {
+        "qualification": {"type": "string", "enum": ["холодный", "теплый", "горячий"]},
+        "summary": {"type": "string"},
+        "monthly_budget": {"type": ["integer", "null"]},
+        "consultation_agreed": {"type": "string", "enum": ["да", "нет", "неясно"]},
+    },
+    "required": ["qualification", "summary", "monthly_budget", "consultation_agreed"],
+    "additionalProperties": False,
+}, coerce=coerce_qualification)
 
 
 # Функция для анализа ведения соц сетей
-async def seti_analyze_qualification(dialogue):
-    def parse_analysis_result(content):
-        try:
-            # Попробуем найти JSON в содержимом ответа
-            json_start = content.find('{')
-            json_end = content.rfind('}') + 1
-            json_content = content[json_start:json_end]
-
-            # Парсинг JSON из извлеченного содержимого
-            analysis_result = json.loads(json_content)
-            return analysis_result
-        except json.JSONDecodeError:
-            print(f"Ошибка парсинга JSON: {content}")
-            return None
-
+async def seti_analyze_qualification(dialogue, prompt_template=seti_prompt_template):
     # Формируем полный контекст для анализа
-    analysis_context = seti_prompt_template.copy()
+    analysis_context = prompt_template.copy()
     analysis_context.extend(dialogue)
 
-    try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",
-            messages=analysis_context,
-            temperature=0.5,
-            top_p=0.9
-        )
-        content = response['choices'][0]['message']['content']
-        print(f"Ответ от модели для анализа ведения соцсетей: {content}")  # Вывод ответа от модели
-
-        # Парсим ответ от модели
-        analysis_result = parse_analysis_result(content)
-        if not analysis_result:
-            print("Анализ результата вернул None. Проверьте формат ответа от модели.")
-        return analysis_result
-    except Exception as e:
-        print(f"Ошибка при анализе ведения соцсетей: {e}")
-        return None
-
-
-
-
-
-# Функция для анализа квалификации
-async def analyze_qualification(dialogue):
-    def parse_analysis_result(content):
-        import json
+    async def request_analysis():
         try:
-            analysis_result = json.loads(content)
-            return analysis_result
-        except json.JSONDecodeError:
-            lines = content.split('\n')
-            result = {}
-
-            for line in lines:
-                if line.strip().startswith('{') or line.strip().startswith('}'):
-                    continue
-
-                if ':' in line:
-                    key, value = line.strip().split(':', 1)
-                    key = key.strip().replace('"', '')
-                    value = value.strip().replace('"', '')
-
-                    if key == 'qualification':
-                        result[key] = value
-                    elif key == 'summary':
-                        result[key] = value
-                    elif key == 'monthly_budget':
-                        if value.lower() == 'null':
-                            result[key] = None
-                        else:
-                            result[key] = int(value.replace(',', ''))
-                    elif key == 'consultation_agreed':
-                        result[key] = value.lower() == 'true'
-                else:
-                    match = re.match(r'"(\w+)":\s*(.*)', line)
-                    if match:
-                        key, value = match.groups()
-                        result[key] = value
-
-            return result
-
-    # Формируем полный контекст для анализа
-    analysis_context = [
-        qualification_prompt_template,
-    ]
-    analysis_context.extend(dialogue)
+            analysis_result, errors = await SETI_OUTPUT.request(
+                analysis_context,
+                label="seti_analyze_qualification",
+                temperature=0.5,
+                top_p=0.9
+            )
+        except Exception as e:
+            logging.error(f"Ошибка при анализе ведения соцсетей: {e}")
+            return None
+        # Без Vedet выбрать второй или третий промпт нельзя
+        if not analysis_result or "Vedet" not in analysis_result:
+            logging.warning("Анализ ведения соцсетей не вернул Vedet даже после исправления ответа.")
+            return None
+        # Ответ, собранный из частично верных полей, не кэшируем: следующий анализ спросит модель снова
+        return Uncached(analysis_result) if errors else analysis_result
 
-    try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",  # Используйте подходящую модель
-            messages=analysis_context,
-            temperature=0.5,
-            top_p=0.9
-        )
-        content = response['choices'][0]['message']['content']
-        print(f"Ответ от модели для анализа квалификации: {content}")
+    # Тот же диалог с тем же промптом и схемой повторно не анализируем
+    return await analysis_cache.get_or_compute(
+        "seti", [prompt_template, SETI_OUTPUT.schema], dialogue, request_analysis
+    )
 
-        # Парсим ответ от модели
-        analysis_result = parse_analysis_result(content)
-        return analysis_result
-    except Exception as e:
-        print(f"Ошибка при анализе квалификации: {e}")
-        return None
 
+# Функция для анализа квалификации
+async def analyze_qualification(dialogue, prompt_template=qualification_prompt_template):
     # Формируем полный контекст для анализа
     analysis_context = [
-        qualification_prompt_template,
+        prompt_template,
     ]
     analysis_context.extend(dialogue)
 
-    try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",  # Используйте подходящую модель
-            messages=analysis_context,
-            temperature=0.5,
-            top_p=0.9
-        )
-        content = response['choices'][0]['message']['content']
-        print(f"Ответ от модели для анализа квалификации: {content}")
-
-        # Парсим ответ от модели
-        analysis_result = parse_analysis_result(content)
+    async def request_analysis():
+        try:
+            analysis_result, errors = await QUALIFICATION_OUTPUT.request(
+                analysis_context,
+                label="analyze_qualification",
+                temperature=0.5,
+                top_p=0.9
+            )
+        except Exception as e:
+            logging.error(f"Ошибка при анализе квалификации: {e}")
+            return None
+        if errors and analysis_result:
+            # Поля, которые прошли проверку, записываем, но не кэшируем: иначе неполный результат
+            # навсегда заменил бы повторный анализ этого диалога
+            logging.warning(f"Анализ квалификации сохранён частично ({', '.join(analysis_result)}): {'; '.join(errors)}")
+            return Uncached(analysis_result)
         return analysis_result
-    except Exception as e:
-        print(f"Ошибка при анализе квалификации: {e}")
-        return None
-  
-
-
-# Определяем названия столбцов для юзернеймов и имен клиентов
-username_column = 'Script1'
-name_column = 'Script1name'
-
-# Основная функция выполнения программы
-async def main(index_name):
-    clients = []
-    context = {}
-    users_processed = 0
-    max_users_per_day = 2
 
-    conn = await create_db_connection()
+    # Тот же диалог с тем же промптом и схемой повторно не анализируем
+    return await analysis_cache.get_or_compute(
+        "qualification", [prompt_template, QUALIFICATION_OUTPUT.schema], dialogue, request_analysis
+    )
 
-    for account in accounts:
-        client = Client(account['session_name'])
-        await client.start()
-        clients.append(client)
 
-        # Регистрация обработчика сообщений
-        asyncio.create_task(handle_response(clients[0], context, conn))
 
+# Рассылка первых сообщений одной кампании
+async def run_campaign(campaign):
+    account_pool = campaign.account_pool
+    while True:
+        # Записи лога рассылки помечаются кампанией, пока не взят очередной лид
+        set_log_dialog(campaign.index_name)
+        account = account_pool.pick()
+        if account is not None:
+            # Подгружаем в очередь новые строки, если файл с лидами изменился
+            await load_leads_to_queue(campaign)
+
+            # Выборка лида, отправка и смена его статуса проходят в одной транзакции;
+            # состояние диалога и пауза — уже после неё, чтобы не держать соединение очереди
+            sent = False
+            async with campaign.pool.acquire() as conn, claim_lead(conn, campaign.index_name) as lead:
+                if lead:
+                    username, client_name = lead['username'], lead['name']
+                    logging.info(f"[{campaign.index_name}] Username взят в работу: {username}, Имя клиента: {client_name}")  # Логируем username и имя
+
+                    if client_name:
+                        # Форматируем приветственное сообщение с использованием имени клиента
+                        personalized_message = campaign.initial_message.replace('Script1name', client_name)
+
+                        # Отправляем сообщение
+                        sent = await send_message(campaign, account, username, personalized_message)
+                        if sent is None:
+                            # Аккаунт получил ограничение Telegram — лид достанется следующему аккаунту
+                            lead['status'] = 'pending'
+                        else:
+                            lead['status'] = 'sent' if sent else 'failed'
+                    else:
+                        logging.info(f"У лида {username} не указано имя, пропускаем")
+                        lead['status'] = 'skipped'
+
+            if lead is None:
+                logging.info(f"[{campaign.index_name}] Нет больше пользователей для обработки")
+                return
+            if sent:
+                await start_dialog(campaign, account, lead['username'])
+                await asyncio.sleep(1)
+        else:
+            # Ждём токен в бакете аккаунта, конец паузы после FloodWait, окно активности или сброс дневных квот
+            wait_time = account_pool.seconds_until_available()
+            logging.info(f"[{campaign.index_name}] Нет аккаунтов, готовых к отправке. Ждем {wait_time:.0f} сек")
+            await asyncio.sleep(max(wait_time, 1))
+
+# Общие для всех кампаний ресурсы процесса: пул соединений, запись статистики, колесо таймеров,
+# запись файлов диалогов и кэш анализа
+async def open_runtime():
+    global stats_writer
+    pool = await create_db_pool()
+    stats_writer = StatsWriter(pool).start()
+    timer_wheel.start()
+    transcripts.start()
+    analysis_cache.attach(pool)
+    return pool
+
+# Дописываем состояние диалогов и накопленную статистику перед закрытием пула
+async def close_runtime(pool, campaigns):
+    await timer_wheel.close()
+    await transcripts.close()
+    for campaign in campaigns:
+        await campaign.close()
+    await stats_writer.close()
+    await pool.close()
+    await get_llm_client().close()
+
+# Основная функция выполнения программы: все кампании в одном цикле событий
+async def main(campaign_configs):
+    campaigns = []
+    # Под супервизором run.py: пульс для проверки живости и корректная остановка по SIGTERM
+    cancel_on_sigterm()
+    start_heartbeat()
+    # Метрики процесса в формате Prometheus на localhost (METRICS_PORT)
+    metrics_server = await start_metrics_server()
+
+    pool = await open_runtime()
     try:
-        while True:
-            if users_processed < max_users_per_day:
-                start_index = await get_current_index(conn, index_name)
-                logging.info(f"Текущий индекс в работе: {start_index}")  # Логируем индекс
-                
-                # Вызов функции и передача названий столбцов
-                username, client_name, next_index = load_single_username_from_excel(username_column, name_column, start_index)
-
-                if username and client_name:
-                    logging.info(f"Username взят в работу: {username}, Имя клиента: {client_name}")  # Логируем username и имя
-                    
-                    # Форматируем приветственное сообщение с использованием имени клиента
-                    personalized_message = initial_message.replace('Script1name', client_name)
-                    
-                    # Отправляем сообщение
-                    await send_message(clients[0], username, personalized_message, context, conn)
-                    
-                    # Обновляем индекс
-                    await update_current_index(conn, next_index, index_name)
-                    
-                    users_processed += 1
-
-                    if users_processed < max_users_per_day:
-                        await asyncio.sleep(1200)  # Ждем 1200 сек 20 мин перед обработкой следующего пользователя
-                else:
-                    logging.info("Нет больше пользователей для обработки")
-                    break
-            else:
-                now = datetime.now()
-                tomorrow = now + timedelta(days=1)
-                next_run_time = datetime(tomorrow.year, tomorrow.month, tomorrow.day, 11, 0, 0)
-
-                wait_time = (next_run_time - now).total_seconds()
-                logging.info(f"Все пользователи обработаны. Ждем до {next_run_time}")
-                await asyncio.sleep(wait_time)
-
-                users_processed = 0
-
-        # Бесконечный цикл для удержания скрипта активным
+        sessions = {}
+        for config in campaign_configs:
+            campaign = Campaign(config, pool)
+            # Один аккаунт не может вести две кампании: его сообщения получили бы оба обработчика
+            for session_name in campaign.session_names:
+                if session_name in sessions:
+                    raise ValueError(f"Аккаунт {session_name} указан в кампаниях {sessions[session_name]} и {campaign.index_name}")
+                sessions[session_name] = campaign.index_name
+            campaigns.append(campaign)
+
+        for campaign in campaigns:
+            await campaign.start()
+
+        await asyncio.gather(*(run_campaign(campaign) for campaign in campaigns))
+
+        # Бесконечный цикл для удержания скрипта активным (обработчики ответов продолжают работать)
         while True:
             await asyncio.sleep(3600)  # Периодически спим, чтобы не занимать ресурсы
     finally:
-        await conn.close()
-        for client in clients:
-            await client.stop()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await close_runtime(pool, campaigns)
 
-# Запуск скрипта с указанием уникального имени индекса
+# Запуск скрипта: одна кампания по имени индекса или несколько из файла конфигурации
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Запуск рассылки для одной или нескольких кампаний")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--index_name', type=str, help='Уникальное имя индекса для одной кампании с настройками из скрипта')
+    group.add_argument('--campaigns', type=str, help='JSON-файл со списком кампаний')
+    args = parser.parse_args()
+
+    campaign_configs = load_campaign_configs(args.campaigns) if args.campaigns else [{"index_name": args.index_name}]
+
     asyncio.run(initialize_tables())  # Инициализируем таблицы перед запуском main
-    asyncio.run(main(index_name))
+    try:
+        asyncio.run(main(campaign_configs))
+    except asyncio.CancelledError:
+        logging.info("Скрипт остановлен")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Корневая папка проекта, чтобы импортировать общие модули из common/
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
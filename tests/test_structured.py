@@ -0,0 +1,82 @@
+import pytest
+
+from common.structured import StructuredOutput, coerce_amount, compile_schema
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "qualification": {"type": "string", "enum": ["да", "нет"]},
+        "monthly_budget": {"type": ["integer", "null"]},
+        "tags": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["qualification", "monthly_budget"],
+    "additionalProperties": False,
+}
+
+
+def errors_of(schema, value):
+    errors = []
+    compile_schema(schema)(value, "$", errors)
+    return errors
+
+
+def test_compile_schema_accepts_valid_object():
+    assert errors_of(SCHEMA, {"qualification": "да", "monthly_budget": None, "tags": ["a"]}) == []
+
+
+def test_compile_schema_reports_each_broken_field():
+    errors = errors_of(SCHEMA, {"qualification": "может", "tags": ["a", 1], "extra": 1})
+    paths = sorted(error.split(":", 1)[0] for error in errors)
+    assert paths == ["$.extra", "$.monthly_budget", "$.qualification", "$.tags[1]"]
+
+
+def test_compile_schema_bool_is_not_a_number():
+    assert errors_of({"type": "integer"}, True)
+    assert errors_of({"type": "number"}, 1.5) == []
+
+
+def test_compile_schema_stops_at_wrong_type():
+    # У значения не того типа вложенные поля не проверяются
+    assert len(errors_of(SCHEMA, ["да"])) == 1
+
+
+@pytest.mark.parametrize("value, expected", [
+    (50000, 50000),
+    (1500.6, 1501),
+    ("около 50 000", 50000),
+    ("50.000 руб", 50000),
+    ("15к", 15000),
+    ("15 тыс.", 15000),
+    ("1,5 млн", 1500000),
+    ("не знаю", None),
+    (None, None),
+    (True, None),
+    (-5, None),
+    (10 ** 12, None),
+])
+def test_coerce_amount(value, expected):
+    assert coerce_amount(value) == expected
+
+
+def test_parse_coerces_and_validates():
+    def coerce(result):
+        result["monthly_budget"] = coerce_amount(result.get("monthly_budget"))
+        return result
+    output = StructuredOutput("qualification", SCHEMA, coerce=coerce)
+    result, errors = output.parse('Вот ответ: {"qualification": "да", "monthly_budget": "15к"}')
+    assert result == {"qualification": "да", "monthly_budget": 15000}
+    assert errors == []
+    assert output.parse("без JSON") == (None, ["$: ответ не содержит JSON-объекта"])
+
+
+def test_salvage_keeps_fields_without_errors():
+    output = StructuredOutput("qualification", SCHEMA)
+    result = {"qualification": "может", "monthly_budget": 1000, "tags": ["a", 2], "extra": 1}
+    assert output.salvage(result, output.validate(result)) == {"monthly_budget": 1000}
+
+
+def test_salvage_returns_none_when_nothing_is_left():
+    output = StructuredOutput("qualification", SCHEMA)
+    result = {"qualification": "может"}
+    assert output.salvage(result, output.validate(result)) is None
+    assert output.salvage(None, ["$: ответ не содержит JSON-объекта"]) is None
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+from common.timer_wheel import TimerWheel
+
+# Маленькое колесо: оборот 4 × 0.02 = 0.08 с
+TICK = 0.02
+SLOTS = 4
+
+
+def run_wheel(scenario):
+    async def main():
+        wheel = TimerWheel(tick=TICK, slots=SLOTS).start()
+        try:
+            return await scenario(wheel)
+        finally:
+            await wheel.close()
+    return asyncio.run(main())
+
+
+def test_timer_beyond_one_revolution_fires_on_time():
+    async def scenario(wheel):
+        fired = []
+
+        async def callback():
+            fired.append(time.monotonic())
+
+        started = time.monotonic()
+        wheel.schedule(("reminder", "u1"), 0.3, callback)
+        # Ячейка таймера проходится несколько раз до срока — раньше времени он не срабатывает
+        await asyncio.sleep(0.2)
+        assert fired == []
+        assert wheel.is_pending(("reminder", "u1"))
+        await asyncio.sleep(0.25)
+        return started, fired
+
+    started, fired = run_wheel(scenario)
+    assert len(fired) == 1
+    assert 0.3 <= fired[0] - started < 0.3 + 3 * TICK
+
+
+def test_timers_in_same_slot_fire_by_their_own_deadline():
+    async def scenario(wheel):
+        fired = []
+
+        async def callback(name):
+            fired.append(name)
+
+        # Сроки отличаются ровно на оборот колеса и попадают в одну ячейку
+        wheel.schedule(("reply", "near"), 0.1, callback, "near")
+        wheel.schedule(("reply", "far"), 0.1 + TICK * SLOTS, callback, "far")
+        await asyncio.sleep(0.1 + TICK * 2)
+        near_only = list(fired)
+        await asyncio.sleep(TICK * SLOTS)
+        return near_only, fired
+
+    near_only, fired = run_wheel(scenario)
+    assert near_only == ["near"]
+    assert fired == ["near", "far"]
+
+
+def test_reschedule_and_cancel():
+    async def scenario(wheel):
+        fired = []
+
+        async def callback(name):
+            fired.append(name)
+
+        wheel.schedule(("reply", "u1"), 0.05, callback, "first")
+        wheel.schedule(("reply", "u1"), 0.25, callback, "moved")
+        wheel.schedule(("reminder", "u2"), 0.05, callback, "cancelled")
+        assert wheel.pending_count() == 2
+        assert wheel.cancel(("reminder", "u2"))
+        await asyncio.sleep(0.15)
+        assert fired == []
+        await asyncio.sleep(0.2)
+        return fired, wheel.pending_count()
+
+    fired, pending = run_wheel(scenario)
+    assert fired == ["moved"]
+    assert pending == 0
@@ -0,0 +1,33 @@
+from common.transcripts import collapse_repeated_history, format_turns, parse_transcript
+
+U1, A1, U2, A2, U3 = ("user", "u1"), ("assistant", "a1"), ("user", "u2"), ("assistant", "a2"), ("user", "u3")
+
+
+def as_dicts(messages):
+    return [{"role": role, "content": content} for role, content in messages]
+
+
+def test_collapse_old_layout_written_before_every_reply():
+    # Прежний save_dialog_to_file: вся история перед каждым ответом
+    messages = [U1] + [U1, A1, U2] + [U1, A1, U2, A2, U3]
+    assert collapse_repeated_history(messages) == [U1, A1, U2, A2, U3]
+
+
+def test_collapse_old_layout_read_from_file():
+    text = format_turns(as_dicts([U1])) + format_turns(as_dicts([U1, A1, U2])) + format_turns(as_dicts([U1, A1, U2, A2]))
+    assert collapse_repeated_history(parse_transcript(text)) == [U1, A1, U2, A2]
+
+
+def test_collapse_keeps_incremental_transcript():
+    messages = [A1, U1, A2, U2, ("assistant", "a3"), U3]
+    assert collapse_repeated_history(messages) == messages
+
+
+def test_collapse_keeps_appended_tail_after_last_copy():
+    messages = [U1, A1] + [U1, A1, U2, A2] + [U3]
+    assert collapse_repeated_history(messages) == [U1, A1, U2, A2, U3]
+
+
+def test_parse_transcript_multiline_messages():
+    text = "User: привет\n\nAssistant: строка 1\n\nстрока 2\n\nUser: ок\n\n"
+    assert parse_transcript(text) == [("user", "привет"), ("assistant", "строка 1\n\nстрока 2"), ("user", "ок")]
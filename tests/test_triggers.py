@@ -0,0 +1,52 @@
+import pytest
+
+from common.triggers import AhoCorasick, Triggers
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    matcher = AhoCorasick(["he", "she", "his", "hers"])
+    assert matcher.find("ushers") == {0, 1, 3}
+
+
+def test_aho_corasick_ignores_case():
+    matcher = AhoCorasick(["Хорошо <3", "#спасибо"])
+    assert matcher.find("ХОРОШО <3, #Спасибо") == {0, 1}
+
+
+def test_aho_corasick_pattern_inside_another():
+    matcher = AhoCorasick(["abcd", "bc"])
+    assert matcher.find("xabcx") == {1}
+    assert matcher.find("abcd") == {0, 1}
+    assert matcher.find("") == set()
+
+
+RULES = [
+    {"match": "Хорошо <3", "action": "switch_prompt", "prompts": [1]},
+    {"match": ["презентаци", "прайс"], "action": "send_document", "document": "deck.pdf"},
+    {"match": "#спасибо", "action": "qualify", "prompts": [2, 3]},
+]
+
+
+def test_triggers_match_in_rule_order():
+    triggers = Triggers(RULES)
+    actions = [rule["action"] for rule in triggers.match("#спасибо, прайс пришлю")]
+    assert actions == ["send_document", "qualify"]
+
+
+def test_triggers_filter_by_prompt():
+    triggers = Triggers(RULES)
+    assert triggers.has("Хорошо <3", "switch_prompt", prompt=1)
+    assert not triggers.has("Хорошо <3", "switch_prompt", prompt=2)
+    assert not triggers.has("#спасибо", "qualify", prompt=1)
+    assert triggers.has("#спасибо", "qualify")
+
+
+@pytest.mark.parametrize("rule", [
+    {"match": "x", "action": "unknown"},
+    {"match": "x", "action": "send_document"},
+    {"match": [], "action": "qualify"},
+    {"match": ["x", ""], "action": "qualify"},
+])
+def test_triggers_reject_invalid_rules(rule):
+    with pytest.raises(ValueError):
+        Triggers([rule])
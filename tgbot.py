@@ -1,11 +1,16 @@
+import asyncio
 import logging
 import os
+import time
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2 import sql
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CommandHandler, CallbackQueryHandler, CallbackContext, ApplicationBuilder
 
+from common.db import create_db_pool
+from common.stats_counters import fetch_counters
+from common.supervision import start_heartbeat
+from common.metrics import fetch_metrics, sum_samples, histogram_summary
+
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
@@ -19,65 +24,115 @@ logger = logging.getLogger(__name__)
 # Получение токена бота из переменных окружения
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
-# Настройки подключения к базе данных
-DB_CONFIG = {
-    'dbname': os.getenv('DB_NAME', ' '),
-    'user': os.getenv('DB_USER', ' '),
-    'password': os.getenv('DB_PASSWORD', ' ''),
-    'host': os.getenv('DB_HOST', 'localhost'),
-    'port': os.getenv('DB_PORT', '5432')
-}
-
-def get_database_connection():
-    """Создает и возвращает соединение с базой данных."""
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        logger.error(f"Ошибка подключения к базе данных: {e}")
-        return None
-
-def get_statistics():
-    """Извлекает статистику из базы данных и возвращает в виде словаря."""
-    conn = get_database_connection()
-    if not conn:
-        return None
-
-    try:
-        with conn.cursor() as cursor:
-            stats = {}
-
-            # Количество сообщений
-            cursor.execute("""
-                SELECT COUNT(*) FROM user_stats WHERE initial_message_sent = TRUE;
-            """)
-            stats['Количество сообщений'] = cursor.fetchone()[0]
-
-            # Начато диалогов
-            cursor.execute("""
-                SELECT COUNT(*) FROM user_stats WHERE user_replied = TRUE;
-            """)
-            stats['Начато диалогов'] = cursor.fetchone()[0]
-
-            # Получили контакты для консультации
-            cursor.execute("""
-                SELECT COUNT(*) FROM user_stats WHERE sensitive_info_sent = TRUE;
-            """)
-            stats['Получили контакты для консультации'] = cursor.fetchone()[0]
-
-            # Промежуточная конверсия
-            if stats['Количество сообщений'] > 0:
-                conversion_rate = (stats['Получили контакты для консультации'] / stats['Количество сообщений']) * 100
-            else:
-                conversion_rate = 0.0
-            stats['Промежуточная конверсия'] = conversion_rate
-
-            return stats
-    except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {e}")
-        return None
-    finally:
-        conn.close()
+# Настройки подключения к базе данных берутся из .env (DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
+db_pool = None
+
+# Сколько секунд отдавать статистику из кэша, прежде чем снова идти в базу
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', '30'))
+stats_cache = {'stats': None, 'expires_at': 0.0}
+stats_lock = asyncio.Lock()
+
+# Эндпоинты метрик скриптов рассылки через запятую (METRICS_PORT каждого процесса)
+METRICS_URLS = [url.strip() for url in os.getenv('METRICS_URLS', 'http://127.0.0.1:9108/metrics').split(',') if url.strip()]
+
+async def fetch_statistics():
+    """Читает статистику из счётчиков user_stats_counters — несколько строк независимо от размера user_stats."""
+    counters = await fetch_counters(db_pool)
+    stats = {
+        'Количество сообщений': counters.get('contacted', 0),
+        'Начато диалогов': counters.get('replied', 0),
+        'Получили контакты для консультации': counters.get('contact_shared', 0),
+        'Согласились на консультацию': counters.get('consultation_agreed', 0),
+        'Квалификация': {
+            bucket.split(':', 1)[1]: value
+            for bucket, value in counters.items()
+            if bucket.startswith('qualification:') and value > 0
+        },
+    }
+
+    # Промежуточная конверсия
+    if stats['Количество сообщений'] > 0:
+        conversion_rate = (stats['Получили контакты для консультации'] / stats['Количество сообщений']) * 100
+    else:
+        conversion_rate = 0.0
+    stats['Промежуточная конверсия'] = conversion_rate
+    return stats
+
+async def get_statistics():
+    """Возвращает статистику в виде словаря, обращаясь к базе не чаще раза в STATS_CACHE_TTL секунд."""
+    # Одновременные нажатия кнопки ждут один и тот же запрос, а не запускают свои
+    async with stats_lock:
+        now = time.monotonic()
+        if stats_cache['stats'] is not None and now < stats_cache['expires_at']:
+            return stats_cache['stats']
+
+        try:
+            stats = await fetch_statistics()
+        except Exception as e:
+            logger.error(f"Ошибка при получении статистики: {e}")
+            return None
+
+        stats_cache['stats'] = stats
+        stats_cache['expires_at'] = now + STATS_CACHE_TTL
+        return stats
+
+async def collect_metrics():
+    """Собирает метрики всех процессов рассылки; недоступные процессы пропускаются."""
+    samples = []
+    for url in METRICS_URLS:
+        try:
+            samples.extend(await fetch_metrics(url))
+        except Exception as e:
+            logger.warning(f"Не удалось получить метрики {url}: {e}")
+    return samples
+
+def format_metrics(samples, previous=None):
+    """Текст сводки метрик; previous — (время, отправлено сообщений) прошлого запроса для расчёта темпа."""
+    lines = ["Метрики рассылки", ""]
+
+    sent = sum_samples(samples, 'messages_sent_total', 'kind')
+    total_sent = sum(sent.values())
+    lines.append("Отправлено сообщений: " + (", ".join(f"{kind} {int(count)}" for kind, count in sorted(sent.items())) or "0"))
+    if previous is not None and time.monotonic() > previous[0] and total_sent >= previous[1]:
+        rate = (total_sent - previous[1]) / (time.monotonic() - previous[0]) * 60
+        lines.append(f"Темп с прошлого запроса: {rate:.1f} сообщений в минуту")
+    limits = sum_samples(samples, 'telegram_limits_total', 'error')
+    lines.append("Ограничения Telegram: " + (", ".join(f"{error} {int(count)}" for error, count in sorted(limits.items())) or "нет"))
+
+    lines.append("")
+    lines.append("Запросы к модели (число, среднее, p95, попыток в среднем):")
+    attempts = histogram_summary(samples, 'llm_request_attempts', 'prompt')
+    for prompt, (count, average, p95) in sorted(histogram_summary(samples, 'llm_request_seconds', 'prompt').items()):
+        average_attempts = attempts.get(prompt, (0, 1.0, None))[1]
+        lines.append(f"• {prompt}: {count}, {average:.2f} с, {p95} с, {average_attempts:.2f}")
+
+    for title, name, label in (("Первый кусок потокового ответа модели", 'llm_first_token_seconds', 'prompt'),
+                               ("Ожидание ответа пользователем", 'debounce_wait_seconds', 'campaign'),
+                               ("Запись в базу", 'db_write_seconds', 'table')):
+        summary = histogram_summary(samples, name, label)
+        if summary:
+            lines.append("")
+            lines.append(f"{title} (число, среднее, p95):")
+            lines.extend(f"• {group}: {count}, {average:.3f} с, {p95} с" for group, (count, average, p95) in sorted(summary.items()))
+
+    lines.append("")
+    lines.append(f"Диалогов в памяти: {int(sum_samples(samples, 'open_dialogs'))}")
+    timers = sum_samples(samples, 'pending_timers', 'kind')
+    lines.append("Ожидающих таймеров: " + (", ".join(f"{kind} {int(count)}" for kind, count in sorted(timers.items())) or "0"))
+    lines.append(f"Выполняется обработчиков таймеров: {int(sum_samples(samples, 'running_timer_tasks'))}")
+    lines.append(f"Задач в цикле событий: {int(sum_samples(samples, 'asyncio_tasks'))}")
+    return "\n".join(lines), total_sent
+
+async def metrics_command(update: Update, context: CallbackContext):
+    """Обработчик команды /metrics и кнопки 'Метрики рассылки'."""
+    message = update.message or update.callback_query.message
+    samples = await collect_metrics()
+    if not samples:
+        await message.reply_text("Метрики недоступны: скрипты рассылки не запущены или METRICS_URLS указан неверно.")
+        return
+    text, total_sent = format_metrics(samples, context.bot_data.get('metrics_previous'))
+    context.bot_data['metrics_previous'] = (time.monotonic(), total_sent)
+    await message.reply_text(text)
 
 async def start_command(update: Update, context: CallbackContext):
     """Обработчик команды /start."""
@@ -85,7 +140,8 @@ async def start_command(update: Update, context: CallbackContext):
     context.chat_data['chat_id'] = chat_id  # Сохраняем chat_id для текущей сессии
 
     keyboard = [
-        [InlineKeyboardButton("Получить статистику", callback_data='get_stats')]
+        [InlineKeyboardButton("Получить статистику", callback_data='get_stats')],
+        [InlineKeyboardButton("Метрики рассылки", callback_data='get_metrics')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     welcome_message = (
@@ -111,29 +167,54 @@ async def send_stats(update: Update, context: CallbackContext):
     """Обработчик кнопки 'Получить статистику'."""
     await delete_previous_message(context)  # Удаляем предыдущее сообщение, если оно есть
 
-    stats = get_statistics()
+    stats = await get_statistics()
     if stats:
         stats_message = (
             f"📊 *Статистика:*\n\n"
             f"• Количество сообщений: *{stats['Количество сообщений']}*\n"
             f"• Начато диалогов: *{stats['Начато диалогов']}*\n"
-            f"• Получили контакты для консультации: *{stats['Получили контакты для консультации']}*\n\n"
+            f"• Получили контакты для консультации: *{stats['Получили контакты для консультации']}*\n"
+            f"• Согласились на консультацию: *{stats['Согласились на консультацию']}*\n\n"
             f"Промежуточная конверсия составляет: *{stats['Промежуточная конверсия']:.2f}%*"
         )
+        if stats['Квалификация']:
+            stats_message += "\n\n*Квалификация лидов:*\n" + "\n".join(
+                f"• {qualification}: *{count}*" for qualification, count in sorted(stats['Квалификация'].items())
+            )
         sent_message = await update.callback_query.message.reply_text(stats_message, parse_mode='Markdown')
         # Сохраняем ID нового сообщения для дальнейшего удаления
         context.chat_data['last_stats_message_id'] = sent_message.message_id
     else:
         await update.callback_query.message.reply_text("Не удалось получить статистику. Попробуйте позже.")
 
+async def post_init(application):
+    """Открывает пул соединений с базой данных после запуска приложения."""
+    global db_pool
+    db_pool = await create_db_pool(min_size=1, max_size=2)
+    # Пульс для супервизора run.py (если бот запущен под ним)
+    application.bot_data['heartbeat'] = start_heartbeat()
+
+async def post_shutdown(application):
+    """Закрывает пул соединений при остановке бота."""
+    if db_pool is not None:
+        await db_pool.close()
+
 def main():
     """Основная функция запуска бота."""
     # Создание приложения бота
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler('start', start_command))
     application.add_handler(CallbackQueryHandler(send_stats, pattern='get_stats'))
+    application.add_handler(CommandHandler('metrics', metrics_command))
+    application.add_handler(CallbackQueryHandler(metrics_command, pattern='get_metrics'))
 
     # Запуск бота
     logger.info("Бот запущен и готов к работе.")